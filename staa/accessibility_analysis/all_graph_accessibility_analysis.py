@@ -3,31 +3,99 @@ import os
 from pathlib import Path
 import igraph as ig
 import geopandas as gpd
-from multiprocessing.pool import ThreadPool
-from sklearn.neighbors import BallTree
-import math
+from multiprocessing import get_context
+from typing import Dict, List, Tuple
 import logging
-import pickle
+import re
+
+from scipy.sparse import csr_matrix
+
+from .od_routing import OD_METRICS, RoutingGraph, od_tree_metrics, gather_od, walking_minutes
+from .od_result_store import write_od_result, stack_od_results, read_od_metric, from_compact_od_metric
+from .incremental_od import write_od_state, read_od_state, edge_changes, affected_origins, merge_od_states
+from .cumulative_accessibility import (point_travel_times, cumulative_opportunities, gravity_accessibility,
+                                       nearest_k_travel_times, write_accessibility_measures)
+from .reachability import ReachabilityIndex
+from .snapping import SnappingIndex
+from ..graph_analysis.utils.graph_store import GRAPH_STORE_SUFFIX, is_graph_store, read_graph_store
+from ..graph_analysis.utils.id_dictionary import graph_attribute
+from ..gtfs_prep.fingerprint import read_aliases, record_aliases
+from .stop_cost_table import build_stop_cost_table, stop_cost_table_dir
+from .hourly_routing import parse_hours, boarding_graph, hour_groups, hour_routing_graph
+from .connection_scan import (DEFAULT_MAX_WALK_M, DEFAULT_TRANSFER_RADIUS_M, ConnectionScan, connection_scan_od,
+                              mean_travel_time)
+from ..graph_analysis.utils.connection_store import connection_store_dir
 
 logging.basicConfig()
 logger = logging.getLogger("graph_accessibility_analysis")
 logger.setLevel(logging.INFO)
 
-EARTH_RADIUS_M = 6_371_009
-
 GRAPH_DATA_DIR = Path(os.environ["GRAPH_DATA_DIR"])
 OPPORTUNITIES_GEO_JSON = Path(os.environ["OPPORTUNITIES_GEO_JSON"])
 NEIGHBOURHOODS_GEO_JSON = Path(os.environ["NEIGHBOURHOODS_GEO_JSON"])
 RESULTS_PATH = Path(os.environ["RESULTS_PATH"])
-POI_TYPE_NAME = os.environ["POI_TYPE_NAME"]
+# Comma separated POI types (values of `Functie`) or 'all', routed together in a single pass.
+# POI_TYPE_NAME is still accepted for a single type.
+POI_TYPE_NAMES = os.getenv("POI_TYPE_NAMES") or os.environ["POI_TYPE_NAME"]
 NUM_WORKERS = int(os.getenv("NUM_WORKERS", 2))
+ORIGIN_CHUNK_SIZE = int(os.getenv("ORIGIN_CHUNK_SIZE", 128))
+# Number of nearest stops considered per neighbourhood/POI, the fastest combination is used
+ACCESS_STOP_CANDIDATES = int(os.getenv("ACCESS_STOP_CANDIDATES", 1))
+# Gather OD matrices from a persisted all stops to all stops table instead of routing per point set
+USE_STOP_COST_TABLE = bool(int(os.getenv("USE_STOP_COST_TABLE", 0)))
+# Compute bounded accessibility measures (cumulative opportunities, nearest-k, gravity) instead of full OD matrices
+ACCESSIBILITY_MEASURES = bool(int(os.getenv("ACCESSIBILITY_MEASURES", 0)))
+# Travel time thresholds in minutes, the unit of the graph's travel_time (UrbanAccess' weight)
+CUMULATIVE_THRESHOLDS = sorted(float(t) for t in os.getenv("CUMULATIVE_THRESHOLDS", "15,30,45,60").split(','))
+NEAREST_K = int(os.getenv("NEAREST_K", 3))
+# Gravity decay per minute of travel time, contributions beyond the largest threshold are cut off
+GRAVITY_BETA = float(os.getenv("GRAVITY_BETA", 1 / 30))
+SNAPPING_INDEX_DIR = Path(os.getenv("SNAPPING_INDEX_DIR", GRAPH_DATA_DIR.joinpath("snapping_indices")))
+# Compute the OD matrices of the graphs in date order, rerouting only the origins affected by the edge changes
+# since the previous graph and copying all other rows from its result
+INCREMENTAL_OD = bool(int(os.getenv("INCREMENTAL_OD", 0)))
+INCREMENTAL_STATE_DIR = Path(os.getenv("INCREMENTAL_STATE_DIR", RESULTS_PATH.joinpath("incremental_state")))
+# 'graph' routes over the static transit graph, 'connection_scan' over the schedule exported next to every graph
+# (GG_EXPORT_CONNECTIONS), travel times then are averaged over departures every DEPARTURE_STEP seconds of its window
+# that reach a pair, in minutes like those of the graph
+ROUTING_ENGINE = os.getenv("ROUTING_ENGINE", "graph")
+DEPARTURE_STEP = int(os.getenv("DEPARTURE_STEP", 300))
+# Connections departing later than this after the last departure of the window are not scanned
+CSA_MAX_TRAVEL_TIME = float(os.getenv("CSA_MAX_TRAVEL_TIME", 7200))
+CSA_TRANSFER_RADIUS_M = float(os.getenv("CSA_TRANSFER_RADIUS_M", DEFAULT_TRANSFER_RADIUS_M))
+# Chains of transfers between stops up to this length are walked as a single footpath
+CSA_MAX_WALK_M = float(os.getenv("CSA_MAX_WALK_M", DEFAULT_MAX_WALK_M))
+# Hours of the day ('all' or a comma separated list) to compute hourly OD matrices for on the static graph. Every
+# hour only keeps the segments served in it and every boarding, transfers included, pays the expected wait for its
+# route in that hour. This costs one routing pass per hour (24 for 'all'), only hours with identical service share
+# one, and the hours have to lie within the timerange the graphs were generated for (see
+# hourly_routing.window_hours), 'all' needs graphs of a full day window.
+ROUTING_HOURS = parse_hours(os.getenv("ROUTING_HOURS", ""))
+if ROUTING_ENGINE not in ('graph', 'connection_scan'):
+    raise ValueError(f"Unknown ROUTING_ENGINE {ROUTING_ENGINE}, expected 'graph' or 'connection_scan'")
+if ROUTING_ENGINE == 'connection_scan' and (INCREMENTAL_OD or ACCESSIBILITY_MEASURES or USE_STOP_COST_TABLE):
+    raise ValueError("ROUTING_ENGINE 'connection_scan' only computes full OD matrices, it can not be combined with "
+                     "INCREMENTAL_OD, ACCESSIBILITY_MEASURES or USE_STOP_COST_TABLE")
+if USE_STOP_COST_TABLE and INCREMENTAL_OD:
+    raise ValueError("USE_STOP_COST_TABLE can not be combined with INCREMENTAL_OD, incremental OD matrices route the "
+                     "affected origins to keep their shortest path trees")
+if ROUTING_HOURS and (ROUTING_ENGINE != 'graph' or INCREMENTAL_OD or ACCESSIBILITY_MEASURES or USE_STOP_COST_TABLE):
+    raise ValueError("ROUTING_HOURS only computes full OD matrices on the static graph, it can not be combined with "
+                     "ROUTING_ENGINE 'connection_scan', INCREMENTAL_OD, ACCESSIBILITY_MEASURES or USE_STOP_COST_TABLE")
 
 # Global DataFrames
 destinations = gpd.read_file(OPPORTUNITIES_GEO_JSON)
 destinations.geometry = gpd.points_from_xy(destinations.geometry.y, destinations.geometry.x, crs='EPSG:4326')
 
-poi_gdf = destinations[destinations.Functie == POI_TYPE_NAME]
+if POI_TYPE_NAMES == 'all':
+    poi_types = sorted(destinations.Functie.dropna().unique())
+else:
+    poi_types = [poi_type.strip() for poi_type in POI_TYPE_NAMES.split(',')]
+
+poi_gdf = destinations[destinations.Functie.isin(poi_types)]
 poi_gdf.geometry = gpd.points_from_xy(poi_gdf.geometry.x, poi_gdf.geometry.y, crs='EPSG:4326')
+# Columns of the OD matrices belonging to every POI type
+poi_type_columns = {poi_type: np.flatnonzero(poi_gdf.Functie.values == poi_type) for poi_type in poi_types}
 
 # Read Amsterdam Neighborhoods
 nb_gdf = gpd.read_file(NEIGHBOURHOODS_GEO_JSON)
@@ -37,123 +105,520 @@ nb_gdf['res_centroid'] = gpd.points_from_xy(nb_gdf.res_cent_x, nb_gdf.res_cent_y
 # Find them and assign to them the geographical centroid.
 nb_gdf.loc[nb_gdf['res_cent_x'].isna(), 'res_centroid'] = nb_gdf[nb_gdf['res_cent_x'].isna()]['centroid']
 
+# Per process cache of the last graph read by _snapped_graph
+_graph_cache = {}
+# Per process cache of the last connection store read by _snapped_connections
+_connections_cache = {}
 
-def nearest_nodes_to_points(G, X, Y, return_dist=False):
-    """OSMNX nearest_nodes function adapted to igraph
-    from https://github.com/gboeing/osmnx/blob/main/osmnx/distance.py: nearest_nodes
-    For a given set of geographical locations (X, Y), return the nearest nodes of the given graph G.
-    Args:
-        G (igraph.Graph): input graph
-        X (pandas.Series): X coordinates of the input points
-        Y (pandas.Series): Y coordinages of the input points
-        return_dist (bool, optional): If True the distance to the nearest node for all points is returned. Defaults to False.
+
+def _unique_vertex_indices(vids):
+    """Collapse an array of vertex ids to its unique values.
+    Returns:
+        tuple: sorted unique vertex ids and the inverse index (shaped like `vids`) mapping each input onto them
+    """
+    unique, inverse = np.unique(np.ravel(vids), return_inverse=True)
+    return unique, inverse.reshape(np.shape(vids))
+
+
+def _read_graph(graph_path: Path) -> ig.Graph:
+    """Read a transit network, binary graph stores are memory mapped and keep their integer id codes."""
+    return read_graph_store(graph_path, decode_ids=False) if is_graph_store(graph_path) else ig.read(graph_path)
+
+
+def _snapped_graph(graph_path: Path) -> dict:
+    """Read a transit graph and snap the neighbourhoods and POIs onto it.
+    The result is cached per process, so a worker loads every graph only once for all of its origin chunks.
+    The neighbourhood and POI frames are module globals inherited by the forked workers, they are never
+    pickled per task.
+    """
+    if _graph_cache.get('path') != graph_path:
+        _graph_cache.clear()
+        G_transit = _read_graph(graph_path)
+        # Consecutive dates mostly share their stop set, and with it the snapping index
+        index = SnappingIndex.for_graph(G_transit, SNAPPING_INDEX_DIR)
+        # For each neighborhood, get its nearest (ACCESS_STOP_CANDIDATES) nodes in the network.
+        nb_nodes, nb_dist = index.nearest(nb_gdf['res_centroid'].x, nb_gdf['res_centroid'].y, k=ACCESS_STOP_CANDIDATES)
+        # For each POI, get its nearest (ACCESS_STOP_CANDIDATES) nodes in the network.
+        poi_nodes, poi_dist = index.nearest(poi_gdf['geometry'].x, poi_gdf['geometry'].y, k=ACCESS_STOP_CANDIDATES)
+
+        logger.info(f"Processing graph {graph_path.with_suffix('').name} and have the following statistics:\n"
+                    f"Average point to node distance: {np.average(nb_dist[:, 0])} "
+                    f"ranging from [{np.min(nb_dist[:, 0])},[{np.max(nb_dist[:, 0])}]]\n"
+                    f"Average POI to node distance: {np.average(poi_dist[:, 0])} "
+                    f"ranging from [{np.min(poi_dist[:, 0])},[{np.max(poi_dist[:, 0])}]]")
+
+        rg = RoutingGraph(G_transit)
+        _graph_cache.update(path=graph_path, rg=rg, reach=ReachabilityIndex(rg.csr, poi_nodes),
+                            nb_nodes=nb_nodes, nb_dist=nb_dist, poi_nodes=poi_nodes, poi_dist=poi_dist,
+                            node_ids=graph_attribute(G_transit, 'node_id'))
+    return _graph_cache
+
+
+def _snapped_connections(graph_path: Path) -> dict:
+    """Read the connection store of a graph and snap the neighbourhoods and POIs onto its stops.
+    Cached per process like _snapped_graph.
+    """
+    if _connections_cache.get('path') != graph_path:
+        _connections_cache.clear()
+        cs = ConnectionScan(connection_store_dir(graph_path), CSA_TRANSFER_RADIUS_M, CSA_MAX_WALK_M)
+        nb_stops, nb_dist = cs.nearest(nb_gdf['res_centroid'].x, nb_gdf['res_centroid'].y, k=ACCESS_STOP_CANDIDATES)
+        poi_stops, poi_dist = cs.nearest(poi_gdf['geometry'].x, poi_gdf['geometry'].y, k=ACCESS_STOP_CANDIDATES)
+        start_sec, end_sec = cs.meta['window']
+        logger.info(f"Processing connections of graph {graph_path.with_suffix('').name}: {cs.meta['n_connections']} "
+                    f"connections of {cs.n_trips} trips between {cs.n_stops} stops")
+        _connections_cache.update(path=graph_path, cs=cs, nb_stops=nb_stops, nb_dist=nb_dist, poi_stops=poi_stops,
+                                  poi_dist=poi_dist, departures=np.arange(start_sec, end_sec + 1, DEPARTURE_STEP))
+    return _connections_cache
+
+
+def _route_unique_nodes(rg: RoutingGraph, nb_vids: np.ndarray, poi_vids: np.ndarray, routable: np.ndarray,
+                        with_path_edges: bool = False) -> Tuple[dict, csr_matrix]:
+    """Node to node metrics between unique origin and POI nodes, only the `routable` origins are routed.
+    Returns:
+        tuple: metric name -> (origin nodes, POI nodes) matrix, and with with_path_edges the edges on the paths of
+        every origin node (see od_routing.tree_path_edges), None otherwise
+    """
+    raw = {metric: np.full((len(nb_vids), len(poi_vids)), np.inf if metric in ('tt', 'td') else np.nan)
+           for metric in OD_METRICS}
+    n_edges = len(rg.edge_keys)
+    path_edges = csr_matrix((len(nb_vids), n_edges), dtype=bool) if with_path_edges else None
+    if routable.any():
+        # One shortest path tree per unique origin yields all metrics for a whole row of unique destinations.
+        routed = od_tree_metrics(rg, nb_vids[routable], poi_vids, with_path_edges=with_path_edges)
+        for metric in OD_METRICS:
+            raw[metric][routable] = routed[metric]
+        if with_path_edges:
+            routed_edges = routed['path_edges'].tocoo()
+            path_edges = csr_matrix((routed_edges.data, (np.flatnonzero(routable)[routed_edges.row], routed_edges.col)),
+                                    shape=(len(nb_vids), n_edges))
+    return raw, path_edges
+
+
+def _od_rows(graph_path: Path, rows: np.ndarray) -> Tuple[dict, dict]:
+    """Compute the OD matrix rows of the neighbourhoods `rows` towards the POIs of all types for one graph.
+    Returns:
+        tuple: metric name -> matrix rows, and with INCREMENTAL_OD the routing state of their origin nodes
+        (see incremental_od.write_od_state), None otherwise
+    """
+    if ROUTING_ENGINE == 'connection_scan':
+        # Schedule based travel times in minutes like those of the graph, averaged over the departure times of the
+        # window that reach a pair (inf where none of them does)
+        snapped = _snapped_connections(graph_path)
+        logger.info(f"Processing graph {graph_path} {len(rows)} origins from {rows[0]} by connection scan over "
+                    f"{len(snapped['departures'])} departure times")
+        tt = connection_scan_od(snapped['cs'], snapped['nb_stops'][rows], snapped['nb_dist'][rows],
+                                snapped['poi_stops'], snapped['poi_dist'], snapped['departures'], CSA_MAX_TRAVEL_TIME)
+        return {'tt': mean_travel_time(tt, axis=1) / 60}, None
+
+    snapped = _snapped_graph(graph_path)
+    nb_nodes = snapped['nb_nodes'][rows]
+    nb_dist = snapped['nb_dist'][rows]
+    poi_nodes = snapped['poi_nodes']
+    poi_dist = snapped['poi_dist']
+
+    if USE_STOP_COST_TABLE:
+        # All node to node metrics are precomputed, the OD matrices are a gather from the table
+        if 'table' not in snapped:
+            snapped['table'] = build_stop_cost_table(snapped['rg'], stop_cost_table_dir(graph_path))
+        logger.info(f"Processing graph {graph_path} {len(rows)} origins from {rows[0]} from its stop cost table")
+        return snapped['table'].od_matrices(nb_nodes, nb_dist, poi_nodes, poi_dist), None
+
+    # Several neighbourhoods and POIs snap to the same node: route between unique nodes only and
+    # scatter the results back to the points afterwards.
+    nb_vids, nb_inv = _unique_vertex_indices(nb_nodes)
+    poi_vids, poi_inv = _unique_vertex_indices(poi_nodes)
+
+    # Pairs without any path are known from the reachability index, origins reaching no POI are not routed
+    routable = snapped['reach'].reachable(nb_vids, poi_vids).any(axis=1)
+    logger.info(f"Processing graph {graph_path} {len(rows)} origins from {rows[0]} ({len(nb_vids)} unique origin "
+                f"nodes, {np.count_nonzero(~routable)} of them reach no POI)")
+    raw, path_edges = _route_unique_nodes(snapped['rg'], nb_vids, poi_vids, routable, with_path_edges=INCREMENTAL_OD)
+
+    state = {'origin_nodes': snapped['node_ids'][nb_vids], 'poi_nodes': snapped['node_ids'][poi_vids],
+             'tt': raw['tt'], 'path_edges': path_edges} if INCREMENTAL_OD else None
+    return gather_od(raw, nb_inv, nb_dist, poi_inv, poi_dist), state
+
+
+def _hourly_od_rows(graph_path: Path, rows: np.ndarray) -> Dict[int, dict]:
+    """Compute the OD matrix rows of the neighbourhoods `rows` towards the POIs of all types for every hour of
+    ROUTING_HOURS. Routing runs on the boarding graph of the transit graph (see hourly_routing.boarding_graph), the
+    expected wait of every hour is the weight of its boarding edges so that the first boarding and every transfer
+    pay it. Hours share a routing pass only when all their edge weights are identical, which a real timetable rarely
+    has, so this takes about one routing pass per hour.
+    Returns:
+        dict: hour -> metric name -> matrix rows
+    """
+    snapped = _snapped_graph(graph_path)
+    if 'hourly_rg' not in snapped:
+        G_boarding = boarding_graph(snapped['rg'].graph)
+        snapped['hourly_rg'] = RoutingGraph(G_boarding)
+        snapped['hour_groups'] = hour_groups(G_boarding, ROUTING_HOURS)
+        logger.info(f"Graph {graph_path.with_suffix('').name} has {len(snapped['hour_groups'])} distinct hourly "
+                    f"networks for {len(ROUTING_HOURS)} hours")
+
+    nb_vids, nb_inv = _unique_vertex_indices(snapped['nb_nodes'][rows])
+    poi_vids, poi_inv = _unique_vertex_indices(snapped['poi_nodes'])
+    routable = snapped['reach'].reachable(nb_vids, poi_vids).any(axis=1)
+    logger.info(f"Processing graph {graph_path} {len(rows)} origins from {rows[0]} for {len(ROUTING_HOURS)} hours")
+
+    od = {}
+    for weights, hours in snapped['hour_groups']:
+        raw, _ = _route_unique_nodes(hour_routing_graph(snapped['hourly_rg'], weights), nb_vids, poi_vids, routable)
+        hour_od = gather_od(raw, nb_inv, snapped['nb_dist'][rows], poi_inv, snapped['poi_dist'])
+        for hour in hours:
+            od[hour] = hour_od
+    return od
+
+
+def _compute_od_chunk(task: Tuple[Path, int, int]) -> Tuple[Path, int, dict]:
+    """Compute the OD matrix rows of the neighbourhoods [start, stop) towards the POIs of all types for one graph.
+    Returns:
+        tuple: graph path, start, metric name -> matrix rows
+    """
+    graph_path, start, stop = task
+    od, _ = _od_rows(graph_path, np.arange(start, stop))
+    # Travel times between all neighborhoods and all POIs of all types, walking to and from the network included.
+    # od['tt'].shape = (nr of neighborhoods (origins), nr of POIs (destinations))
+    return graph_path, start, od
+
+
+def _compute_hourly_od_chunk(task: Tuple[Path, int, int]) -> Tuple[Path, int, Dict[int, dict]]:
+    """Compute the hourly OD matrix rows of the neighbourhoods [start, stop) for one graph.
+    Returns:
+        tuple: graph path, start, hour -> metric name -> matrix rows
+    """
+    graph_path, start, stop = task
+    return graph_path, start, _hourly_od_rows(graph_path, np.arange(start, stop))
+
+
+def _compute_od_row_set(task: Tuple[Path, np.ndarray]) -> Tuple[Path, np.ndarray, dict, dict]:
+    """Compute the OD matrix rows of an arbitrary set of neighbourhoods, with the routing state of their origins.
+    Returns:
+        tuple: graph path, rows, metric name -> matrix rows, routing state
+    """
+    graph_path, rows = task
+    od, state = _od_rows(graph_path, rows)
+    return graph_path, rows, od, state
+
+
+def _compute_measures_chunk(task: Tuple[Path, int, int]) -> Tuple[Path, int, Dict[str, dict]]:
+    """Compute the bounded accessibility measures of the neighbourhoods [start, stop) for every POI type.
+    Every search stops at the largest cumulative threshold, nearest-k searches are extended only where needed.
+    Returns:
+        tuple: graph path, start, POI type -> measure name -> rows
+    """
+    graph_path, start, stop = task
+    snapped = _snapped_graph(graph_path)
+    nb_nodes = snapped['nb_nodes'][start:stop]
+    # Walking to and from the network in minutes, like the network travel times and the thresholds
+    nb_walk = walking_minutes(snapped['nb_dist'][start:stop])
+    poi_walk = walking_minutes(snapped['poi_dist'])
+
+    logger.info(f"Processing accessibility measures of graph {graph_path} origins {start} to {stop}")
+    tt = point_travel_times(snapped['rg'], nb_nodes, nb_walk, snapped['poi_nodes'], poi_walk,
+                            limit=CUMULATIVE_THRESHOLDS[-1])
+    # Walking may push some pairs past the search limit, cut them off so that all origins share one cutoff
+    tt[tt > CUMULATIVE_THRESHOLDS[-1]] = np.inf
+
+    measures = {}
+    for poi_type, columns in poi_type_columns.items():
+        measures[poi_type] = {
+            'cumulative': cumulative_opportunities(tt[:, columns], CUMULATIVE_THRESHOLDS),
+            'gravity': gravity_accessibility(tt[:, columns], GRAVITY_BETA),
+            'nearest_k': nearest_k_travel_times(snapped['rg'], nb_nodes, nb_walk, snapped['poi_nodes'][columns],
+                                                poi_walk[columns], NEAREST_K, CUMULATIVE_THRESHOLDS[0]),
+        }
+    return graph_path, start, measures
+
+
+def _origin_chunks(graph_path: Path) -> List[Tuple[Path, int, int]]:
+    n_origins = len(nb_gdf)
+    return [(graph_path, start, min(start + ORIGIN_CHUNK_SIZE, n_origins))
+            for start in range(0, n_origins, ORIGIN_CHUNK_SIZE)]
+
+
+def _od_result_path(graph_path: Path, poi_type: str, hour: int = None) -> Path:
+    name = f"{Path(graph_path).with_suffix('').name}_computation{'' if hour is None else f'_h{hour:02d}'}"
+    return _poi_type_results_path(poi_type).joinpath(name)
+
+
+def _store_od_matrices(graph_path: Path, chunks: list) -> Dict[str, Path]:
+    """Merge the per-chunk results of a graph, ordered by their first origin, and store them per POI type."""
+    chunks = sorted(chunks, key=lambda chunk: chunk[1])
+    return _write_od_matrices(graph_path, {metric: np.vstack([chunk[2][metric] for chunk in chunks])
+                                           for metric in chunks[0][2]})
+
+
+def _store_hourly_od_matrices(graph_path: Path, chunks: list) -> Dict[str, Dict[int, Path]]:
+    """Merge the per-chunk hourly results of a graph and store them per POI type and hour."""
+    chunks = sorted(chunks, key=lambda chunk: chunk[1])
+    od_mat_paths = {poi_type: {} for poi_type in poi_types}
+    for hour in ROUTING_HOURS:
+        matrices = {metric: np.vstack([chunk[2][hour][metric] for chunk in chunks]) for metric in OD_METRICS}
+        for poi_type, path in _write_od_matrices(graph_path, matrices, hour).items():
+            od_mat_paths[poi_type][hour] = path
+    return od_mat_paths
+
+
+def _write_od_matrices(graph_path: Path, matrices: Dict[str, np.ndarray], hour: int = None) -> Dict[str, Path]:
+    """Store the full OD matrices of a graph per POI type, those of a single hour with `hour`."""
+    od_mat_paths = {}
+    for poi_type, columns in poi_type_columns.items():
+        type_matrices = {metric: values[:, columns] for metric, values in matrices.items()}
+
+        # Unreachable pairs are stored as a boolean mask next to the matrices, only their number goes to the meta
+        n_unreachable = int(np.count_nonzero(np.isinf(type_matrices['tt'])))
+
+        od_mat_path = _od_result_path(graph_path, poi_type, hour)
+        logger.info(f"Finished processing graph {graph_path.with_suffix('').name} for {poi_type} "
+                    f"storing it in path: {od_mat_path}")
+        od_mat_paths[poi_type] = write_od_result(od_mat_path, type_matrices,
+                                                 meta={'graph': str(graph_path), 'poi_type': poi_type,
+                                                       'hour': hour, 'n_unreachable': n_unreachable,
+                                                       'routing_engine': ROUTING_ENGINE, 'time_unit': 'minutes'})
+
+    return od_mat_paths
+
+
+def _read_od_matrices(graph_path: Path) -> Dict[str, np.ndarray]:
+    """Reassemble the full OD matrices of a graph from its results per POI type."""
+    matrices = {metric: np.full((len(nb_gdf), len(poi_gdf)), np.nan) for metric in OD_METRICS}
+    for poi_type, columns in poi_type_columns.items():
+        for metric in OD_METRICS:
+            matrices[metric][:, columns] = from_compact_od_metric(
+                metric, read_od_metric(_od_result_path(graph_path, poi_type), metric))
+    return matrices
+
+
+def _store_measures(graph_path: Path, chunks: list) -> Dict[str, Path]:
+    """Merge the per-chunk accessibility measures of a graph, ordered by their first origin, per POI type."""
+    chunks = sorted(chunks, key=lambda chunk: chunk[1])
+    measure_paths = {}
+    for poi_type in poi_types:
+        measures = {name: np.concatenate([chunk[2][poi_type][name] for chunk in chunks])
+                    for name in chunks[0][2][poi_type]}
+        measures_path = _poi_type_results_path(poi_type).joinpath(f"{Path(graph_path).with_suffix('').name}_measures")
+        logger.info(f"Finished accessibility measures of graph {graph_path.with_suffix('').name} for {poi_type} "
+                    f"storing them in path: {measures_path}")
+        measure_paths[poi_type] = write_accessibility_measures(
+            measures_path, measures, meta={'graph': str(graph_path), 'poi_type': poi_type,
+                                           'thresholds': CUMULATIVE_THRESHOLDS, 'k': NEAREST_K,
+                                           'beta': GRAVITY_BETA, 'time_unit': 'minutes'})
+    return measure_paths
+
+
+def _poi_type_results_path(poi_type: str) -> Path:
+    return RESULTS_PATH.joinpath(poi_type.replace(os.sep, '_'))
+
+
+def _ensure_stop_cost_table(graph_path: Path) -> Path:
+    return build_stop_cost_table(_snapped_graph(graph_path)['rg'], stop_cost_table_dir(graph_path)).table_dir
+
+
+def run_analysis(graph_path: Path) -> Dict[str, Path]:
+    chunks = [_compute_od_chunk(task) for task in _origin_chunks(graph_path)]
+    return _store_od_matrices(graph_path, chunks)
+
+
+def run_measures_analysis(graph_path: Path) -> Dict[str, Path]:
+    chunks = [_compute_measures_chunk(task) for task in _origin_chunks(graph_path)]
+    return _store_measures(graph_path, chunks)
+
+
+def _od_state_dir(graph_path: Path) -> Path:
+    return INCREMENTAL_STATE_DIR.joinpath(f"{Path(graph_path).with_suffix('').name}_state")
+
+
+def _incremental_plan(prev_graph: Path, graph_path: Path) -> Tuple[np.ndarray, dict]:
+    """Find the neighbourhoods whose OD rows may differ from the previous graph's result.
     Returns:
-        list: list of nodes of graph G
+        tuple: rows to compute, and unless all rows have to be computed, the previous state, the mask of its origin
+        nodes that are kept, the edge mapping between the graphs and the previous OD matrices
     """
-    if np.isnan(X).any() or np.isnan(Y).any():  # pragma: no cover
-        raise ValueError("`X` and `Y` cannot contain nulls")
+    all_rows = np.arange(len(nb_gdf))
+    if prev_graph is None or not _od_state_dir(prev_graph).exists():
+        return all_rows, None
+
+    snapped = _snapped_graph(graph_path)
+    node_ids = snapped['node_ids']
+    nb_ids, poi_ids = node_ids[snapped['nb_nodes']], node_ids[snapped['poi_nodes']]
+    state = read_od_state(_od_state_dir(prev_graph))
+    # A POI snapping onto another node changes its whole column
+    if state['poi_point_nodes'].shape != poi_ids.shape or state['nb_nodes'].shape != nb_ids.shape or \
+            not (np.array_equal(state['poi_point_nodes'], poi_ids) and np.allclose(state['poi_dist'],
+                                                                                  snapped['poi_dist'])):
+        logger.info(f"POIs snap differently onto {graph_path.with_suffix('').name}, computing all origins")
+        return all_rows, None
+
+    worse, better, prev_to_new = edge_changes(RoutingGraph(_read_graph(prev_graph)), snapped['rg'])
+    affected = affected_origins(state, snapped['rg'], worse, better)
+    # Neighbourhoods that snap differently or have an affected candidate node
+    rows = np.flatnonzero((state['nb_nodes'] != nb_ids).any(axis=1) |
+                          ~np.isclose(state['nb_dist'], snapped['nb_dist']).all(axis=1) |
+                          np.isin(nb_ids, state['origin_nodes'][affected]).any(axis=1))
+    logger.info(f"{graph_path.with_suffix('').name} differs from {prev_graph.with_suffix('').name} in "
+                f"{np.count_nonzero(worse)} removed or worse and {len(better)} added or better edges, "
+                f"computing {len(rows)} of {len(all_rows)} origins")
+    return rows, {'state': state, 'keep': ~affected, 'prev_to_new': prev_to_new,
+                  'matrices': _read_od_matrices(prev_graph)}
+
+
+def _store_incremental(graph_path: Path, chunks: list, prev: dict) -> Dict[str, Path]:
+    """Store the OD matrices of a graph, previous rows overwritten by the computed ones, and its routing state."""
+    snapped = _snapped_graph(graph_path)
+    n_edges = len(snapped['rg'].edge_keys)
+    if prev is None:
+        chunks = sorted(chunks, key=lambda chunk: chunk[1][0])
+        matrices = {metric: np.vstack([chunk[2][metric] for chunk in chunks]) for metric in OD_METRICS}
+        poi_nodes = chunks[0][3]['poi_nodes']
+        prev = {'state': {'origin_nodes': np.zeros(0, dtype=str), 'poi_nodes': poi_nodes,
+                          'tt': np.zeros((0, len(poi_nodes))), 'path_edges': csr_matrix((0, 0), dtype=bool)},
+                'keep': np.zeros(0, dtype=bool), 'prev_to_new': np.zeros(0, dtype=np.int64)}
+    else:
+        matrices = prev['matrices']
+        for _, rows, od, _ in chunks:
+            for metric in OD_METRICS:
+                matrices[metric][rows] = od[metric]
+    od_mat_paths = _write_od_matrices(graph_path, matrices)
+
+    node_ids = snapped['node_ids']
+    state = merge_od_states(prev['state'], prev['keep'], prev['prev_to_new'], [chunk[3] for chunk in chunks],
+                            np.unique(node_ids[snapped['nb_nodes']]), n_edges)
+    state.update(nb_nodes=node_ids[snapped['nb_nodes']], nb_dist=snapped['nb_dist'],
+                 poi_point_nodes=node_ids[snapped['poi_nodes']], poi_dist=snapped['poi_dist'])
+    write_od_state(_od_state_dir(graph_path), state, meta={'graph': str(graph_path)})
+    return od_mat_paths
+
+
+def _split_graph_name(path: Path) -> Tuple[str, str]:
+    """Split the name of a graph into its date, the first number in it, and its (day, time window) spec, the rest of
+    the name, shared by the graphs of all dates generated for that spec."""
+    name = Path(path).with_suffix('').name
+    date = re.search(r'\d+', name)
+    return date.group(), f"{name[:date.start()].rstrip('_')}_{name[date.end():].lstrip('_')}".strip('_')
+
 
-    nodes = np.array([[node['y'], node['x']] for node in G.vs])
+def _graphs_by_spec(graphs: List[Path]) -> Dict[str, List[Path]]:
+    """The graphs of every (day, time window) spec in date order, see _split_graph_name."""
+    by_spec = {}
+    for graph_path in sorted(graphs, key=lambda path: _split_graph_name(path)[0]):
+        by_spec.setdefault(_split_graph_name(graph_path)[1], []).append(graph_path)
+    return dict(sorted(by_spec.items()))
 
-    nodes_rad = np.deg2rad(nodes)
-    points_rad = np.deg2rad(np.array([Y, X]).T)
 
-    dist, pos = BallTree(nodes_rad, metric='haversine').query(points_rad, k=1)
-    dist = dist[:, 0] * EARTH_RADIUS_M  # convert radians -> meters
+def run_incremental_analyses(graphs: List[Path]) -> List[Dict[str, Path]]:
+    """Compute the OD matrices of all graphs in date order, each one starting from the result of the previous one.
+    Graphs of different (day, time window) specs form separate chains.
+    Only the origins whose shortest paths use edges that were removed or became worse, or that may improve through
+    added or cheaper edges, are routed again (on a pool of NUM_WORKERS processes), all other rows are copied.
+    """
+    generated_paths = []
+    with get_context('fork').Pool(NUM_WORKERS) as pool:
+        for spec_graphs in _graphs_by_spec(graphs).values():
+            prev_graph = None
+            for graph_path in spec_graphs:
+                rows, prev = _incremental_plan(prev_graph, graph_path)
+                tasks = [(graph_path, rows[start:start + ORIGIN_CHUNK_SIZE])
+                         for start in range(0, len(rows), ORIGIN_CHUNK_SIZE)]
+                chunks = list(pool.imap_unordered(_compute_od_row_set, tasks))
+                generated_paths.append(_store_incremental(graph_path, chunks, prev))
+                prev_graph = graph_path
 
-    nn = G.vs[pos[:, 0].tolist()]
-    nn = list(nn)
-    dist = dist.tolist()
+    return generated_paths
 
-    if return_dist:
-        return nn, dist
+
+def run_all_analyses(graphs: List[Path]) -> List[Dict[str, Path]]:
+    """Compute the OD matrices of all graphs on a pool of NUM_WORKERS processes.
+    Work is partitioned by graph and by chunks of ORIGIN_CHUNK_SIZE origins, chunks are merged back into the
+    full matrices of a graph as soon as all of them arrived.
+    With ACCESSIBILITY_MEASURES the bounded accessibility measures are computed instead of the OD matrices,
+    with INCREMENTAL_OD the OD matrices are computed incrementally, see run_incremental_analyses, and with
+    ROUTING_HOURS the OD matrices of every hour are computed, see _hourly_od_rows.
+    """
+    if INCREMENTAL_OD and not ACCESSIBILITY_MEASURES:
+        return run_incremental_analyses(graphs)
+    if ACCESSIBILITY_MEASURES:
+        compute_chunk, store = _compute_measures_chunk, _store_measures
+    elif ROUTING_HOURS:
+        compute_chunk, store = _compute_hourly_od_chunk, _store_hourly_od_matrices
     else:
-        return nn
-
-
-def run_analysis(graph_path: Path):
-    # Read the transit network
-    G_transit = ig.read(graph_path)
-    # For each neighborhood, get its nearest node in the network.
-    nb_nodes, nb_dist = nearest_nodes_to_points(G_transit, nb_gdf['res_centroid'].x, nb_gdf['res_centroid'].y,
-                                                return_dist=True)
-    # For each POI, get its nearest node in the network.
-    poi_nodes, poi_dist = nearest_nodes_to_points(G_transit, poi_gdf['geometry'].x, poi_gdf['geometry'].y,
-                                                  return_dist=True)
-
-    logger.info(f"Processing graph {graph_path.with_suffix('').name} and have the following statistics:\n"
-                f"Average point to node distance: {np.average(nb_dist)} "
-                f"ranging from [{np.min(nb_dist)},[{np.max(nb_dist)}]]\n"
-                f"Average POI to node distance: {np.average(poi_dist)} "
-                f"ranging from [{np.min(poi_dist)},[{np.max(poi_dist)}]]")
-
-    # Calculate travel times between all neighborhoods and all POIs.
-    # tt_mx.shape = (nr of neighborhoods (origins), nr of POIs (destinations))
-    tt_mx = np.ndarray((len(nb_nodes), len(poi_nodes)))
-    td_mx = np.ndarray((len(nb_nodes), len(poi_nodes)))
-    modes_mx = np.ndarray((len(nb_nodes), len(poi_nodes)))
-    lines_mx = np.ndarray((len(nb_nodes), len(poi_nodes)))
-    hops_mx = np.ndarray((len(nb_nodes), len(poi_nodes)))
-
-    failed = {}
-
-    for i, o in enumerate(nb_nodes):
-        if i % 100 == 0:
-            logger.info(f"Processing graph {graph_path} origin node {i}")
-        for j, d in enumerate(poi_nodes):
-            # Travel Time
-            tt = G_transit.shortest_paths(o, d, weights='travel_time')[0][0]
-            if tt == math.inf:
-                if not failed.get(f"{o['node_id']}_tt", None) == d['node_id']:
-                    # logger.warning(f'Failed to get TRAVEL TIME for {o["node_id"]} - {d["node_id"]}: '
-                    #                f'No path found between them')
-                    failed[f"{o['node_id']}_tt"] = d["node_id"]
-            else:
-                tt_mx[i, j] = tt + poi_dist[j] + nb_dist[i]
-            # Travel Distance
-            td = G_transit.shortest_paths(o, d, weights='length')[0][0]
-            if td == math.inf:
-                if not failed.get(f"{o['node_id']}_td", None) == d["node_id"]:
-                    # logger.warning(f'Failed to get TRAVEL DISTANCE for {o["node_id"]} - {d["node_id"]}: '
-                    #                f'No path found between them')
-                    failed[f"{o['node_id']}_td"] = d["node_id"]
-            else:
-                td_mx[i, j] = td + poi_dist[j] + nb_dist[i]
-            # Number of hops and number of modes
-            edges = G_transit.get_shortest_paths(o, d, weights='length', output='epath')[0]
-            if edges == math.inf or not edges:
-                if not failed.get(f"{o['node_id']}_edges", None) == d["node_id"]:
-                    # logger.warning(f'Failed to get EDGES for {o["node_id"]} - {d["node_id"]}: '
-                    #                f'No path found between them')
-                    failed[f"{o['node_id']}_edges"] = d["node_id"]
-            else:
-                n_modes = len(np.unique(G_transit.es[edges]['route_type']))
-                n_lines = len(np.unique(G_transit.es[edges]['unique_route_id']))
-                # Add walking if there is some
-                modes_mx[i, j] = n_modes + int(poi_dist[j] > 0 or nb_dist[i] > 0)
-                lines_mx[i, j] = n_lines
-                # Add walking if there is some
-                hops_mx[i, j] = len(edges) + int(poi_dist[j] > 0) + int(nb_dist[i] > 0)
-
-    od_mat_path = RESULTS_PATH.joinpath(f"{Path(graph_path).with_suffix('').name}_computation.pkl")
-    logger.info(f"Finished processing graph {graph_path.with_suffix('').name} storing it in path: {od_mat_path}")
-
-    with open(od_mat_path, "wb") as fp:
-        pickle.dump([tt_mx, td_mx, modes_mx, lines_mx, hops_mx, failed], fp)
-
-    return od_mat_path
+        compute_chunk, store = _compute_od_chunk, _store_od_matrices
+    tasks = [task for graph_path in graphs for task in _origin_chunks(graph_path)]
+    pending = {graph_path: [] for graph_path in graphs}
+    n_chunks = {graph_path: len(_origin_chunks(graph_path)) for graph_path in graphs}
+
+    generated_paths = []
+    # Forked workers share the module level neighbourhood and POI frames with the parent process
+    with get_context('fork').Pool(NUM_WORKERS) as pool:
+        if USE_STOP_COST_TABLE and not ACCESSIBILITY_MEASURES:
+            # Build the missing tables one graph per worker, before any chunk gathers from them
+            for table_dir in pool.imap_unordered(_ensure_stop_cost_table, graphs):
+                logger.info(f"Stop cost table available in {table_dir}")
+        for chunk in pool.imap_unordered(compute_chunk, tasks):
+            graph_path = chunk[0]
+            pending[graph_path].append(chunk)
+            if len(pending[graph_path]) == n_chunks[graph_path]:
+                generated_paths.append(store(graph_path, pending.pop(graph_path)))
+
+    return generated_paths
+
+
+def _stack_dated_results(results: Dict[Path, Path], aliases: Dict[str, str], results_dir: Path,
+                         stack_name: str) -> List[Path]:
+    """Stack the results of all dates along a time axis, one stack per (day, time window) spec.
+    Aliases share the result of their canonical date. A single spec is stacked into `stack_name`, several specs
+    into `<stack_name>_<spec>`.
+    Args:
+        results (dict): graph path -> result path
+        aliases (dict): alias date -> canonical date
+        results_dir (Path): directory to write the stacks to
+        stack_name (str): name of the stacks
+    Returns:
+        list: paths of the stacks
+    """
+    by_spec = _graphs_by_spec(list(results))
+    stack_paths = []
+    for spec, spec_graphs in by_spec.items():
+        dated_paths = [(_split_graph_name(graph_path)[0], results[graph_path]) for graph_path in spec_graphs]
+        dated_paths += [(alias, path) for alias, canonical in aliases.items() for date, path in dated_paths
+                        if date == canonical]
+        dated_paths.sort(key=lambda dated_path: dated_path[0])
+        stack_dir = results_dir.joinpath(stack_name if len(by_spec) == 1 else f"{stack_name}_{spec}")
+        stack_paths.append(stack_od_results([path for _, path in dated_paths], [date for date, _ in dated_paths],
+                                            stack_dir))
+    return stack_paths
 
 
 if __name__ == "__main__":
     graph_folders = [d for d in os.listdir(GRAPH_DATA_DIR) if os.path.isdir(GRAPH_DATA_DIR.joinpath(d))]
-    graphs = [GRAPH_DATA_DIR.joinpath(folder).joinpath(file) for folder in graph_folders for file in
-              os.listdir(GRAPH_DATA_DIR.joinpath(folder)) if Path(file).suffix == '.gml']
+    graphs = {}
+    for folder in graph_folders:
+        for file in sorted(os.listdir(GRAPH_DATA_DIR.joinpath(folder))):
+            path = GRAPH_DATA_DIR.joinpath(folder).joinpath(file)
+            # Prefer the binary graph store over a GML export of the same graph
+            if path.suffix == GRAPH_STORE_SUFFIX or (path.suffix == '.gml' and path.with_suffix('') not in graphs):
+                graphs[path.with_suffix('')] = path
+    graphs = list(graphs.values())
 
-    results = ThreadPool(NUM_WORKERS).imap(run_analysis, graphs)
+    generated_paths = run_all_analyses(graphs)
+    # Results are named after their graph
+    graph_by_name = {Path(graph_path).with_suffix('').name: graph_path for graph_path in graphs}
 
-    generated_paths = []
+    logger.info(f"Generated {len(generated_paths)} results for {poi_types} in {generated_paths}")
 
-    for r in results:
-        generated_paths.append(r)
+    # Graphs are only generated for the first of several days with the same service, the others are its aliases
+    aliases = read_aliases(GRAPH_DATA_DIR)
+    for poi_type in poi_types:
+        record_aliases(_poi_type_results_path(poi_type), aliases)
 
-    logger.info(f"Generated {len(generated_paths)} OD matrix tuples in {generated_paths}")
+    # Stack all dates along a time axis, so that downstream analyses can slice without loading whole results
+    for poi_type in (poi_types if not ACCESSIBILITY_MEASURES else []):
+        # One stack per hour with ROUTING_HOURS
+        for hour in ROUTING_HOURS or [None]:
+            results = {}
+            for paths in generated_paths:
+                path = paths[poi_type] if hour is None else paths[poi_type][hour]
+                results[graph_by_name[re.sub(r'_computation(_h\d+)?$', '', path.name)]] = path
+            for stack_path in _stack_dated_results(results, aliases, _poi_type_results_path(poi_type),
+                                                   "od_stack" if hour is None else f"od_stack_h{hour:02d}"):
+                logger.info(f"Stacked OD results for {poi_type} in {stack_path}")
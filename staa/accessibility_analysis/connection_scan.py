@@ -0,0 +1,224 @@
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from .snapping import SnappingIndex
+from ..graph_analysis.utils.connection_store import read_connection_store
+from ..graph_analysis.utils.speeds import MetricTravelSpeeds
+
+# Walking speed used for access, egress and transfers, in meters per second
+WALKING_SPEED = MetricTravelSpeeds.WALKING.value / 3.6
+# Stops within this distance of each other are connected by a walking transfer
+DEFAULT_TRANSFER_RADIUS_M = 250
+# Chains of transfers up to this length become a single footpath
+DEFAULT_MAX_WALK_M = 1000
+# Maximum number of (origin, departure time) searches scanned at once
+DEFAULT_BATCH_SIZE = 1024
+# Number of stops whose footpaths are closed at once
+CLOSURE_BATCH_SIZE = 512
+
+
+def _independent_runs(dep_time: np.ndarray, arr_time: np.ndarray) -> np.ndarray:
+    """Split connections sorted by departure time into runs that can be scanned at once.
+    Every connection of a run departs before any connection of the run arrives, so no connection of a run can be
+    reached through another one (also not by staying on its trip, or by walking).
+    Returns:
+        numpy.ndarray: start position of every run followed by the number of connections
+    """
+    starts = [0]
+    min_arrival = np.inf
+    for c, (dep, arr) in enumerate(zip(dep_time.tolist(), arr_time.tolist())):
+        if dep >= min_arrival:
+            starts.append(c)
+            min_arrival = arr
+        else:
+            min_arrival = min(min_arrival, arr)
+    return np.array(starts + [len(dep_time)], dtype=np.int64)
+
+
+def _minimum_at(tau: np.ndarray, stops: np.ndarray, rows: np.ndarray, times: np.ndarray):
+    """Unbuffered tau[stops, rows] = min(tau[stops, rows], times), on the flat view for numpy's fast 1-D path."""
+    np.minimum.at(tau.reshape(-1), stops.astype(np.int64) * tau.shape[1] + rows, times)
+
+
+def closed_footpaths(index: SnappingIndex, located: np.ndarray, lat_lng: np.ndarray, transfer_radius_m: float,
+                     max_walk_m: float = DEFAULT_MAX_WALK_M):
+    """Walking transfers between stops, transitively closed up to `max_walk_m`.
+    Stops within `transfer_radius_m` of each other are linked, every shortest chain of links up to `max_walk_m`
+    becomes a direct footpath, so that a single transfer after every arrival covers all walks.
+    Args:
+        index (SnappingIndex): index over the located stops
+        located (numpy.ndarray): stop of every point of the index, stops without coordinates have no footpaths
+        lat_lng (numpy.ndarray): (stops, 2) coordinates of all stops
+        transfer_radius_m (float): maximum length of a link
+        max_walk_m (float, optional): maximum length of a footpath, None for the full closure.
+            Defaults to DEFAULT_MAX_WALK_M.
+    Returns:
+        tuple: CSR indptr, target stops and lengths in meters of the footpaths, the stops themselves excluded
+    """
+    n_stops = len(lat_lng)
+    neighbours, distances = index.within_radius(lat_lng[located, 1], lat_lng[located, 0], transfer_radius_m)
+    src = located[np.repeat(np.arange(len(located)), [len(n) for n in neighbours])]
+    dst = located[np.concatenate(neighbours).astype(np.int64)] if len(located) else np.zeros(0, dtype=np.int64)
+    # Stops at the same location are linked by a very short walk, explicit zeros would not count as links
+    length = np.maximum(np.concatenate(distances) if len(located) else np.zeros(0), 1e-6)
+    links = csr_matrix((length[src != dst], (src[src != dst], dst[src != dst])), shape=(n_stops, n_stops))
+
+    targets, lengths, counts = [], [], []
+    for start in range(0, n_stops, CLOSURE_BATCH_SIZE):
+        sources = np.arange(start, min(start + CLOSURE_BATCH_SIZE, n_stops))
+        dist = dijkstra(links, directed=False, indices=sources, limit=np.inf if max_walk_m is None else max_walk_m)
+        dist[np.arange(len(sources)), sources] = np.inf
+        r, c = np.nonzero(np.isfinite(dist))
+        targets.append(c)
+        lengths.append(dist[r, c])
+        counts.append(np.bincount(r, minlength=len(sources)))
+    indptr = np.r_[0, np.cumsum(np.concatenate(counts))] if counts else np.zeros(1, dtype=np.int64)
+    return (indptr.astype(np.int64), np.concatenate(targets).astype(np.int64) if targets else np.zeros(0, np.int64),
+            np.concatenate(lengths) if lengths else np.zeros(0))
+
+
+class ConnectionScan:
+    """Schedule based earliest arrival routing (Connection Scan Algorithm) over a connection store.
+    Connections are scanned once in departure order for a whole batch of (origin, departure time) searches. Runs of
+    connections that can not reach each other (see _independent_runs) are applied at once, vectorised over the
+    connections of the run and the searches.
+    Args:
+        store_dir (Path): directory written by connection_store.write_connection_store
+        transfer_radius_m (float, optional): maximum walking link between stops. Defaults to
+            DEFAULT_TRANSFER_RADIUS_M.
+        max_walk_m (float, optional): maximum walking transfer, see closed_footpaths. Defaults to DEFAULT_MAX_WALK_M.
+    """
+
+    def __init__(self, store_dir: Path, transfer_radius_m: float = DEFAULT_TRANSFER_RADIUS_M,
+                 max_walk_m: float = DEFAULT_MAX_WALK_M):
+        self.meta, arrays = read_connection_store(store_dir, mmap=False)
+        self.stop_ids = arrays['stop_ids']
+        # Stops of the dictionary missing from the stops table have no coordinates, they are left out of the index
+        self.located = np.flatnonzero(~np.isnan(arrays['stop_lat_lng']).any(axis=1))
+        self.index = SnappingIndex(arrays['stop_lat_lng'][self.located])
+        self.dep_stop, self.arr_stop = arrays['dep_stop'], arrays['arr_stop']
+        self.dep_time, self.arr_time = arrays['dep_time'], arrays['arr_time']
+        self.trip = arrays['trip']
+        self.n_trips = self.meta['n_trips']
+        self.run_starts = _independent_runs(self.dep_time, self.arr_time)
+
+        self.transfer_indptr, self.transfer_stops, walk_m = closed_footpaths(
+            self.index, self.located, arrays['stop_lat_lng'], transfer_radius_m, max_walk_m)
+        self.transfer_time = walk_m / WALKING_SPEED
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.stop_ids)
+
+    def nearest(self, X, Y, k: int = 1):
+        """The k nearest stops of points, see SnappingIndex.nearest.
+        Returns:
+            tuple: (points, k) arrays of stop codes and distances in meters, sorted by distance
+        """
+        pos, dist = self.index.nearest(X, Y, k=k)
+        return self.located[pos], dist
+
+    def _walk_from(self, tau: np.ndarray, stops: np.ndarray, rows: np.ndarray, times: np.ndarray):
+        """Relax the walking transfers from `stops`, reached at `times` by the searches `rows`."""
+        counts = self.transfer_indptr[stops + 1] - self.transfer_indptr[stops]
+        if not counts.sum():
+            return
+        offsets = np.repeat(self.transfer_indptr[stops] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        _minimum_at(tau, self.transfer_stops[offsets], np.repeat(rows, counts),
+                    np.repeat(times, counts) + self.transfer_time[offsets])
+
+    def earliest_arrival(self, o_idx: np.ndarray, o_access: np.ndarray, departures: np.ndarray,
+                         max_travel_time: float = None) -> np.ndarray:
+        """Earliest arrival time at every stop for every search.
+        Args:
+            o_idx (numpy.ndarray): (searches, k) candidate stops of every search
+            o_access (numpy.ndarray): (searches, k) walking time in seconds to those stops
+            departures (numpy.ndarray): departure time of every search, in seconds after midnight
+            max_travel_time (float, optional): connections departing this long after the last departure are not
+                scanned. Defaults to None, scanning until the end of the day.
+        Returns:
+            numpy.ndarray: (stops, searches) arrival times in seconds after midnight, inf where not reached
+        """
+        n_searches = len(departures)
+        rows = np.arange(n_searches)
+        tau = np.full((self.n_stops, n_searches), np.inf)
+        for j in range(o_idx.shape[1]):
+            start = departures + o_access[:, j]
+            _minimum_at(tau, o_idx[:, j], rows, start)
+            self._walk_from(tau, o_idx[:, j], rows, start)
+
+        # Boarded trips of every search, stored transposed like tau so that a connection reads a contiguous row
+        boarded = np.zeros((self.n_trips, n_searches), dtype=bool)
+        first = np.searchsorted(self.dep_time, departures.min())
+        last = len(self.dep_time) if max_travel_time is None else \
+            np.searchsorted(self.dep_time, departures.max() + max_travel_time, side='right')
+        # Sub-runs of independent runs are independent as well
+        bounds = np.unique(np.clip(self.run_starts, first, last))
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            trip, dep_stop, arr_stop = self.trip[start:stop], self.dep_stop[start:stop], self.arr_stop[start:stop]
+            dep_time, arr_time = self.dep_time[start:stop, None], self.arr_time[start:stop, None]
+            # (connections, searches), the trips of a run are distinct
+            on_trip = boarded[trip] | (tau[dep_stop] <= dep_time)
+            if not on_trip.any():
+                continue
+            boarded[trip] = on_trip
+            c, r = np.nonzero(on_trip & (arr_time < tau[arr_stop]))
+            if len(c):
+                stops, times = arr_stop[c], arr_time[c, 0].astype(float)
+                _minimum_at(tau, stops, r, times)
+                self._walk_from(tau, stops, r, times)
+        return tau
+
+
+def connection_scan_od(cs: ConnectionScan, o_idx: np.ndarray, o_access: np.ndarray, d_idx: np.ndarray,
+                       d_egress: np.ndarray, departures: np.ndarray, max_travel_time: float = None,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+    """Travel times between points for a set of departure times (a profile over a departure window).
+    Args:
+        cs (ConnectionScan): routing engine
+        o_idx (numpy.ndarray): (origins, k) candidate stops of every origin, e.g. from cs.nearest
+        o_access (numpy.ndarray): (origins, k) walking distances in meters to those stops
+        d_idx (numpy.ndarray): (destinations, l) candidate stops of every destination
+        d_egress (numpy.ndarray): (destinations, l) walking distances in meters from those stops
+        departures (numpy.ndarray): departure times at the origins, in seconds after midnight
+        max_travel_time (float, optional): see ConnectionScan.earliest_arrival. Defaults to None.
+        batch_size (int, optional): number of (origin, departure time) searches scanned at once.
+            Defaults to DEFAULT_BATCH_SIZE.
+    Returns:
+        numpy.ndarray: (origins, departures, destinations) door to door travel times in seconds, inf where not
+        reachable
+    """
+    departures = np.asarray(departures, dtype=float)
+    n_departures = len(departures)
+    # Searches are (origin, departure time) pairs, origin major
+    search_origin = np.repeat(np.arange(len(o_idx)), n_departures)
+    search_departure = np.tile(departures, len(o_idx))
+    egress = d_egress / WALKING_SPEED
+
+    tt = np.full((len(o_idx) * n_departures, len(d_idx)), np.inf)
+    for start in range(0, len(search_origin), batch_size):
+        batch = slice(start, start + batch_size)
+        origins = search_origin[batch]
+        tau = cs.earliest_arrival(o_idx[origins], o_access[origins] / WALKING_SPEED, search_departure[batch],
+                                  max_travel_time)
+        # (destinations, l, searches) arrival at the destination through every candidate stop
+        arrival = tau[d_idx] + egress[..., None]
+        tt[batch] = (arrival.min(axis=1) - search_departure[batch]).T
+    return tt.reshape(len(o_idx), n_departures, len(d_idx))
+
+
+def mean_travel_time(tt: np.ndarray, axis: int = 1) -> np.ndarray:
+    """Mean travel time over the departures that reach a destination, inf where none of them does.
+    Args:
+        tt (numpy.ndarray): travel times as returned by connection_scan_od
+        axis (int, optional): departure axis. Defaults to 1.
+    """
+    reached = np.isfinite(tt)
+    n_reached = reached.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(reached, tt, 0.).sum(axis=axis) / n_reached
+    return np.where(n_reached > 0, mean, np.inf)
@@ -0,0 +1,141 @@
+import json
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from .od_result_store import META_FILE
+from .od_routing import DEFAULT_BATCH_SIZE, RoutingGraph
+
+
+def _bounded_trees(rg: RoutingGraph, origins: np.ndarray, limit: float) -> np.ndarray:
+    """Shortest path travel times from `origins` to all vertices, the search stops at `limit` (inf beyond it)."""
+    return dijkstra(rg.csr, directed=True, indices=origins, limit=limit)
+
+
+def _search_exhausted(rg: RoutingGraph, dist: np.ndarray) -> np.ndarray:
+    """Whether a bounded search settled everything reachable, i.e. no edge leaves its settled set."""
+    reached = np.isfinite(dist)
+    pattern = rg.csr.copy()
+    pattern.data[:] = 1
+    # (origins, vertices) number of edges from the settled set into every vertex
+    entering = np.asarray((pattern.T @ reached.T.astype(float)).T)
+    return ~((entering > 0) & ~reached).any(axis=1)
+
+
+def point_travel_times(rg: RoutingGraph, o_idx: np.ndarray, o_access: np.ndarray, d_idx: np.ndarray,
+                       d_egress: np.ndarray, limit: float = np.inf, batch_size: int = DEFAULT_BATCH_SIZE,
+                       return_exhausted: bool = False):
+    """Travel times from points to points over the network, with the search bounded by `limit`.
+    Every point may have several candidate nodes, the fastest combination (walking included) is used.
+    Args:
+        rg (RoutingGraph): routing graph
+        o_idx (numpy.ndarray): (origins, k) vertex ids of the candidate nodes of every origin
+        o_access (numpy.ndarray): (origins, k) walking time from every origin to its candidate nodes, in the unit
+            of the edge weights (minutes, see od_routing.walking_minutes)
+        d_idx (numpy.ndarray): (destinations, l) vertex ids of the candidate nodes of every destination
+        d_egress (numpy.ndarray): (destinations, l) walking time from the candidate nodes to every destination
+        limit (float, optional): maximum travel time over the network. Defaults to np.inf.
+        batch_size (int, optional): number of origin nodes routed at once. Defaults to DEFAULT_BATCH_SIZE.
+        return_exhausted (bool, optional): also return whether the bounded search of every origin settled all of
+            its reachable nodes. Defaults to False.
+    Returns:
+        numpy.ndarray: (origins, destinations) travel times, inf for pairs not reached within `limit`
+    """
+    vids, inverse = np.unique(o_idx, return_inverse=True)
+    inverse = inverse.reshape(o_idx.shape)
+    node_tt = np.empty((len(vids), len(d_idx)))
+    node_exhausted = np.empty(len(vids), dtype=bool)
+
+    for start in range(0, len(vids), batch_size):
+        rows = slice(start, start + batch_size)
+        dist = _bounded_trees(rg, vids[rows], limit)
+        # Fastest egress from any candidate node of every destination
+        node_tt[rows] = np.min(dist[:, d_idx] + d_egress[None], axis=-1)
+        node_exhausted[rows] = _search_exhausted(rg, dist)
+
+    tt = np.min(node_tt[inverse] + o_access[..., None], axis=1)
+    if return_exhausted:
+        return tt, node_exhausted[inverse].all(axis=1)
+    return tt
+
+
+def cumulative_opportunities(tt: np.ndarray, thresholds, weights: np.ndarray = None) -> np.ndarray:
+    """Number (or total weight) of destinations reachable within every threshold.
+    Args:
+        tt (numpy.ndarray): (origins, destinations) travel times
+        thresholds (list): travel time thresholds
+        weights (numpy.ndarray, optional): weight of every destination, e.g. its capacity. Defaults to None.
+    Returns:
+        numpy.ndarray: (origins, thresholds) cumulative opportunities
+    """
+    weights = np.ones(tt.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+    return np.stack([(tt <= threshold) @ weights for threshold in thresholds], axis=1)
+
+
+def gravity_accessibility(tt: np.ndarray, beta: float, weights: np.ndarray = None) -> np.ndarray:
+    """Gravity based accessibility with a negative exponential decay, sum_j w_j * exp(-beta * tt_ij).
+    Unreached destinations do not contribute.
+    Args:
+        tt (numpy.ndarray): (origins, destinations) travel times
+        beta (float): decay rate per unit of travel time
+        weights (numpy.ndarray, optional): weight of every destination. Defaults to None.
+    Returns:
+        numpy.ndarray: score of every origin
+    """
+    weights = np.ones(tt.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+    return np.exp(-beta * tt) @ weights
+
+
+def nearest_k_travel_times(rg: RoutingGraph, o_idx: np.ndarray, o_access: np.ndarray, d_idx: np.ndarray,
+                           d_egress: np.ndarray, k: int, initial_limit: float,
+                           batch_size: int = DEFAULT_BATCH_SIZE) -> np.ndarray:
+    """Travel times to the k nearest destinations of every origin.
+    Origins are first searched up to `initial_limit`, those with less than k destinations settled are searched
+    again with a doubled limit, until k destinations are found or everything reachable is settled.
+    Args:
+        rg (RoutingGraph): routing graph
+        o_idx, o_access, d_idx, d_egress (numpy.ndarray): candidate nodes and walking times, see point_travel_times
+        k (int): number of destinations
+        initial_limit (float): travel time limit of the first search, should cover most origins
+        batch_size (int, optional): number of origin nodes routed at once. Defaults to DEFAULT_BATCH_SIZE.
+    Returns:
+        numpy.ndarray: (origins, k) sorted travel times, inf where less than k destinations are reachable
+    """
+    if initial_limit <= 0:
+        raise ValueError("initial_limit must be positive")
+    k_eff = min(k, len(d_idx))
+    result = np.full((len(o_idx), k), np.inf)
+    pending = np.arange(len(o_idx))
+    limit = float(initial_limit)
+
+    while len(pending) and k_eff:
+        tt, exhausted = point_travel_times(rg, o_idx[pending], o_access[pending], d_idx, d_egress, limit,
+                                           batch_size, return_exhausted=True)
+        nearest = np.sort(np.partition(tt, k_eff - 1, axis=1)[:, :k_eff], axis=1)
+        # Destinations within `limit` in total are exact, a later search cannot find anything faster
+        done = (nearest[:, -1] <= limit) | exhausted
+        result[pending[done], :k_eff] = nearest[done]
+        pending = pending[~done]
+        limit *= 2
+
+    return result
+
+
+def write_accessibility_measures(result_dir: Path, measures: Dict[str, np.ndarray], meta: dict = None) -> Path:
+    """Store accessibility measures as one .npy file per measure, with their parameters in meta.json.
+    Args:
+        result_dir (Path): directory to write to, created if needed
+        measures (dict): measure name -> array with one row per origin
+        meta (dict, optional): extra JSON serialisable information, e.g. thresholds. Defaults to None.
+    Returns:
+        Path: result_dir
+    """
+    result_dir = Path(result_dir)
+    result_dir.mkdir(parents=True, exist_ok=True)
+    for name, values in measures.items():
+        np.save(result_dir.joinpath(f"{name}.npy"), values)
+    with open(result_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'measures': list(measures), **(meta or {})}, fp)
+    return result_dir
@@ -0,0 +1,125 @@
+from typing import List, Tuple
+
+import igraph as ig
+import numpy as np
+
+from .od_routing import BOARDING_ATTRIBUTE, RoutingGraph, _encode_attribute
+
+HOURS_PER_DAY = 24
+SECONDS_PER_HOUR = 3600
+# Graph arrays the hourly costs are derived from, see graph_helper_utils.append_hourly_wait_attribute
+WAIT_ARRAYS = ('segment_waits',)
+
+
+def parse_hours(hours: str) -> List[int]:
+    """Hours of the day from a comma separated list, 'all' for every hour and an empty string for none."""
+    if hours.strip() == 'all':
+        return list(range(HOURS_PER_DAY))
+    return sorted({int(hour) for hour in hours.split(',') if hour.strip()})
+
+
+def _check_wait_arrays(G: ig.Graph):
+    missing = [name for name in WAIT_ARRAYS if name not in G.attributes()]
+    if missing:
+        raise ValueError(f"Graph has no {missing}, hourly routing needs graphs generated with their wait arrays")
+
+
+def window_hours(G: ig.Graph) -> List[int]:
+    """Hours of the day overlapping the timerange the graph was built from (graph attribute 'time_window').
+    The graph only holds the segments served in that timerange, so only these hours can be routed on it.
+    """
+    if 'time_window' not in G.attributes():
+        raise ValueError("Graph has no 'time_window', hourly routing needs graphs generated with their timerange")
+    start, end = (sum(int(part) * 60 ** (2 - i) for i, part in enumerate(t.split(':'))) for t in G['time_window'])
+    return list(range(start // SECONDS_PER_HOUR, min(-(-end // SECONDS_PER_HOUR), HOURS_PER_DAY)))
+
+
+def boarding_graph(G: ig.Graph) -> ig.Graph:
+    """Expand a transit graph so that boarding a line is an edge of its own.
+    Every (stop, route) pair of a segment becomes a route vertex, appended after the stop vertices so that their
+    ids are unchanged. Segments connect the route vertices of their route, boarding edges lead from a stop to its
+    route vertices and alighting edges back. Staying on a route never passes a stop vertex, while every boarding,
+    the first one and every transfer, takes a boarding edge.
+    The (edges, hours) graph attribute 'hourly_weights' holds the weight of every edge in every hour in minutes:
+    the travel time of the segments served in it (inf otherwise), the expected wait for the route at the stop on
+    boarding edges (inf without any departure, 0 where the frequency is unknown) and 0 on alighting edges.
+    Args:
+        G (igraph.Graph): transit graph with wait arrays
+    Returns:
+        igraph.Graph: the boarding graph, with the 'travel_time', 'length', 'route_type' and 'unique_route_id'
+        edge attributes used by RoutingGraph, boarding and alighting edges carry those of their route
+    """
+    _check_wait_arrays(G)
+    n, n_edges = G.vcount(), G.ecount()
+    edges = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    route = _encode_attribute(G, 'unique_route_id')
+    n_routes = int(route.max()) + 1 if n_edges else 1
+
+    # Route vertex of the (stop, route) pair at both ends of every segment, and a segment of every pair
+    pairs, first, inverse = np.unique(np.concatenate([edges[:, 0], edges[:, 1]]) * n_routes + np.tile(route, 2),
+                                      return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    pair_stop, pair_segment = pairs // n_routes, first % max(n_edges, 1)
+    boarding = np.unique(inverse[:n_edges])
+    alighting = np.unique(inverse[n_edges:])
+
+    Gb = ig.Graph(n=n + len(pairs), directed=True, edges=np.vstack([
+        n + inverse.reshape(2, -1).T,
+        np.column_stack([pair_stop[boarding], n + boarding]),
+        np.column_stack([n + alighting, pair_stop[alighting]]),
+    ]))
+    source = np.concatenate([np.arange(n_edges), pair_segment[boarding], pair_segment[alighting]])
+    is_segment = np.arange(len(source)) < n_edges
+    for name in ('route_type', 'unique_route_id'):
+        values = G.es[name] if n_edges else []
+        Gb.es[name] = [values[e] for e in source]
+    travel_time = np.asarray(G.es['travel_time'], dtype=float) if n_edges else np.zeros(0)
+    length = np.asarray(G.es['length'], dtype=float) if n_edges else np.zeros(0)
+    Gb.es['travel_time'] = np.where(is_segment, travel_time[source], 0.).tolist()
+    Gb.es['length'] = np.where(is_segment, length[source], 0.).tolist()
+    Gb.es[BOARDING_ATTRIBUTE] = (~is_segment).tolist()
+
+    segment_waits = np.asarray(G['segment_waits'], dtype=float)
+    # Waiting for a route at a stop: the shortest expected wait of its segments leaving the stop
+    route_waits = np.full((len(pairs), segment_waits.shape[1]), np.inf)
+    np.minimum.at(route_waits, inverse[:n_edges], np.where(np.isnan(segment_waits), 0., segment_waits))
+    Gb['hourly_weights'] = np.vstack([
+        np.where(np.isinf(segment_waits), np.inf, travel_time[:, None]),
+        route_waits[boarding],
+        np.zeros((len(alighting), segment_waits.shape[1])),
+    ])
+    if 'time_window' in G.attributes():
+        Gb['time_window'] = G['time_window']
+    return Gb
+
+
+def hour_groups(Gb: ig.Graph, hours: List[int]) -> List[Tuple[np.ndarray, List[int]]]:
+    """Group hours with the same edge weights, all hours of a group share their shortest path trees.
+    Segments without any vehicle in an hour are left out of its graph, segments without known frequencies are kept.
+    The waits differ with the headways of every hour, so hourly routing takes one routing pass per hour, only hours
+    with identical service share one.
+    Raises ValueError for hours outside the timerange of the graph (see window_hours), its segments served only
+    outside of it are missing.
+    Args:
+        Gb (igraph.Graph): boarding graph, see boarding_graph
+        hours (list): hours of the day
+    Returns:
+        list: tuples of the weights of the edges of Gb and the hours with exactly those weights
+    """
+    outside = sorted(set(hours) - set(window_hours(Gb)))
+    if outside:
+        raise ValueError(f"Hours {outside} are outside of the timerange {Gb['time_window']} of the graph, generate "
+                         f"graphs with a timerange covering them (GG_TIME_WINDOWS)")
+    weights = np.asarray(Gb['hourly_weights'])[:, hours]
+    _, group, inverse = np.unique(weights, axis=1, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    return [(weights[:, first], [hours[h] for h in np.flatnonzero(inverse == g)]) for g, first in enumerate(group)]
+
+
+def hour_routing_graph(rg: RoutingGraph, weights: np.ndarray) -> RoutingGraph:
+    """Routing graph of a group of hours, see hour_groups.
+    Args:
+        rg (RoutingGraph): routing graph of the boarding graph
+        weights (numpy.ndarray): weights of the edges of the boarding graph in the hours of the group
+    """
+    return rg.with_edge_weights(weights)
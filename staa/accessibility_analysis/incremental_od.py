@@ -0,0 +1,167 @@
+import json
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
+from scipy.sparse.csgraph import dijkstra
+
+from .od_routing import RoutingGraph
+from ..graph_analysis.utils.id_dictionary import graph_attribute
+
+STATE_META_FILE = 'meta.json'
+# Edge attributes that change the OD metrics of the paths using an edge, next to its weight
+EDGE_METRIC_ATTRIBUTES = ('route_type', 'unique_route_id')
+# A path through a cheaper or added edge has to beat the previous travel time by more than this to count
+IMPROVEMENT_TOLERANCE = 1e-6
+
+
+def write_od_state(state_dir: Path, state: dict, meta: dict = None) -> Path:
+    """Store the routing state of a graph that the next graph's incremental OD computation starts from.
+    Args:
+        state_dir (Path): directory to write to, created if needed
+        state (dict): 'origin_nodes' and 'poi_nodes' (node_ids of the routed nodes), 'tt' (their node to node
+            travel times), 'path_edges' (csr matrix of the edges on the paths of every origin node, indexed like
+            RoutingGraph.edge_keys) and the snapping of the points ('nb_nodes', 'nb_dist', 'poi_point_nodes',
+            'poi_dist')
+        meta (dict, optional): extra JSON serialisable information. Defaults to None.
+    Returns:
+        Path: state_dir
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    for name, values in state.items():
+        if name == 'path_edges':
+            np.save(state_dir.joinpath('path_edges_indptr.npy'), values.indptr)
+            np.save(state_dir.joinpath('path_edges_indices.npy'), values.indices)
+        else:
+            np.save(state_dir.joinpath(f"{name}.npy"), values)
+    with open(state_dir.joinpath(STATE_META_FILE), 'w') as fp:
+        json.dump({'arrays': [name for name in state if name != 'path_edges'],
+                   'n_edges': state['path_edges'].shape[1], **(meta or {})}, fp)
+    return state_dir
+
+
+def read_od_state(state_dir: Path) -> dict:
+    """Inverse of write_od_state, the meta data is returned under 'meta'."""
+    state_dir = Path(state_dir)
+    with open(state_dir.joinpath(STATE_META_FILE)) as fp:
+        meta = json.load(fp)
+    state = {name: np.load(state_dir.joinpath(f"{name}.npy")) for name in meta['arrays']}
+    indptr = np.load(state_dir.joinpath('path_edges_indptr.npy'))
+    indices = np.load(state_dir.joinpath('path_edges_indices.npy'))
+    state['path_edges'] = csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                     shape=(len(indptr) - 1, meta['n_edges']))
+    state['meta'] = meta
+    return state
+
+
+def _edge_frame(rg: RoutingGraph) -> pd.DataFrame:
+    """The collapsed edges of a routing graph keyed by the node_ids of their endpoints.
+    Ids are compared as strings, the id codes of two graphs come from different dictionaries.
+    """
+    names = graph_attribute(rg.graph, 'node_id')
+    return pd.DataFrame({
+        'from': names[rg.edge_keys // rg.n],
+        'to': names[rg.edge_keys % rg.n],
+        'weight': rg.edge_weights,
+        'length': rg.length[rg.edge_ids],
+        **{name: graph_attribute(rg.graph, name, edges=True)[rg.edge_ids] for name in EDGE_METRIC_ATTRIBUTES},
+    })
+
+
+def edge_changes(prev_rg: RoutingGraph, rg: RoutingGraph) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Diff the edges of two graphs by the node_ids of their endpoints.
+    Returns:
+        tuple: boolean mask of the previous edges that were removed, became more expensive or changed any other
+        metric attribute; positions of the new edges that were added or became cheaper; position in the new graph
+        of every previous edge, -1 if it was removed
+    """
+    prev, new = _edge_frame(prev_rg), _edge_frame(rg)
+    merged = prev.reset_index().merge(new.reset_index(), on=['from', 'to'], how='outer', suffixes=('_prev', '_new'))
+    removed = merged['index_new'].isna().values
+    added = merged['index_prev'].isna().values
+    both = ~removed & ~added
+
+    changed = np.zeros(len(merged), dtype=bool)
+    for name in ('length', *EDGE_METRIC_ATTRIBUTES):
+        prev_values, new_values = merged[f"{name}_prev"], merged[f"{name}_new"]
+        changed |= ((prev_values != new_values) & ~(prev_values.isna() & new_values.isna())).values
+    worse = removed | both & ((merged['weight_new'] > merged['weight_prev']).values | changed)
+    better = added | both & (merged['weight_new'] < merged['weight_prev']).values
+
+    prev_pos = merged['index_prev'].values
+    worse_prev = np.zeros(len(prev), dtype=bool)
+    worse_prev[prev_pos[worse].astype(np.int64)] = True
+    prev_to_new = np.full(len(prev), -1, dtype=np.int64)
+    prev_to_new[prev_pos[both].astype(np.int64)] = merged['index_new'].values[both].astype(np.int64)
+    return worse_prev, np.sort(merged['index_new'].values[better].astype(np.int64)), prev_to_new
+
+
+def affected_origins(state: dict, rg: RoutingGraph, worse: np.ndarray, better: np.ndarray) -> np.ndarray:
+    """Origin nodes of a previous state whose travel times towards its POI nodes may differ on a new graph.
+    An origin is affected if one of its previous paths uses a worse edge, or if a path through one of the better
+    edges (using the exact distances to and from that edge on the new graph) beats one of its previous travel
+    times. All other paths of unaffected origins still exist unchanged, so their rows can be copied.
+    Args:
+        state (dict): state of the previous graph, see write_od_state
+        rg (RoutingGraph): routing graph of the new graph, all POI nodes of the state have to exist in it
+        worse (numpy.ndarray): mask over the previous edges, see edge_changes
+        better (numpy.ndarray): positions of the new edges, see edge_changes
+    Returns:
+        numpy.ndarray: boolean mask over state['origin_nodes']
+    """
+    n_origins = len(state['origin_nodes'])
+    affected = np.asarray(state['path_edges'][:, worse].sum(axis=1)).ravel() > 0 if worse.any() \
+        else np.zeros(n_origins, dtype=bool)
+    node_index = pd.Index(graph_attribute(rg.graph, 'node_id'))
+    o_vids = node_index.get_indexer(state['origin_nodes'])
+    d_vids = node_index.get_indexer(state['poi_nodes'])
+    affected |= o_vids < 0
+    if not len(better):
+        return affected
+
+    tails, heads = rg.edge_keys[better] // rg.n, rg.edge_keys[better] % rg.n
+    u_vids, u_inv = np.unique(tails, return_inverse=True)
+    v_vids, v_inv = np.unique(heads, return_inverse=True)
+    # Two searches per changed endpoint, beyond the number of origins routing all of them again is cheaper
+    if len(u_vids) + len(v_vids) >= n_origins:
+        return np.ones(n_origins, dtype=bool)
+
+    to_u = dijkstra(rg.csr.T.tocsr(), directed=True, indices=u_vids)[:, o_vids]
+    from_v = dijkstra(rg.csr, directed=True, indices=v_vids)[:, d_vids]
+    for e, edge in enumerate(better):
+        via = to_u[u_inv[e]][:, None] + rg.edge_weights[edge] + from_v[v_inv[e]][None, :]
+        affected |= (via < state['tt'] - IMPROVEMENT_TOLERANCE).any(axis=1)
+    return affected
+
+
+def merge_od_states(prev_state: dict, keep: np.ndarray, prev_to_new: np.ndarray, states: List[dict],
+                    origin_nodes: np.ndarray, n_edges: int) -> dict:
+    """Combine the origin nodes kept from the previous state with freshly routed ones into the new graph's state.
+    Args:
+        prev_state (dict): state of the previous graph
+        keep (numpy.ndarray): mask over the previous origin nodes whose rows were copied
+        prev_to_new (numpy.ndarray): edge position mapping, see edge_changes
+        states (list): states of the freshly routed origin nodes, their path edges indexed on the new graph
+        origin_nodes (numpy.ndarray): node_ids of all origin nodes the new state has to hold
+        n_edges (int): number of edges of the new routing graph
+    Returns:
+        dict: 'origin_nodes', 'poi_nodes', 'tt' and 'path_edges' of the new graph
+    """
+    kept = prev_state['path_edges'][keep].tocoo()
+    # Kept origins only use unchanged edges, which all exist in the new graph
+    kept = csr_matrix((kept.data, (kept.row, prev_to_new[kept.col])), shape=(kept.shape[0], n_edges))
+    # Vertex ids, and with them the order of the POI nodes, may differ between graphs
+    poi_nodes = prev_state['poi_nodes']
+    fresh_tt = [state['tt'][:, pd.Index(state['poi_nodes']).get_indexer(poi_nodes)] for state in states]
+
+    # Freshly routed rows come first, so that they win over kept rows of the same node
+    names = np.concatenate([*(state['origin_nodes'] for state in states), prev_state['origin_nodes'][keep]])
+    tt = np.vstack([*fresh_tt, prev_state['tt'][keep]])
+    path_edges = vstack([*(state['path_edges'] for state in states), kept], format='csr')
+
+    _, first = np.unique(names, return_index=True)
+    first = first[np.isin(names[first], origin_nodes)]
+    return {'origin_nodes': names[first], 'poi_nodes': poi_nodes, 'tt': tt[first], 'path_edges': path_edges[first]}
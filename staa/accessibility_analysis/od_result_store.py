@@ -0,0 +1,123 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Compact on-disk dtype of every OD metric
+OD_DTYPES = {
+    'tt': np.float32,
+    'td': np.float32,
+    'modes': np.uint8,
+    'lines': np.uint8,
+    'hops': np.uint16,
+}
+UNREACHABLE_NAME = 'unreachable'
+META_FILE = 'meta.json'
+
+
+def _unreachable_value(dtype) -> np.generic:
+    """Value marking unreachable pairs: nan for floats, the dtype maximum for counts."""
+    dtype = np.dtype(dtype)
+    return dtype.type(np.nan) if dtype.kind == 'f' else np.iinfo(dtype).max
+
+
+def to_compact_od_metric(metric: str, values: np.ndarray) -> np.ndarray:
+    """Cast a metric to its compact dtype, replacing non-finite entries with the unreachable marker."""
+    dtype = OD_DTYPES[metric]
+    missing = ~np.isfinite(values)
+    compact = np.where(missing, 0, values).astype(dtype)
+    compact[missing] = _unreachable_value(dtype)
+    return compact
+
+
+def from_compact_od_metric(metric: str, values: np.ndarray) -> np.ndarray:
+    """Inverse of to_compact_od_metric: float64 values, inf for unreachable times and distances, nan for counts."""
+    dtype = OD_DTYPES[metric]
+    if np.dtype(dtype).kind == 'f':
+        return np.where(np.isnan(values), np.inf, values).astype(float)
+    return np.where(values == _unreachable_value(dtype), np.nan, values).astype(float)
+
+
+def write_od_result(result_dir: Path, matrices: Dict[str, np.ndarray], meta: dict = None) -> Path:
+    """Store the OD matrices of one graph as one .npy file per metric.
+    Args:
+        result_dir (Path): directory to write to, created if needed
+        matrices (dict): metric name (see OD_DTYPES) -> (origins, destinations) matrix, non-finite where unreachable
+        meta (dict, optional): extra JSON serialisable information stored next to the matrices. Defaults to None.
+    Returns:
+        Path: result_dir
+    """
+    result_dir = Path(result_dir)
+    result_dir.mkdir(parents=True, exist_ok=True)
+
+    for metric, values in matrices.items():
+        np.save(result_dir.joinpath(f"{metric}.npy"), to_compact_od_metric(metric, values))
+    np.save(result_dir.joinpath(f"{UNREACHABLE_NAME}.npy"), ~np.isfinite(matrices['tt']))
+
+    with open(result_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'shape': list(matrices['tt'].shape), 'metrics': list(matrices), **(meta or {})}, fp)
+
+    return result_dir
+
+
+def read_od_metric(result_dir: Path, metric: str, mmap: bool = True) -> np.ndarray:
+    """Read a single metric (or the 'unreachable' mask) of a stored OD result, memory mapped by default."""
+    return np.load(Path(result_dir).joinpath(f"{metric}.npy"), mmap_mode='r' if mmap else None)
+
+
+def read_od_result(result_dir: Path, mmap: bool = True) -> Dict[str, np.ndarray]:
+    """Read all metrics and the unreachable mask of a stored OD result."""
+    with open(Path(result_dir).joinpath(META_FILE)) as fp:
+        metrics = json.load(fp)['metrics']
+    return {metric: read_od_metric(result_dir, metric, mmap) for metric in [*metrics, UNREACHABLE_NAME]}
+
+
+def stack_od_results(result_dirs: List[Path], labels: List[str], stack_dir: Path) -> Path:
+    """Stack the OD results of several graphs (e.g. dates) along a leading time axis.
+    Every metric ends up in a single (time, origins, destinations) .npy file which is written slice by slice
+    and can be memory mapped with open_od_stack, so that no result is ever fully loaded.
+    Args:
+        result_dirs (list): OD result directories written by write_od_result, all of the same shape
+        labels (list): label (e.g. the date) of every result
+        stack_dir (Path): directory to write the stacked metrics to
+    Returns:
+        Path: stack_dir
+    """
+    if len(result_dirs) != len(labels):
+        raise ValueError("Every OD result needs exactly one label")
+    if not result_dirs:
+        raise ValueError("Nothing to stack")
+
+    stack_dir = Path(stack_dir)
+    stack_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(Path(result_dirs[0]).joinpath(META_FILE)) as fp:
+        meta = json.load(fp)
+    shape = (len(result_dirs), *meta['shape'])
+
+    for metric in [*meta['metrics'], UNREACHABLE_NAME]:
+        dtype = np.bool_ if metric == UNREACHABLE_NAME else OD_DTYPES[metric]
+        stack = np.lib.format.open_memmap(stack_dir.joinpath(f"{metric}.npy"), mode='w+', dtype=dtype, shape=shape)
+        for t, result_dir in enumerate(result_dirs):
+            values = read_od_metric(result_dir, metric)
+            if values.shape != shape[1:]:
+                raise ValueError(f"{result_dir} has shape {values.shape}, expected {shape[1:]}")
+            stack[t] = values
+        stack.flush()
+        del stack
+
+    with open(stack_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'shape': list(shape), 'metrics': meta['metrics'], 'labels': list(labels)}, fp)
+
+    return stack_dir
+
+
+def open_od_stack(stack_dir: Path, metric: str) -> Tuple[np.ndarray, List[str]]:
+    """Memory map one stacked metric.
+    Returns:
+        tuple: (time, origins, destinations) read-only memmap and the labels of its time axis
+    """
+    with open(Path(stack_dir).joinpath(META_FILE)) as fp:
+        labels = json.load(fp)['labels']
+    return read_od_metric(stack_dir, metric), labels
@@ -0,0 +1,294 @@
+import copy
+
+import numpy as np
+import igraph as ig
+from scipy.sparse import csr_matrix, vstack
+from scipy.sparse.csgraph import dijkstra
+
+from ..graph_analysis.utils.speeds import MetricTravelSpeeds
+
+OD_METRICS = ('tt', 'td', 'modes', 'lines', 'hops')
+
+# Maximum number of shortest path trees kept in memory at once
+DEFAULT_BATCH_SIZE = 256
+# Edge attribute marking edges that are not a ride, e.g. boarding a line, they do not count as hops
+BOARDING_ATTRIBUTE = 'boarding'
+# Walking speed of access and egress, in meters per minute like the network travel times
+WALKING_METERS_PER_MINUTE = MetricTravelSpeeds.WALKING.value * 1000 / 60
+
+
+def walking_minutes(distance_m: np.ndarray) -> np.ndarray:
+    """Walking time in minutes for distances in meters, e.g. those of the snapped points."""
+    return np.asarray(distance_m, dtype=float) / WALKING_METERS_PER_MINUTE
+
+
+class RoutingGraph:
+    """Sparse (CSR) view of an igraph transit graph used to grow shortest path trees in batches.
+    Parallel edges are collapsed onto the cheapest one, whose igraph edge id is kept so that
+    edge attributes can be looked up for every tree edge.
+    Args:
+        G (igraph.Graph): input graph
+        weights (str, optional): edge attribute minimised by the search. Defaults to 'travel_time'.
+        length (str, optional): edge attribute accumulated as travel distance. Defaults to 'length'.
+    """
+
+    def __init__(self, G: ig.Graph, weights: str = 'travel_time', length: str = 'length'):
+        self.graph = G
+        self.n = G.vcount()
+
+        edges = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        self.keys = edges[:, 0] * self.n + edges[:, 1]
+        self.weights = np.asarray(G.es[weights], dtype=float) if G.ecount() else np.zeros(0)
+        self._collapse(self.weights, np.ones(len(self.weights), dtype=bool))
+
+        self.length = np.asarray(G.es[length], dtype=float) if G.ecount() else np.zeros(0)
+        self.hop = ~np.asarray(G.es[BOARDING_ATTRIBUTE], dtype=bool) if BOARDING_ATTRIBUTE in G.es.attributes() \
+            else np.ones(G.ecount(), dtype=bool)
+        # Categorical edge attributes as bitsets, so distinct values along a path are a bitwise or away
+        self.mode_bits = _bitsets(_encode_attribute(G, 'route_type'))
+        self.line_bits = _bitsets(_encode_attribute(G, 'unique_route_id'))
+
+    def _collapse(self, w: np.ndarray, kept: np.ndarray):
+        """Keep the cheapest of the `kept` edges for every (source, target) pair, sorted by pair key."""
+        candidates = np.flatnonzero(kept)
+        keys = self.keys[candidates]
+        order = np.lexsort((w[candidates], keys))
+        first = np.r_[True, keys[order][1:] != keys[order][:-1]] if len(order) else np.zeros(0, dtype=bool)
+        self.edge_ids = candidates[order[first]]
+        self.edge_keys = self.keys[self.edge_ids]
+        self.edge_weights = w[self.edge_ids]
+        self.csr = csr_matrix((self.edge_weights, (self.edge_keys // self.n, self.edge_keys % self.n)),
+                              shape=(self.n, self.n))
+
+    def with_edge_weights(self, weights: np.ndarray) -> 'RoutingGraph':
+        """Copy sharing the graph and the edge attributes, with other weights for its edges.
+        Parallel edges are collapsed again, so the cheapest remaining edge of a pair carries its attributes.
+        Args:
+            weights (numpy.ndarray): weight of every igraph edge, inf removes an edge
+        Returns:
+            RoutingGraph: the reweighted graph
+        """
+        rg = copy.copy(self)
+        rg.weights = np.asarray(weights, dtype=float)
+        rg._collapse(rg.weights, np.isfinite(rg.weights))
+        return rg
+
+    def tree_edges(self, pred: np.ndarray) -> np.ndarray:
+        """Map a predecessor matrix onto the igraph ids of the tree edges.
+        Args:
+            pred (numpy.ndarray): predecessor matrix as returned by scipy's dijkstra
+        Returns:
+            numpy.ndarray: igraph edge id entering every vertex, -1 for roots and unreached vertices
+        """
+        eid = np.full(pred.shape, -1, dtype=np.int64)
+        r, c = np.nonzero(pred >= 0)
+        eid[r, c] = self.edge_ids[np.searchsorted(self.edge_keys, pred[r, c].astype(np.int64) * self.n + c)]
+        return eid
+
+
+def tree_path_edges(rg: RoutingGraph, pred: np.ndarray, destinations: np.ndarray) -> csr_matrix:
+    """Edges on the tree paths from the root to the destinations of a set of shortest path trees.
+    Args:
+        rg (RoutingGraph): routing graph the trees were grown on
+        pred (numpy.ndarray): predecessor matrix (one tree per row)
+        destinations (numpy.ndarray): vertex ids of the destinations
+    Returns:
+        scipy.sparse.csr_matrix: (trees, edges) boolean matrix, edges indexed like rg.edge_keys
+    """
+    on_path = np.zeros(pred.shape, dtype=bool)
+    r = np.repeat(np.arange(pred.shape[0]), len(destinations))
+    c = np.tile(np.asarray(destinations, dtype=np.int64), pred.shape[0])
+    keep = pred[r, c] >= 0
+    r, c = r[keep], c[keep]
+    # Walk up from the destinations until the root, or a vertex whose path is already marked
+    while len(r):
+        on_path[r, c] = True
+        c = pred[r, c].astype(np.int64)
+        keep = (pred[r, c] >= 0) & ~on_path[r, c]
+        r, c = r[keep], c[keep]
+
+    r, c = np.nonzero(on_path)
+    edges = np.searchsorted(rg.edge_keys, pred[r, c].astype(np.int64) * rg.n + c)
+    return csr_matrix((np.ones(len(r), dtype=bool), (r, edges)), shape=(pred.shape[0], len(rg.edge_keys)))
+
+
+def _encode_attribute(G: ig.Graph, attribute: str) -> np.ndarray:
+    """Integer codes for a categorical edge attribute, missing values count as a category of their own."""
+    if not G.ecount():
+        return np.zeros(0, dtype=np.int64)
+    values = np.asarray(G.es[attribute])
+    # Interned ids (see id_dictionary) already are integer codes, other categories are encoded by their text
+    _, codes = np.unique(values if values.dtype.kind in 'iu' else values.astype(str), return_inverse=True)
+    return codes.ravel()
+
+
+def _bitsets(codes: np.ndarray) -> np.ndarray:
+    """One-hot bitsets of shape (len(codes), n_words) for integer category codes."""
+    n_words = int(codes.max()) // 64 + 1 if codes.size else 1
+    bits = np.zeros((len(codes), n_words), dtype=np.uint64)
+    bits[np.arange(len(codes)), codes // 64] = np.left_shift(np.uint64(1), (codes % 64).astype(np.uint64))
+    return bits
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    """Number of set bits in the bitsets stored along the last axis of a uint64 array."""
+    return np.unpackbits(np.ascontiguousarray(x, dtype=np.uint64).view(np.uint8), axis=-1).sum(axis=-1)
+
+
+def _distinct_along_tree(pred: np.ndarray, eid: np.ndarray, bits: np.ndarray) -> np.ndarray:
+    """Number of distinct categories on the root path of every vertex, given the bitsets of all edges."""
+    values = np.where((eid >= 0)[..., None], bits[eid], np.uint64(0))
+    return _popcount(accumulate_along_tree(pred, values, np.bitwise_or))
+
+
+def accumulate_along_tree(pred: np.ndarray, values: np.ndarray, ufunc: np.ufunc = np.add) -> np.ndarray:
+    """Reduce per-vertex values along the root path of every vertex of a set of shortest path trees.
+    Uses pointer jumping, so the number of vectorised passes grows with the log of the tree depth
+    instead of walking every path separately.
+    Args:
+        pred (numpy.ndarray): predecessor matrix (one tree per row), negative for roots and unreached vertices
+        values (numpy.ndarray): value of the tree edge entering every vertex (trailing axes are allowed),
+            the identity of `ufunc` for roots
+        ufunc (numpy.ufunc, optional): associative reduction, e.g. np.add, np.bitwise_or, np.maximum.
+            Defaults to np.add.
+    Returns:
+        numpy.ndarray: reduction of `values` from the root up to (and including) every vertex
+    """
+    acc = values.copy()
+    anc = pred.astype(np.int64)
+    r, c = np.nonzero(anc >= 0)
+    while len(r):
+        a = anc[r, c]
+        acc[r, c] = ufunc(acc[r, c], acc[r, a])
+        anc[r, c] = anc[r, a]
+        keep = anc[r, c] >= 0
+        r, c = r[keep], c[keep]
+    return acc
+
+
+def od_tree_metrics(rg: RoutingGraph, origins: np.ndarray, destinations: np.ndarray,
+                    along_tree: dict = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                    with_path_edges: bool = False) -> dict:
+    """Derive travel time, distance, number of modes, lines and hops between every origin and destination
+    from a single shortest path tree (by travel time) per origin.
+    Modes and lines are the distinct `route_type` and `unique_route_id` values on the path, accumulated
+    incrementally along the tree as bitsets.
+    Args:
+        rg (RoutingGraph): routing graph
+        origins (numpy.ndarray): vertex ids of the origins
+        destinations (numpy.ndarray): vertex ids of the destinations
+        along_tree (dict, optional): additional metrics to accumulate along the trees, mapping a metric name
+            to a tuple (edge attribute name, ufunc). Defaults to None.
+        batch_size (int, optional): number of origins routed at once. Defaults to DEFAULT_BATCH_SIZE.
+        with_path_edges (bool, optional): also return the edges on the paths of every origin to the destinations
+            under 'path_edges' (see tree_path_edges). Defaults to False.
+    Returns:
+        dict: metric name -> numpy.ndarray of shape (len(origins), len(destinations)). Unreachable pairs are inf
+        for 'tt' and 'td' and nan for the counts, as are pairs without any edge in between.
+    """
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    along_tree = along_tree or {}
+    extra_values = {name: np.asarray(rg.graph.es[attribute], dtype=float) for name, (attribute, _) in
+                    along_tree.items()}
+
+    shape = (len(origins), len(destinations))
+    result = {metric: np.full(shape, np.nan) for metric in (*OD_METRICS, *along_tree)}
+    path_edges = []
+
+    if not len(rg.edge_ids):
+        # Without any edge only the origins themselves are reached, by an empty path
+        reached = origins[:, None] == destinations[None]
+        result['tt'] = np.where(reached, 0., np.inf)
+        result['td'] = result['tt'].copy()
+        for name in along_tree:
+            result[name] = np.where(reached, 0., np.nan)
+        if with_path_edges:
+            result['path_edges'] = csr_matrix((len(origins), len(rg.edge_keys)), dtype=bool)
+        return result
+
+    for start in range(0, len(origins), batch_size):
+        batch = origins[start:start + batch_size]
+        rows = slice(start, start + len(batch))
+
+        dist, pred = dijkstra(rg.csr, directed=True, indices=batch, return_predecessors=True)
+        eid = rg.tree_edges(pred)
+        in_tree = eid >= 0
+
+        hops = accumulate_along_tree(pred, (in_tree & rg.hop[eid]).astype(np.int64))
+        td = accumulate_along_tree(pred, np.where(in_tree, rg.length[eid], 0.))
+        modes = _distinct_along_tree(pred, eid, rg.mode_bits)
+        lines = _distinct_along_tree(pred, eid, rg.line_bits)
+
+        reached = np.isfinite(dist[:, destinations])
+        with_path = reached & (hops[:, destinations] > 0)
+        result['tt'][rows] = dist[:, destinations]
+        result['td'][rows] = np.where(reached, td[:, destinations], np.inf)
+        for metric, values in (('modes', modes), ('lines', lines), ('hops', hops)):
+            result[metric][rows] = np.where(with_path, values[:, destinations], np.nan)
+
+        for name, (_, ufunc) in along_tree.items():
+            acc = accumulate_along_tree(pred, np.where(in_tree, extra_values[name][eid], 0.), ufunc)
+            result[name][rows] = np.where(reached, acc[:, destinations], np.nan)
+
+        if with_path_edges:
+            path_edges.append(tree_path_edges(rg, pred, destinations))
+
+    if with_path_edges:
+        result['path_edges'] = vstack(path_edges, format='csr') if path_edges \
+            else csr_matrix((0, len(rg.edge_keys)), dtype=bool)
+    return result
+
+
+def gather_od(raw: dict, o_idx: np.ndarray, o_access: np.ndarray, d_idx: np.ndarray, d_egress: np.ndarray,
+              decode=None, chunk_size: int = 64) -> dict:
+    """Assemble point to point OD matrices from node to node metrics plus access and egress walking.
+    Every point may have several candidate access nodes, the pair of candidates with the lowest travel time
+    (including walking) is used for all metrics. Walking adds its distance to 'td' and its time at
+    WALKING_METERS_PER_MINUTE to 'tt', so travel times stay in minutes.
+    Args:
+        raw (dict): metric name -> 2D node to node matrix (as returned by od_tree_metrics), indexable by o_idx, d_idx
+        o_idx (numpy.ndarray): (origins, k) row indices into the raw matrices
+        o_access (numpy.ndarray): (origins, k) walking distance in meters from every origin to its candidate nodes
+        d_idx (numpy.ndarray): (destinations, l) column indices into the raw matrices
+        d_egress (numpy.ndarray): (destinations, l) walking distance in meters from the candidate nodes to every
+            destination
+        decode (callable, optional): applied as decode(metric, values) to the gathered raw values. Defaults to None.
+        chunk_size (int, optional): number of origins gathered at once. Defaults to 64.
+    Returns:
+        dict: metric name -> (origins, destinations) matrix
+    """
+    n_destinations = len(d_idx)
+    result = {metric: np.full((len(o_idx), n_destinations), np.nan) for metric in raw}
+    egress = d_egress[None, None, :, :]
+
+    def candidates(values):
+        # (p, k, Q, l) -> (p, Q, k * l)
+        return values.transpose(0, 2, 1, 3).reshape(values.shape[0], n_destinations, -1)
+
+    for start in range(0, len(o_idx), chunk_size):
+        rows = slice(start, start + chunk_size)
+        access = o_access[rows, :, None, None]
+        values = {metric: np.asarray(matrix[o_idx[rows, :, None, None], d_idx[None, None, :, :]])
+                  for metric, matrix in raw.items()}
+        if decode:
+            values = {metric: decode(metric, v) for metric, v in values.items()}
+
+        # Candidate access/egress pair with the lowest travel time
+        tt = candidates(values['tt'] + walking_minutes(access) + walking_minutes(egress))
+        best = np.argmin(np.where(np.isnan(tt), np.inf, tt), axis=-1)[..., None]
+
+        def pick(v):
+            return np.take_along_axis(candidates(np.broadcast_to(v, values['tt'].shape)), best, axis=-1)[..., 0]
+
+        walk_o, walk_d = pick(access), pick(egress)
+        for metric, v in values.items():
+            result[metric][rows] = pick(v)
+
+        result['tt'][rows] += walking_minutes(walk_o + walk_d)
+        result['td'][rows] += walk_o + walk_d
+        # Add walking if there is some
+        result['modes'][rows] += (walk_o > 0) | (walk_d > 0)
+        result['hops'][rows] += (walk_o > 0).astype(int) + (walk_d > 0)
+
+    return result
@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class ReachabilityIndex:
+    """Which targets can be reached at all from any vertex, answered without routing.
+    The graph is condensed into its strongly connected components. Every component keeps a bitset of the target
+    components reachable from it, propagated from the sinks of the condensation (a DAG) towards its sources.
+    Args:
+        csr (scipy.sparse.csr_matrix): adjacency matrix of the graph, e.g. RoutingGraph.csr
+        targets (numpy.ndarray): vertex ids of all destinations that will be queried
+    """
+
+    def __init__(self, csr: csr_matrix, targets: np.ndarray):
+        self.n_components, self.labels = connected_components(csr, directed=True, connection='strong')
+        self.target_components = np.unique(self.labels[np.ravel(targets)])
+
+        coo = csr.tocoo()
+        src, dst = self.labels[coo.row], self.labels[coo.col]
+        between = src != dst
+        dag = csr_matrix((np.ones(between.sum()), (src[between], dst[between])),
+                         shape=(self.n_components, self.n_components))
+        dag.sum_duplicates()
+
+        n_words = len(self.target_components) // 64 + 1
+        self.bits = np.zeros((self.n_components, n_words), dtype=np.uint64)
+        cols = np.arange(len(self.target_components))
+        self.bits[self.target_components, cols // 64] = np.left_shift(np.uint64(1), (cols % 64).astype(np.uint64))
+
+        # Kahn's algorithm on the reversed condensation: a component is final once all its successors are
+        reverse = dag.T.tocsr()
+        out_degree = np.diff(dag.indptr)
+        ready = np.flatnonzero(out_degree == 0)
+        while len(ready):
+            counts = np.diff(reverse.indptr)[ready]
+            successors = np.repeat(ready, counts)
+            # Positions of the reversed edges of all ready components in reverse.indices
+            offsets = np.repeat(reverse.indptr[ready] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            predecessors = reverse.indices[offsets]
+            np.bitwise_or.at(self.bits, predecessors, self.bits[successors])
+            np.subtract.at(out_degree, predecessors, 1)
+            ready = np.unique(predecessors[out_degree[predecessors] == 0])
+
+    def reachable(self, origins: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+        """Whether a path exists from every origin to every destination.
+        Args:
+            origins (numpy.ndarray): vertex ids
+            destinations (numpy.ndarray): vertex ids, all of them among the targets of the index
+        Returns:
+            numpy.ndarray: (origins, destinations) boolean matrix
+        """
+        cols = np.searchsorted(self.target_components, self.labels[destinations])
+        words = self.bits[self.labels[origins]][:, cols // 64]
+        return ((words >> (cols % 64).astype(np.uint64)) & np.uint64(1)) == 1
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import igraph as ig
+from sklearn.neighbors import BallTree
+
+from ..graph_analysis.utils.id_dictionary import graph_attribute
+
+EARTH_RADIUS_M = 6_371_009
+
+
+def node_set_hash(G: ig.Graph) -> str:
+    """Hash of the node ids, their order and their coordinates, identifying graphs that share a stop set."""
+    digest = hashlib.sha1()
+    digest.update(graph_attribute(G, 'node_id').tobytes())
+    digest.update(_node_coordinates(G).tobytes())
+    return digest.hexdigest()
+
+
+def _node_coordinates(G: ig.Graph) -> np.ndarray:
+    """(lat, lng) coordinates of all nodes, pulled attribute-wise from the graph."""
+    return np.column_stack([np.asarray(G.vs['y'], dtype=float), np.asarray(G.vs['x'], dtype=float)])
+
+
+class SnappingIndex:
+    """Haversine ball tree over the nodes of a graph, used to snap points (neighbourhoods, POIs) onto it.
+    Args:
+        lat_lng (numpy.ndarray): (n, 2) array of node latitudes and longitudes in degrees
+    """
+
+    def __init__(self, lat_lng: np.ndarray):
+        self.tree = BallTree(np.deg2rad(lat_lng), metric='haversine')
+
+    @classmethod
+    def from_graph(cls, G: ig.Graph) -> 'SnappingIndex':
+        return cls(_node_coordinates(G))
+
+    @classmethod
+    def for_graph(cls, G: ig.Graph, cache_dir: Path) -> 'SnappingIndex':
+        """Load the index of a graph from `cache_dir`, or build and persist it there.
+        The index is keyed by node_set_hash, so all graphs with an identical stop set share one index.
+        """
+        cache_path = Path(cache_dir).joinpath(f"snapping_index_{node_set_hash(G)}.pkl")
+        if cache_path.exists():
+            with open(cache_path, 'rb') as fp:
+                return pickle.load(fp)
+
+        index = cls.from_graph(G)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, concurrent workers may build the same index
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(index, fp)
+        os.replace(tmp_path, cache_path)
+        return index
+
+    @staticmethod
+    def _points_rad(X, Y) -> np.ndarray:
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        if np.isnan(X).any() or np.isnan(Y).any():  # pragma: no cover
+            raise ValueError("`X` and `Y` cannot contain nulls")
+        return np.deg2rad(np.column_stack([Y, X]))
+
+    def nearest(self, X, Y, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Batched k-nearest node query.
+        Args:
+            X (array-like): longitudes of the points
+            Y (array-like): latitudes of the points
+            k (int, optional): number of nodes per point. Defaults to 1.
+        Returns:
+            tuple: (points, k) arrays of node ids and distances in meters, sorted by distance
+        """
+        dist, pos = self.tree.query(self._points_rad(X, Y), k=k)
+        return pos, dist * EARTH_RADIUS_M  # convert radians -> meters
+
+    def within_radius(self, X, Y, radius_m: float) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """Batched radius query, e.g. to snap points onto all stops within walking distance.
+        Args:
+            X (array-like): longitudes of the points
+            Y (array-like): latitudes of the points
+            radius_m (float): search radius in meters
+        Returns:
+            tuple: per point an array of node ids and an array of distances in meters, sorted by distance
+        """
+        pos, dist = self.tree.query_radius(self._points_rad(X, Y), r=radius_m / EARTH_RADIUS_M,
+                                           return_distance=True, sort_results=True)
+        return list(pos), [d * EARTH_RADIUS_M for d in dist]
+
+
+def nearest_nodes_to_points(G, X, Y, return_dist=False, index: SnappingIndex = None):
+    """OSMNX nearest_nodes function adapted to igraph
+    from https://github.com/gboeing/osmnx/blob/main/osmnx/distance.py: nearest_nodes
+    For a given set of geographical locations (X, Y), return the nearest nodes of the given graph G.
+    Args:
+        G (igraph.Graph): input graph
+        X (pandas.Series): X coordinates of the input points
+        Y (pandas.Series): Y coordinages of the input points
+        return_dist (bool, optional): If True the distance to the nearest node for all points is returned. Defaults to False.
+        index (SnappingIndex, optional): prebuilt index of G, built on the fly if None. Defaults to None.
+    Returns:
+        numpy.ndarray: vertex ids of the nearest nodes of graph G (and their distances in meters)
+    """
+    index = index or SnappingIndex.from_graph(G)
+    pos, dist = index.nearest(X, Y, k=1)
+
+    if return_dist:
+        return pos[:, 0], dist[:, 0]
+    else:
+        return pos[:, 0]
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from .od_routing import OD_METRICS, DEFAULT_BATCH_SIZE, RoutingGraph, od_tree_metrics, gather_od
+from .od_result_store import OD_DTYPES, META_FILE, read_od_metric, to_compact_od_metric, from_compact_od_metric
+
+
+def stop_cost_table_dir(graph_path: Path) -> Path:
+    """Directory of the stop to stop cost table of a graph, stored next to the graph file."""
+    graph_path = Path(graph_path)
+    return graph_path.with_name(f"{graph_path.with_suffix('').name}_stop_costs")
+
+
+class StopCostTable:
+    """Dense node to node table of all OD metrics of one graph, memory mapped from compact .npy files.
+    Once it exists, the OD matrices of any set of points snapped onto the graph are a gather plus the
+    access and egress walk, without any further routing.
+    Args:
+        table_dir (Path): directory written by build_stop_cost_table
+    """
+
+    def __init__(self, table_dir: Path):
+        self.table_dir = Path(table_dir)
+        self.metrics = {metric: read_od_metric(self.table_dir, metric) for metric in OD_METRICS}
+
+    def od_matrices(self, o_idx: np.ndarray, o_access: np.ndarray, d_idx: np.ndarray,
+                    d_egress: np.ndarray) -> dict:
+        """Point to point OD matrices, see od_routing.gather_od.
+        Args:
+            o_idx (numpy.ndarray): (origins, k) candidate access nodes of every origin
+            o_access (numpy.ndarray): (origins, k) walking distances in meters to those nodes
+            d_idx (numpy.ndarray): (destinations, l) candidate egress nodes of every destination
+            d_egress (numpy.ndarray): (destinations, l) walking distances in meters from those nodes
+        Returns:
+            dict: metric name -> (origins, destinations) matrix
+        """
+        return gather_od(self.metrics, o_idx, o_access, d_idx, d_egress, decode=from_compact_od_metric)
+
+
+def build_stop_cost_table(rg: RoutingGraph, table_dir: Path, tile_size: int = DEFAULT_BATCH_SIZE) -> StopCostTable:
+    """Compute the stop cost table of a graph, tile of origin rows by tile, unless it already exists.
+    Args:
+        rg (RoutingGraph): routing graph
+        table_dir (Path): directory to store the table in
+        tile_size (int, optional): number of origin rows routed and written at once. Defaults to DEFAULT_BATCH_SIZE.
+    Returns:
+        StopCostTable: the (memory mapped) table
+    """
+    table_dir = Path(table_dir)
+    if table_dir.joinpath(META_FILE).exists():
+        return StopCostTable(table_dir)
+
+    # Build into a process specific directory and move it in place once complete
+    tmp_dir = table_dir.with_name(f"{table_dir.name}.{os.getpid()}.tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    nodes = np.arange(rg.n)
+    tables = {metric: np.lib.format.open_memmap(tmp_dir.joinpath(f"{metric}.npy"), mode='w+',
+                                                dtype=OD_DTYPES[metric], shape=(rg.n, rg.n))
+              for metric in OD_METRICS}
+    for start in range(0, rg.n, tile_size):
+        od = od_tree_metrics(rg, nodes[start:start + tile_size], nodes, batch_size=tile_size)
+        for metric, table in tables.items():
+            table[start:start + tile_size] = to_compact_od_metric(metric, od[metric])
+    for table in tables.values():
+        table.flush()
+    del tables
+
+    with open(tmp_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'shape': [rg.n, rg.n], 'metrics': list(OD_METRICS)}, fp)
+
+    try:
+        os.replace(tmp_dir, table_dir)
+    except OSError:
+        # Another worker finished the same table first
+        shutil.rmtree(tmp_dir)
+
+    return StopCostTable(table_dir)
@@ -1,16 +1,25 @@
 from .utils.graph_helper_utils import (
-    ua_transit_network_to_nx,
+    ua_transit_network_to_igraph,
+    igraph_to_nx,
     append_length_attribute,
     append_hourly_edge_frequency_attribute,
     append_hourly_stop_frequency_attribute,
+    append_hourly_wait_attribute,
 )
+from .utils.graph_store import GRAPH_STORE_SUFFIX, write_graph_store
+from .utils.connection_store import build_connections, connection_store_dir, write_connection_store
+from .utils.gtfs_loading import load_gtfs_tables, gtfs_tables_to_ua_feed
+from .utils.id_dictionary import IdDictionary
 from .utils.osm_utils import get_bbox
 from .utils.frequency_computation_utils import (
+    frequency_stop_times,
     compute_stop_frequencies,
     compute_segment_frequencies,
+    gtfs_time_to_seconds,
 )
 
 from .exceptions import GraphGenerationError
+from ..gtfs_prep.fingerprint import file_date, read_aliases, record_aliases
 from ..settings import (
     logger,
     GG_DELETE_EXISTING,
@@ -18,26 +27,118 @@ from ..settings import (
     GG_GTFS_DATA_DIR,
     GG_TRANSIT_GRAPH_DATA_DIR,
     GG_CITY_NAME,
+    GG_EXPORT_NX,
+    GG_EXPORT_CONNECTIONS,
+    GG_MAX_RETRIES,
+    GG_SCRATCH_DIR,
+    GG_GTFS_CACHE_DIR,
+    GG_TIME_WINDOWS,
 )
 
 import os
 import re
+import shutil
+import tempfile
 import time
 from typing import Tuple, List, Union
 from pathlib import Path
-from zipfile import ZipFile
-from multiprocessing.pool import ThreadPool
+from multiprocessing import get_context, util
 
 import networkx as nx
+import pandas as pd
 import urbanaccess as ua
-# Prevent UA to log unnecessary output
 from urbanaccess.config import settings
-settings.log_consolse = False
+
+# Per process scratch directory, set by _init_worker
+_worker_scratch_dir = None
 
 
 def _remove_files_in_dir(curr_run_dir: Union[Path, str]):
     for f in os.listdir(curr_run_dir):
-        os.remove(curr_run_dir.joinpath(f))
+        path = curr_run_dir.joinpath(f)
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def _init_worker():
+    """Give every worker process its own scratch directory and UrbanAccess settings.
+    UrbanAccess gets its feed folders in the scratch directory instead of the shared output directories and
+    logs to a per worker folder, so that concurrent workers never touch each other's files. The scratch directory
+    is removed when the worker exits, which requires the pool to be closed and joined rather than terminated.
+    """
+    global _worker_scratch_dir
+    GG_SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+    _worker_scratch_dir = Path(tempfile.mkdtemp(prefix=f"graph_generation_{os.getpid()}_", dir=GG_SCRATCH_DIR))
+    util.Finalize(None, shutil.rmtree, args=(_worker_scratch_dir,), kwargs={'ignore_errors': True}, exitpriority=0)
+    # Prevent UA to log unnecessary output
+    settings.log_console = False
+    settings.logs_folder = str(_worker_scratch_dir.joinpath('logs'))
+    settings.data_folder = str(_worker_scratch_dir.joinpath('data'))
+
+
+def _build_and_store_graph(bbox: Tuple[float, float, float, float], gtfs_file: Path, curr_run_dir: Path):
+    # Load the part of the GTFS inside bbox straight from the zip, parsed tables are cached by content hash.
+    # UrbanAccess derives the unique_feed_id from the name of the feed folder, so the scratch folder keeps the name
+    # of the zip.
+    tables = load_gtfs_tables(gtfs_file, GG_GTFS_CACHE_DIR, bbox)
+    with tempfile.TemporaryDirectory(dir=_worker_scratch_dir) as scratch_dir:
+        loaded_feeds = gtfs_tables_to_ua_feed(tables, Path(scratch_dir).joinpath(gtfs_file.with_suffix('').name),
+                                              bbox)
+    # Stop, route, trip and agency ids are interned once per feed as soon as it is loaded, frequencies, graphs and
+    # connections refer to them by their codes
+    ids = IdDictionary.from_ua_feed(loaded_feeds)
+
+    # Frequencies cover the whole service of the feed, they are shared by the graphs of all time windows. They are
+    # counted on stop times of their own, the feed is left as UrbanAccess needs it.
+    freq_stop_times = frequency_stop_times(loaded_feeds, ids)
+    stop_freq_df = compute_stop_frequencies(loaded_feeds, ids, freq_stop_times)
+    seg_freq_df = compute_segment_frequencies(freq_stop_times)
+
+    # Extract the date from the current GTFS file
+    date = re.findall(r'\d+', str(gtfs_file))[0]
+
+    previous_day = None
+    # Sorted, so that the windows of one day follow each other
+    for day, timerange in sorted(GG_TIME_WINDOWS):
+        # Create the transit network graph from GTFS feeds using the urbanaccess library. The interpolated stop
+        # times only depend on the day, so windows of the same day reuse them.
+        logger.debug(loaded_feeds.calendar_dates.columns)
+        transit_net = ua.gtfs.network.create_transit_net(
+            gtfsfeeds_dfs=loaded_feeds,
+            calendar_dates_lookup={'unique_feed_id': f"{gtfs_file.with_suffix('').name}_1"},
+            day=day,
+            timerange=timerange,
+            use_existing_stop_times_int=day == previous_day,
+        )
+        previous_day = day
+
+        # Generate transit graph WITHOUT headways
+        G_transit = ua_transit_network_to_igraph(transit_net)
+        G_transit = append_length_attribute(G_transit)
+
+        # Append frequencies as attributes to the graph
+        append_hourly_stop_frequency_attribute(G_transit, stop_freq_df, ids)
+        append_hourly_edge_frequency_attribute(G_transit, seg_freq_df, ids)
+        append_hourly_wait_attribute(G_transit)
+        # The segments of the graph are those served in its timerange, while the frequencies cover the whole day
+        G_transit['time_window'] = list(timerange)
+
+        window = '-'.join(t[:5].replace(':', '') for t in timerange)
+        name = f'ams_pt_network_{day}_{date}_{window}'
+        graph_path = write_graph_store(G_transit, curr_run_dir.joinpath(f'{name}{GRAPH_STORE_SUFFIX}'), ids)
+        if GG_EXPORT_CONNECTIONS:
+            # The connections of the whole day departing from the start of the window on, so that trips that
+            # start inside the window can be followed until they arrive
+            start_sec, end_sec = (int(t) for t in gtfs_time_to_seconds(pd.Series(timerange)))
+            connections = build_connections(loaded_feeds.stop_times_int, loaded_feeds.stops, ids, start_sec)
+            write_connection_store(connections, connection_store_dir(graph_path),
+                                   meta={'day': day, 'date': date, 'window': [start_sec, end_sec]})
+        if GG_EXPORT_NX:
+            nx_transit = igraph_to_nx(G_transit)
+            nx.write_gpickle(nx_transit, curr_run_dir.joinpath(f'{name}.gpickle'))
+            nx.write_gml(nx_transit, curr_run_dir.joinpath(f'{name}.gml'))
 
 
 def _generate_and_store_graphs(args: Tuple[Tuple[float, float, float, float], Path]) -> Union[
@@ -45,65 +146,29 @@ def _generate_and_store_graphs(args: Tuple[Tuple[float, float, float, float], Pa
     logger.debug(f"received: {args}")
     bbox, gtfs_file = args
 
-    # Load GTFS
     curr_run_dir = GG_TRANSIT_GRAPH_DATA_DIR.joinpath(gtfs_file.with_suffix('').name)
     if os.path.exists(curr_run_dir):
         logger.warning(f"Directory {curr_run_dir} already exists{' -> removing.' if GG_DELETE_EXISTING else ''}")
         if GG_DELETE_EXISTING:
-            for file in os.listdir(curr_run_dir):
-                os.remove(curr_run_dir.joinpath(file))
-            os.rmdir(curr_run_dir)
+            shutil.rmtree(curr_run_dir)
         else:
             return curr_run_dir
-    else:
-        os.mkdir(curr_run_dir)
-
-    with ZipFile(gtfs_file) as ref:
-        ref.extractall(curr_run_dir)
-        loaded_feeds = ua.gtfs.load.gtfsfeed_to_df(gtfsfeed_path=str(curr_run_dir.absolute()),
-                                                   validation=True,
-                                                   verbose=True,
-                                                   bbox=bbox,
-                                                   remove_stops_outsidebbox=True,
-                                                   append_definitions=True)
-        _remove_files_in_dir(curr_run_dir)
-
-    # Create the transit network graph from GTFS feeds using the urbanaccess library
-    logger.debug(loaded_feeds.calendar_dates.columns)
-    try:
-        transit_net = ua.gtfs.network.create_transit_net(
-            gtfsfeeds_dfs=loaded_feeds,
-            calendar_dates_lookup={'unique_feed_id': f"{gtfs_file.with_suffix('').name}_1"},
-            day='monday',
-            timerange=['07:00:00', '09:00:00'],
-        )
-
-        # Generate transit graph WITHOUT headways
-        G_transit = ua_transit_network_to_nx(transit_net)
-        G_transit = append_length_attribute(G_transit)
-
-        # Generate stop frequency dataframe
-        stop_freq_df = compute_stop_frequencies(loaded_feeds)
-        seg_freq_df = compute_segment_frequencies(loaded_feeds)
+    os.mkdir(curr_run_dir)
 
-        # Append frequencies as attributes to the graph
-        append_hourly_stop_frequency_attribute(G_transit, stop_freq_df)
-        append_hourly_edge_frequency_attribute(G_transit, seg_freq_df)
+    for attempt in range(1, GG_MAX_RETRIES + 2):
+        try:
+            _build_and_store_graph(bbox, gtfs_file, curr_run_dir)
+            return curr_run_dir
+        except Exception as e:
+            logger.error(f"Attempt {attempt} of {GG_MAX_RETRIES + 1} failed for {gtfs_file}: {e}")
+            _remove_files_in_dir(curr_run_dir)
 
-        # Extract the date from the current GTFS file
-        date = re.findall(r'\d+', str(gtfs_file))[0]
+    os.rmdir(curr_run_dir)
+    return GraphGenerationError(curr_run_dir)
 
-        nx.write_gpickle(G_transit, curr_run_dir.joinpath(f'ams_pt_network_monday_{date}.gpickle'))
-        nx.write_gml(G_transit, curr_run_dir.joinpath(f'ams_pt_network_monday_{date}.gml'))
-    except Exception as e:
-        logger.error(str(e))
-        logger.error(f"With columns {loaded_feeds.calendar_dates.columns}\n"
-                     f"And values {loaded_feeds.calendar_dates.head(10)}")
-        _remove_files_in_dir(curr_run_dir)
-        os.rmdir(curr_run_dir)
-        return GraphGenerationError(curr_run_dir)
 
-    return curr_run_dir
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
 
 
 def generate_transit_graphs(bbox_dict: dict, gtfs_day_files: List[Path]):
@@ -122,13 +187,18 @@ def generate_transit_graphs(bbox_dict: dict, gtfs_day_files: List[Path]):
 
     inputs = [[bbox, gtfs_day_file] for gtfs_day_file in gtfs_day_files]
     logger.debug(inputs)
-    results = ThreadPool(GG_NUM_WORKERS).imap_unordered(_generate_and_store_graphs, inputs)
 
-    for r in results:
-        if isinstance(r, GraphGenerationError):
-            not_processed.append(str(r))
-        stored_graphs.append(r)
-        total_space += r.stat().st_size
+    # Every feed runs in its own process: UrbanAccess keeps module level state that threads would share
+    with get_context('fork').Pool(GG_NUM_WORKERS, initializer=_init_worker) as pool:
+        for r in pool.imap_unordered(_generate_and_store_graphs, inputs):
+            if isinstance(r, GraphGenerationError):
+                not_processed.append(str(r))
+                continue
+            stored_graphs.append(r)
+            total_space += _dir_size(r)
+        # Let the workers exit by themselves, so that they remove their scratch directories (see _init_worker)
+        pool.close()
+        pool.join()
 
     logger.info(f"###\n"
                 f"Processed {len(stored_graphs)} graphs\n"
@@ -143,6 +213,11 @@ def run_graph_generation():
     # Aggregate needed data
     bbox_dict = get_bbox(GG_CITY_NAME)
     all_gtfs_files = [GG_GTFS_DATA_DIR.joinpath(e) for e in os.listdir(GG_GTFS_DATA_DIR) if Path(e).suffix == '.zip']
+    # Days with the same service as an earlier day share its graph, only their dates are recorded
+    aliases = read_aliases(GG_GTFS_DATA_DIR)
+    all_gtfs_files = [path for path in all_gtfs_files if file_date(path) not in aliases]
+    GG_TRANSIT_GRAPH_DATA_DIR.mkdir(parents=True, exist_ok=True)
+    record_aliases(GG_TRANSIT_GRAPH_DATA_DIR, aliases)
 
     # Run the core part
     generate_transit_graphs(bbox_dict, all_gtfs_files)
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .id_dictionary import IdDictionary
+
+CONNECTION_STORE_SUFFIX = '_connections'
+META_FILE = 'meta.json'
+
+
+def connection_store_dir(graph_path: Path) -> Path:
+    """Directory of the connections of a graph, stored next to the graph."""
+    graph_path = Path(graph_path)
+    return graph_path.with_name(f"{graph_path.with_suffix('').name}{CONNECTION_STORE_SUFFIX}")
+
+
+def build_connections(stop_times: pd.DataFrame, stops: pd.DataFrame, ids: IdDictionary,
+                      start_sec: int = 0) -> Dict[str, np.ndarray]:
+    """Turn the interpolated stop times of a day into elementary connections sorted by departure time.
+    A connection is a vehicle going from one stop of a trip to its next stop without intermediate stop.
+    Args:
+        stop_times (pandas.DataFrame): UrbanAccess' stop_times_int, with 'unique_trip_id', 'unique_stop_id',
+            'stop_sequence' and 'departure_time_sec_interpolate'
+        stops (pandas.DataFrame): GTFS stops with 'stop_id', 'unique_agency_id', 'stop_lat' and 'stop_lon'
+        ids (IdDictionary): id dictionary of the feed, stops and trips are referred to by their codes
+        start_sec (int, optional): connections departing before are dropped. Defaults to 0.
+    Returns:
+        dict: 'stop_ids' (the stop ids of the dictionary, unique_stop_id is the node_id of the graph),
+        'stop_lat_lng', and the connection arrays 'dep_stop', 'arr_stop' (stop codes), 'dep_time', 'arr_time'
+        (seconds after midnight) and 'trip' (trip codes)
+    """
+    stop_lat_lng = np.full((len(ids.ids['stop']), 2), np.nan)
+    stop_codes = ids.encode('stop', stops['stop_id'].astype(str).str.cat(stops['unique_agency_id'].astype(str),
+                                                                         sep='_'))
+    stop_lat_lng[stop_codes[stop_codes >= 0]] = stops[['stop_lat', 'stop_lon']].to_numpy(dtype=float)[
+        stop_codes >= 0]
+
+    trip = ids.encode('trip', stop_times['unique_trip_id'])
+    stop = ids.encode('stop', stop_times['unique_stop_id'])
+    order = np.lexsort((stop_times['stop_sequence'].to_numpy(), trip))
+    trip, stop = trip[order], stop[order]
+    time = stop_times['departure_time_sec_interpolate'].to_numpy(dtype=np.int64)[order]
+
+    # Consecutive stop times of the same known trip, both stops known
+    keep = (trip[1:] == trip[:-1]) & (trip[1:] >= 0) & (stop[1:] >= 0) & (stop[:-1] >= 0) & \
+        (time[1:] >= time[:-1]) & (time[:-1] >= start_sec)
+    order = np.lexsort((time[1:][keep], time[:-1][keep]))
+    return {
+        'stop_ids': ids.ids['stop'],
+        'stop_lat_lng': stop_lat_lng,
+        'dep_stop': stop[:-1][keep][order].astype(np.int32),
+        'arr_stop': stop[1:][keep][order].astype(np.int32),
+        'dep_time': time[:-1][keep][order].astype(np.int32),
+        'arr_time': time[1:][keep][order].astype(np.int32),
+        'trip': trip[:-1][keep][order].astype(np.int32),
+        'n_trips': len(ids.ids['trip']),
+    }
+
+
+def write_connection_store(connections: Dict[str, np.ndarray], store_dir: Path, meta: dict = None) -> Path:
+    """Store the arrays of build_connections as one .npy file each.
+    Args:
+        connections (dict): as returned by build_connections
+        store_dir (Path): directory to write to, replaced if it exists
+        meta (dict, optional): extra JSON serialisable information (e.g. the time window). Defaults to None.
+    Returns:
+        Path: store_dir
+    """
+    store_dir = Path(store_dir)
+    # Write next to the final location first, so that readers never see a half written store
+    tmp_dir = store_dir.with_name(f"{store_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    arrays = [name for name, values in connections.items() if isinstance(values, np.ndarray)]
+    for name in arrays:
+        np.save(tmp_dir.joinpath(f"{name}.npy"), connections[name])
+    with open(tmp_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'arrays': arrays, 'n_trips': int(connections['n_trips']),
+                   'n_connections': len(connections['dep_time']), **(meta or {})}, fp)
+
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+    return store_dir
+
+
+def read_connection_store(store_dir: Path, mmap: bool = True) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Read a connection store.
+    Returns:
+        tuple: the meta data and the arrays written by write_connection_store
+    """
+    store_dir = Path(store_dir)
+    with open(store_dir.joinpath(META_FILE)) as fp:
+        meta = json.load(fp)
+    return meta, {name: np.load(store_dir.joinpath(f"{name}.npy"), mmap_mode='r' if mmap else None)
+                  for name in meta['arrays']}
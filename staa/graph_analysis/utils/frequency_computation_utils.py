@@ -1,69 +1,149 @@
-import datetime
-
 import numpy as np
 import pandas as pd
 import urbanaccess as ua
 
-
-def compute_stop_frequencies(ua_feed: ua.feeds) -> pd.DataFrame:
-    # Drop all runs where the arrival time is after midnight
-    rect_arrivals = ua_feed.stop_times['arrival_time'].apply(lambda x: int(x.split(':')[0]))
-    rect_departures = ua_feed.stop_times['departure_time'].apply(lambda x: int(x.split(':')[0]))
-    ua_feed.stop_times = ua_feed.stop_times[rect_arrivals < 24]
-    ua_feed.stop_times = ua_feed.stop_times[rect_departures < 24]
-
-    ua_feed.stops = ua_feed.stops[ua_feed.stops['unique_agency_id'] != 'nan']
-    ua_feed.stops["stop_id"] = ua_feed.stops[["stop_id", "unique_agency_id"]].agg('_'.join, axis=1)
-    ua_feed.stop_times = ua_feed.stop_times[ua_feed.stop_times['unique_agency_id'] != 'nan']
-    ua_feed.stop_times["stop_id"] = ua_feed.stop_times[["stop_id", "unique_agency_id"]].agg('_'.join, axis=1)
-
-    date = datetime.datetime.strptime(str(ua_feed.calendar_dates.date.unique()[0]), '%Y%m%d')
-    day_times = pd.to_datetime(pd.Series([date + datetime.timedelta(hours=e) for e in range(25)]))
-
-    ua_feed.stop_times['arrival_time'] = pd.to_datetime(
-        ua_feed.stop_times['arrival_time'].apply(lambda x: str(date.date()) + ' ' + x))
-    ua_feed.stop_times['departure_time'] = pd.to_datetime(
-        ua_feed.stop_times['departure_time'].apply(lambda x: str(date.date()) + ' ' + x))
+from .id_dictionary import IdDictionary
+
+
+HOURS_PER_DAY = 24
+SECONDS_PER_HOUR = 3600
+MINUTES_PER_HOUR = 60
+
+
+def gtfs_time_to_seconds(times: pd.Series) -> np.ndarray:
+    """Vectorised conversion of GTFS HH:MM:SS times to seconds since midnight.
+    GTFS hours may exceed 23 for trips running after midnight, those are kept as is.
+    Args:
+        times (pandas.Series): GTFS time strings
+    Returns:
+        numpy.ndarray: seconds since midnight of the service day, nan where the time is missing or malformed
+    """
+    hms = times.astype('string').str.split(':', n=2, expand=True).reindex(columns=range(3))
+    hms = hms.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    return hms @ np.array([SECONDS_PER_HOUR, 60, 1], dtype=float)
+
+
+def expected_waits(frequencies: np.ndarray, bin_minutes: float = MINUTES_PER_HOUR) -> np.ndarray:
+    """Expected wait of a passenger arriving at random, half of the mean headway in every time bin.
+    Args:
+        frequencies (numpy.ndarray): number of vehicles per bin, e.g. the hourly frequency matrices of a graph
+        bin_minutes (float, optional): width of the bins in minutes. Defaults to an hour.
+    Returns:
+        numpy.ndarray: float32 waits in minutes shaped like `frequencies`, inf for bins without any vehicle and nan
+        where the frequency is unknown
+    """
+    with np.errstate(divide='ignore'):
+        return (bin_minutes / (2 * np.asarray(frequencies, dtype=np.float32))).astype(np.float32)
+
+
+def frequency_stop_times(ua_feed: ua.feeds, ids: IdDictionary, keep_after_midnight: bool = False) -> pd.DataFrame:
+    """The stop times counted by compute_stop_frequencies and compute_segment_frequencies, the feed is left as is.
+    Args:
+        ua_feed (urbanaccess.gtfsfeeds_dataframe): loaded GTFS feed
+        ids (IdDictionary): id dictionary of the feed (see IdDictionary.from_ua_feed)
+        keep_after_midnight (bool, optional): If True, arrivals and departures at or after 24:00:00 are kept and
+            counted in their hour modulo 24, otherwise they are dropped. Defaults to False.
+    Returns:
+        pandas.DataFrame: a new frame with the 'trip_id', the 'stop_code' and the arrival time in seconds
+        'arrival_time_sec' of the stop times of known agencies, in the order of the feed
+    """
+    stop_times = ua_feed.stop_times
+    arrival_sec = gtfs_time_to_seconds(stop_times['arrival_time'])
+    keep = stop_times['unique_agency_id'].to_numpy() != 'nan'
+    if not keep_after_midnight:
+        # Drop all runs where the arrival or departure time is after midnight
+        day = SECONDS_PER_HOUR * HOURS_PER_DAY
+        keep &= (arrival_sec < day) & (gtfs_time_to_seconds(stop_times['departure_time']) < day)
+    stop_times = stop_times[keep]
+    return pd.DataFrame({
+        'trip_id': stop_times['trip_id'].to_numpy(),
+        'stop_code': ids.encode_unique('stop', stop_times, 'stop_id'),
+        'arrival_time_sec': arrival_sec[keep],
+    })
+
+
+def compute_stop_frequencies(ua_feed: ua.feeds, ids: IdDictionary, stop_times: pd.DataFrame) -> pd.DataFrame:
+    """Number of arrivals at every stop for every hour of the day, counted in a single pass over stop_times.
+    Args:
+        ua_feed (urbanaccess.gtfsfeeds_dataframe): loaded GTFS feed, only read
+        ids (IdDictionary): id dictionary of the feed (see IdDictionary.from_ua_feed)
+        stop_times (pandas.DataFrame): stop times of the feed, see frequency_stop_times
+    Returns:
+        pandas.DataFrame: stops indexed by their stop code, with their name, location and the integer counts
+        freq_h_0 to freq_h_23
+    """
+    stops = ua_feed.stops[ua_feed.stops['unique_agency_id'] != 'nan']
 
     # ## Stop frequencies
-    stop_freq = ua_feed.stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]]
-    stop_freq = stop_freq.drop_duplicates()
-
-    for h in range(24):
-        stop_freq[f"freq_h_{h}"] = np.zeros(len(stop_freq))
-
-    for i in range(len(day_times[:24])):
-        served_stops = ua_feed.stop_times[(ua_feed.stop_times.arrival_time >= day_times[i]) & (
-                ua_feed.stop_times.arrival_time <= day_times[i + 1])]
-        served_stops_count = served_stops.groupby('stop_id').size()
-        served_stops_count_ids = served_stops_count.index
-        stop_freq.loc[stop_freq['stop_id'].isin(served_stops_count_ids), f'freq_h_{i}'] = served_stops_count.values
-
-    stop_freq.index = stop_freq['stop_id']
-    stop_freq = stop_freq.drop(columns=['stop_id'])
-    return stop_freq
-
-
-def compute_segment_frequencies(ua_feed: ua.feeds) -> pd.DataFrame:
-
-    date = datetime.datetime.strptime(str(ua_feed.calendar_dates.date.unique()[0]), '%Y%m%d')
-    day_times = pd.to_datetime(pd.Series([date + datetime.timedelta(hours=e) for e in range(25)]))
-
-    # Generate arrival_stop_id for each trip
-    ua_feed.stop_times["stop_id_provenance"] = ua_feed.stop_times.groupby('trip_id')["stop_id"].shift(1)
-
-    seg_freq = ua_feed.stop_times[["stop_id", "stop_id_provenance"]]
-    seg_freq = seg_freq.dropna()
-    seg_freq = seg_freq.drop_duplicates()
-    seg_freq.set_index(["stop_id", "stop_id_provenance"], inplace=True)
-
-    for h in range(24):
-        seg_freq[f"freq_h_{h}"] = np.zeros(len(seg_freq))
-
-    for i in range(len(day_times[:24])):
-        served_stops = ua_feed.stop_times[(ua_feed.stop_times.arrival_time >= day_times[i]) & (
-                ua_feed.stop_times.arrival_time <= day_times[i + 1])]
-        serv_counts = served_stops.groupby(["stop_id", "stop_id_provenance"]).size()
-        seg_freq.loc[serv_counts.index, f"freq_h_{i}"] = serv_counts.values
-
+    stop_freq = stops[["stop_name", "stop_lat", "stop_lon"]].set_axis(
+        pd.Index(ids.encode_unique('stop', stops, 'stop_id'), name='stop_code'))
+    stop_freq = stop_freq[(stop_freq.index >= 0) & ~stop_freq.index.duplicated()]
+
+    # One grouped count over (stop, hour) codes
+    stop_codes = stop_times['stop_code'].to_numpy()
+    arrival_sec = stop_times['arrival_time_sec'].to_numpy()
+    valid = (stop_codes >= 0) & ~np.isnan(arrival_sec)
+    hours = (arrival_sec[valid] // SECONDS_PER_HOUR).astype(np.int64) % HOURS_PER_DAY
+    counts = np.bincount(stop_codes[valid].astype(np.int64) * HOURS_PER_DAY + hours,
+                         minlength=len(ids.ids['stop']) * HOURS_PER_DAY)
+
+    hourly = pd.DataFrame(counts.reshape(-1, HOURS_PER_DAY)[stop_freq.index.to_numpy()], index=stop_freq.index,
+                          columns=[f"freq_h_{h}" for h in range(HOURS_PER_DAY)])
+    return pd.concat([stop_freq, hourly], axis=1)
+
+
+def time_bins(width_sec: int, start_sec: int = 0, end_sec: int = HOURS_PER_DAY * SECONDS_PER_HOUR) -> np.ndarray:
+    """Edges of equally wide time bins, e.g. time_bins(15 * 60) for quarter hours.
+    Args:
+        width_sec (int): bin width in seconds
+        start_sec (int, optional): start of the first bin in seconds since midnight. Defaults to 0.
+        end_sec (int, optional): end of the last bin in seconds since midnight. Defaults to 24h.
+    Returns:
+        numpy.ndarray: bin edges in seconds since midnight
+    """
+    return np.arange(start_sec, end_sec + width_sec, width_sec)
+
+
+def compute_segment_frequencies(stop_times: pd.DataFrame, bin_edges: np.ndarray = None) -> pd.DataFrame:
+    """Number of trips over every segment (pair of consecutive stops of a trip) per time bin, in a single grouped
+    pass over the stop codes of the segments.
+    Arrivals are binned by their 'arrival_time_sec' modulo 24 hours at the segment's end stop.
+    Args:
+        stop_times (pandas.DataFrame): stop times of the feed, see frequency_stop_times
+        bin_edges (numpy.ndarray, optional): increasing bin edges in seconds since midnight (see time_bins),
+            custom windows are allowed. Defaults to hourly bins over the whole day.
+    Returns:
+        pandas.DataFrame: integer counts indexed by the stop codes (stop_code, stop_code_provenance) of the end and
+        start stop of the segments. Columns are freq_h_0 to
+        freq_h_23 for the default hourly bins, freq_b_0 to freq_b_{n-1} otherwise, the edges are kept in
+        attrs['bin_edges'].
+    """
+    hourly = bin_edges is None
+    bin_edges = time_bins(SECONDS_PER_HOUR) if hourly else np.asarray(bin_edges, dtype=float)
+    n_bins = len(bin_edges) - 1
+
+    # Trips keep their stop order, a stable sort only groups them
+    order = np.argsort(stop_times['trip_id'].to_numpy(), kind='stable')
+    trips = stop_times['trip_id'].to_numpy()[order]
+    stop_codes = stop_times['stop_code'].to_numpy(dtype=np.int64)[order]
+    n_stops = int(stop_codes.max()) + 1 if len(stop_codes) else 0
+    arrival_sec = stop_times['arrival_time_sec'].to_numpy()[order] % (HOURS_PER_DAY * SECONDS_PER_HOUR)
+
+    # Generate the arrival stop's provenance stop (the previous stop of the same trip), both stops known
+    provenance_codes = np.r_[-1, stop_codes[:-1]]
+    has_provenance = np.r_[False, trips[1:] == trips[:-1]] & (stop_codes >= 0) & (provenance_codes >= 0)
+    segment_keys = stop_codes[has_provenance] * n_stops + provenance_codes[has_provenance]
+    segments, segment_codes = np.unique(segment_keys, return_inverse=True)
+    segment_codes = segment_codes.ravel()
+
+    bins = np.searchsorted(bin_edges, arrival_sec[has_provenance], side='right') - 1
+    in_bins = (bins >= 0) & (bins < n_bins)
+    counts = np.bincount(segment_codes[in_bins] * n_bins + bins[in_bins], minlength=len(segments) * n_bins)
+
+    index = pd.MultiIndex.from_arrays([segments // n_stops, segments % n_stops],
+                                      names=["stop_code", "stop_code_provenance"])
+    prefix = 'freq_h' if hourly else 'freq_b'
+    seg_freq = pd.DataFrame(counts.reshape(len(segments), n_bins).astype(np.int32), index=index,
+                            columns=[f"{prefix}_{b}" for b in range(n_bins)])
+    seg_freq.attrs['bin_edges'] = bin_edges.tolist()
     return seg_freq
@@ -1,7 +1,6 @@
 # From Dimitris Michealidis' Peoject-A
 # https://github.com/dimichai
 
-from haversine import haversine
 import time
 
 import numpy as np
@@ -9,200 +8,246 @@ import pandas as pd
 import osmnx as ox
 
 import networkx as nx
+import igraph as ig
+
+from sklearn.neighbors import BallTree
 
 from .speeds import MetricTravelSpeeds
+from .frequency_computation_utils import expected_waits
+from .id_dictionary import IdDictionary
+from ..constants import EARTH_RADIUS_M
 import logging
+from typing import Tuple
 
 
 logger = logging.getLogger(__file__)
 
+# Maximum walking distance of a transfer edge
+MAX_TRANSFER_DISTANCE_KM = 1
+
 
-def append_length_attribute(ua_network: nx.MultiDiGraph) -> nx.MultiDiGraph:
+def append_length_attribute(ua_network: ig.Graph) -> ig.Graph:
     """ UrbanAccess networks do not have a 'length' attribute (they have 'weight' instead.)
     We want to add the length attribute because it is needed for some osmnx methods.
     We will set it to the same value as the weight.
     Args:
-        ua_network (urbanaccess.network.urbanaccess_network):
+        ua_network (igraph.Graph): transit graph built by ua_transit_network_to_igraph
 
     Returns:
-        urbanaccess.network.urbanaccess_network: [description]
+        igraph.Graph: the same graph with 'length' and 'travel_time' edge attributes
     """
-    ua_network_weights = {}
-    for node1, node2, key, data in ua_network.edges(data=True, keys=True):
-        ua_network_weights[(node1, node2, key)] = data['weight']
-
-    nx.set_edge_attributes(ua_network, ua_network_weights, "length")
-    nx.set_edge_attributes(ua_network, ua_network_weights, "travel_time")
+    ua_network.es['length'] = ua_network.es['weight']
+    ua_network.es['travel_time'] = ua_network.es['weight']
 
     return ua_network
 
 
-def append_hourly_stop_frequency_attribute(ua_network: nx.MultiDiGraph, hourly_stop_frequency_df: pd.DataFrame):
+def _frequency_matrix(frequency_df: pd.DataFrame, keys: pd.Index) -> Tuple[np.ndarray, np.ndarray, list]:
+    """Align graph keys with the index of a frequency table in a single vectorised lookup.
+    Returns:
+        tuple: boolean mask of the keys found in the table, (keys, frequency columns) float32 matrix (nan where not
+        found) and the names of the frequency columns
+    """
+    columns = [column for column in frequency_df.columns if str(column).startswith('freq_')]
+    positions = frequency_df.index.get_indexer(keys)
+    found = positions >= 0
+    matrix = np.full((len(keys), len(columns)), np.nan, dtype=np.float32)
+    matrix[found] = frequency_df[columns].to_numpy(dtype=np.float32)[positions[found]]
+    return found, matrix, columns
+
+
+def append_hourly_stop_frequency_attribute(ua_network: ig.Graph, hourly_stop_frequency_df: pd.DataFrame,
+                                           ids: IdDictionary):
     """
-    This function adds the 'hourly_frequency' attribute from the hourly_stop_frequency_df
-    to a UrbanAccess network
-    :param ua_network:
-    :param hourly_stop_frequency_df:
+    This function adds the stop frequencies from the hourly_stop_frequency_df to a transit graph, joining the stop
+    codes of all nodes with its index at once. They are stored as the (nodes, bins) graph attribute
+    'stop_frequencies' (nan for unknown stops) with the bin names in 'stop_frequency_columns'
+    :param ua_network: transit graph built by ua_transit_network_to_igraph
+    :param hourly_stop_frequency_df: frequencies indexed by stop code (see compute_stop_frequencies)
+    :param ids: id dictionary of the feed the frequencies were computed with
     :return:
     """
-    ua_network_stop_frequencies = {}
-    for node, _ in ua_network.nodes(data=True):
-        try:
-            data = hourly_stop_frequency_df.loc[node, :]
-            data_dict = data.to_dict()
-            ua_network_stop_frequencies[node] = data_dict
-        except KeyError as e:
-            logger.warning(f"couldn't identify {node} in stop_ids")
+    node_codes = ids.encode('stop', ua_network.vs['node_id'])
+    found, matrix, columns = _frequency_matrix(hourly_stop_frequency_df, pd.Index(node_codes))
+    if not found.all():
+        logger.warning(f"couldn't identify {np.count_nonzero(~found)} of {len(found)} nodes in stop_ids")
 
-    nx.set_node_attributes(ua_network, ua_network_stop_frequencies, "stop_frequencies")
+    ua_network['stop_frequencies'] = matrix
+    ua_network['stop_frequency_columns'] = columns
 
     return ua_network
 
 
-def append_hourly_edge_frequency_attribute(ua_network: nx.MultiDiGraph, hourly_leg_frequency_df: pd.DataFrame):
+def append_hourly_edge_frequency_attribute(ua_network: ig.Graph, hourly_leg_frequency_df: pd.DataFrame,
+                                           ids: IdDictionary):
     """
-
-    :param ua_network:
-    :param hourly_leg_frequency_df:
+    This function adds the segment frequencies from the hourly_leg_frequency_df to a transit graph, joining the
+    stop codes of all edges (node1, node2) with the (stop_code, stop_code_provenance) index as (node2, node1) at
+    once. They are stored as the (edges, bins) graph attribute 'segment_frequencies' with the bin names in
+    'segment_frequency_columns'
+    :param ua_network: transit graph built by ua_transit_network_to_igraph
+    :param hourly_leg_frequency_df: frequencies indexed by (stop_code, stop_code_provenance)
+        (see compute_segment_frequencies)
+    :param ids: id dictionary of the feed the frequencies were computed with
     :return:
     """
-    ua_network_edge_frequencies = {}
-    for node1, node2, key, data in ua_network.edges(data=True, keys=True):
-        try:
-            data = hourly_leg_frequency_df.loc[(node2, node1), :]
-            data_dict = data.to_dict()
-            ua_network_edge_frequencies[(node1, node2, key)] = data_dict
-        except KeyError as e:
-            logger.warning(f"couldn't identify {(node2, node1)} in (stop_id, provenance_stop_id) index")
+    node_codes = ids.encode('stop', ua_network.vs['node_id'])
+    edges = np.array(ua_network.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    found, matrix, columns = _frequency_matrix(
+        hourly_leg_frequency_df, pd.MultiIndex.from_arrays([node_codes[edges[:, 1]], node_codes[edges[:, 0]]]))
+    if not found.all():
+        logger.warning(f"couldn't identify {np.count_nonzero(~found)} of {len(found)} edges "
+                       f"in (stop_id, provenance_stop_id) index")
 
-    nx.set_edge_attributes(ua_network, ua_network_edge_frequencies, "segment_frequencies")
+    ua_network['segment_frequencies'] = matrix
+    ua_network['segment_frequency_columns'] = columns
 
     return ua_network
 
 
-def parse_nx_node(row, attr, idcol):
-    """Parses nodes into nx-format"""
-    attr = row[attr].copy()
-    return (row[idcol], attr.to_dict())
-
+def append_hourly_wait_attribute(ua_network: ig.Graph):
+    """
+    This function derives the expected waits from the frequency matrices of a transit graph (see
+    append_hourly_stop_frequency_attribute and append_hourly_edge_frequency_attribute). They are stored as the
+    (nodes, bins) graph attribute 'stop_waits' and the (edges, bins) graph attribute 'segment_waits', in minutes
+    (inf where there is no service in a bin, nan where the frequency is unknown), binned like the frequencies
+    :param ua_network: transit graph with frequency matrices
+    :return:
+    """
+    ua_network['stop_waits'] = expected_waits(ua_network['stop_frequencies'])
+    ua_network['segment_waits'] = expected_waits(ua_network['segment_frequencies'])
 
-def parse_nx_edge(row, attr_cols, fr, to):
-    """Parses edges into nx-format"""
-    idx = row.name
-    attr = row[attr_cols].copy().to_dict()
-    return (row[fr], row[to], idx, attr)
+    return ua_network
 
 
-def ua_transit_network_to_nx(transit_net) -> nx.MultiDiGraph:
-    """Convert an urbanaccess transit network to networkx.
-    ua2nx needs a transit+walk network to work, thus here the function is adjusted for when
-    only a tranist network is available.
+def ua_transit_network_to_igraph(transit_net) -> ig.Graph:
+    """Convert an urbanaccess transit network to igraph.
+    Trips between the same pair of nodes are aggregated into a single edge with their median travel time
+    (the other edge attributes are those of the first trip), all attributes are set column-wise.
 
     Args:
-        transit_net (urbanaccess.network.urbanaccess_network): transit network to convert to networkx.
+        transit_net (urbanaccess.network.urbanaccess_network): transit network to convert to igraph.
+    Returns:
+        igraph.Graph: directed graph with a 'node_id' vertex attribute and the UrbanAccess edge attributes
     """
-    nodes = transit_net.transit_nodes
-    edges = transit_net.transit_edges
-    graph = nx.MultiDiGraph()
-
-    # Reset index for nodes to get the integer version of the node_id
-    nodes = nodes.reset_index()
     fr = 'node_id_from'
     to = 'node_id_to'
     nodeid = 'node_id'
 
+    # Reset index for nodes to get the integer version of the node_id
+    nodes = transit_net.transit_nodes.reset_index()
+    edges = transit_net.transit_edges
+
     # Don't make an edge out of every trip, instead aggregate them using the median travel time.
-    edges = edges.groupby([fr, to])['weight'].agg('median').reset_index() \
-        .merge(edges, on=[fr, to]).rename(columns={'weight' + '_x': 'weight'}) \
-        .drop_duplicates([fr, to]) \
-        .drop('weight' + '_y', axis=1)
+    first = edges.drop_duplicates([fr, to]).set_index([fr, to]).sort_index()
+    first['weight'] = edges.groupby([fr, to])['weight'].median().reindex(first.index).values
+    first = first.reset_index()
 
     edge_attr = ['node_id_from', 'node_id_to', 'weight', 'net_type', 'route_type',
                  'sequence', 'unique_agency_id', 'unique_route_id',
                  'unique_trip_id']
-    exp_edge_attr = edge_attr
-    exp_node_attr = list(nodes.columns)
 
-    nodes['nx_node'] = nodes.apply(parse_nx_node, attr=exp_node_attr, idcol=nodeid, axis=1)
-    edges['nx_edge'] = edges.apply(parse_nx_edge, attr_cols=exp_edge_attr, fr=fr, to=to, axis=1)
+    # Edge endpoints missing from the node table become nodes without attributes
+    node_index = pd.Index(nodes[nodeid])
+    missing = pd.Index(pd.unique(np.concatenate([first[fr].values, first[to].values]))).difference(node_index)
+    nodes = pd.concat([nodes, pd.DataFrame({nodeid: missing})], ignore_index=True)
+    node_index = pd.Index(nodes[nodeid])
 
-    graph.add_nodes_from(nodes['nx_node'].to_list())
-    graph.add_edges_from(edges['nx_edge'].to_list())
+    graph = ig.Graph(n=len(nodes), directed=True,
+                     edges=np.column_stack([node_index.get_indexer(first[fr]), node_index.get_indexer(first[to])]))
+    for column in nodes.columns:
+        graph.vs[column] = nodes[column].tolist()
+    for column in edge_attr:
+        if column in first.columns:
+            graph.es[column] = first[column].tolist()
 
-    graph.graph['crs'] = {'init': 'epsg:4326'}
-    graph.graph['name'] = edges['unique_agency_id'].unique()[0]
+    graph['crs'] = {'init': 'epsg:4326'}
+    graph['name'] = edges['unique_agency_id'].unique()[0]
 
     return graph
 
 
-def add_transfer_edges(G, headways):
-    """ Adds edges between all nodes in the network by taking the avg walking speed/euclidean distance
-    between each node. This is done to enable inter-layer edges on transit networks.
+def igraph_to_nx(graph: ig.Graph) -> nx.MultiDiGraph:
+    """Export a transit graph built by ua_transit_network_to_igraph to networkx, keyed by node_id.
+    The frequency matrices become 'stop_frequencies' / 'segment_frequencies' dicts on the nodes and edges that
+    have them.
+    """
+    def attributes(seq, matrix_name, columns_name):
+        names = seq.attributes()
+        records = [dict(zip(names, values)) for values in zip(*(seq[name] for name in names))] if names \
+            else [{} for _ in seq]
+        if matrix_name in graph.attributes():
+            columns = graph[columns_name]
+            for record, row in zip(records, np.asarray(graph[matrix_name])):
+                if not np.isnan(row).all():
+                    record[matrix_name] = dict(zip(columns, row.tolist()))
+        return records
+
+    node_ids = graph.vs['node_id']
+    nx_graph = nx.MultiDiGraph()
+    nx_graph.add_nodes_from(zip(node_ids, attributes(graph.vs, 'stop_frequencies', 'stop_frequency_columns')))
+    edge_attributes = attributes(graph.es, 'segment_frequencies', 'segment_frequency_columns')
+    nx_graph.add_edges_from((node_ids[u], node_ids[v], key, attr) for key, ((u, v), attr) in
+                            enumerate(zip(graph.get_edgelist(), edge_attributes)))
+    nx_graph.graph.update({name: graph[name] for name in graph.attributes()
+                           if not isinstance(graph[name], np.ndarray) and not name.endswith('_frequency_columns')})
+
+    return nx_graph
+
+
+def ua_transit_network_to_nx(transit_net) -> nx.MultiDiGraph:
+    """Convert an urbanaccess transit network to networkx, see ua_transit_network_to_igraph.
+    ua2nx needs a transit+walk network to work, thus here the function is adjusted for when
+    only a tranist network is available.
 
     Args:
-        G : networkx graph
+        transit_net (urbanaccess.network.urbanaccess_network): transit network to convert to networkx.
     """
+    return igraph_to_nx(ua_transit_network_to_igraph(transit_net))
 
-    def create_edge(orig, dest):
-        orig = nodes.iloc[orig]
-        dest = nodes.iloc[dest]
-
-        # Do not add loop edges.
-        if orig['node_id'] == dest['node_id']:
-            return None
-
-        dist = haversine((orig['x'], orig['y']), (dest['x'], dest['y']))
-
-        # Only add a new edge if the distance between the nodes is max 1 kilometer
-        if dist > 1:
-            return None
-
-        travel_time = dist / MetricTravelSpeeds.WALKING.value * 60
-        # 0 means no connection, we prefer a very small number instead.
-        # This is to avoid re-adding an edge after the previous add had weight=0 (check loop below)
-        if travel_time == 0:
-            travel_time = 0.0001
-
-        # Add headway time if available
-        if not np.isnan(dest['mean_hw']):
-            travel_time += dest['mean_hw']
-
-        return (
-            orig['node_id'],
-            dest['node_id'],
-            {
-                'node_id_from': orig['node_id'],
-                'node_id_to': dest['node_id'],
-                'length': dist,
-                'weight': travel_time,
-                'travel_time': travel_time,
-                'net_type': 'walking_estimation'
-            }
-        )
-
-    nodes = ox.graph_to_gdfs(G, edges=False)
-    nodes = pd.merge(nodes, headways, how='left', left_on='node_id', right_on='unique_stop_id')
 
-    adj_mx = nx.to_numpy_array(G)
+def add_transfer_edges(G, headways, max_distance_km: float = MAX_TRANSFER_DISTANCE_KM):
+    """ Adds walking edges between all nodes within max_distance_km of each other, with the travel time of the
+    avg walking speed over their great circle distance plus the headway of the destination. This is done to
+    enable inter-layer edges on transit networks.
+    Candidate pairs come from a single haversine radius query, so memory grows with the number of transfers.
+    Pairs that are already connected get no transfer edge.
 
+    Args:
+        G : networkx graph
+        headways (pandas.DataFrame): mean headway 'mean_hw' per 'unique_stop_id'
+        max_distance_km (float, optional): maximum walking distance. Defaults to MAX_TRANSFER_DISTANCE_KM.
+    """
     start_time = time.time()
-    edges_to_add = []
-    # for i in G.nodes():
-    for i, node_i in enumerate(G.nodes()):
-        for j, node_j in enumerate(G.nodes()):
-            if adj_mx[i][j] == 0:
-                new_edge = create_edge(i, j)
-                if new_edge:
-                    edges_to_add.append(new_edge)
-                    adj_mx[i][j] = new_edge[2]['weight']
-            if adj_mx[j][i] == 0:
-                new_edge = create_edge(j, i)
-                if new_edge:
-                    edges_to_add.append(new_edge)
-                    adj_mx[j][i] = new_edge[2]['weight']
-
-            print(f'\r Completed: {len(edges_to_add)} paths.', end='')
-
-    G.add_edges_from(edges_to_add)
-    print(f'Total time to connect the network: {round((time.time() - start_time) / 60, 2)} minutes')
+    nodes = ox.graph_to_gdfs(G, edges=False)
+    nodes = pd.merge(nodes, headways, how='left', left_on='node_id', right_on='unique_stop_id')
+    node_ids = nodes['node_id'].to_numpy()
+
+    lat_lng = np.deg2rad(nodes[['y', 'x']].to_numpy(dtype=float))
+    neighbours, distances = BallTree(lat_lng, metric='haversine').query_radius(
+        lat_lng, r=max_distance_km * 1000 / EARTH_RADIUS_M, return_distance=True)
+    orig = np.repeat(np.arange(len(nodes)), [len(n) for n in neighbours])
+    dest = np.concatenate(neighbours).astype(np.int64)
+    dist = np.concatenate(distances) * EARTH_RADIUS_M / 1000  # radians -> kilometers
+
+    # Do not add loop edges, nor edges between nodes that are already connected.
+    node_index = pd.Index(node_ids)
+    existing = [(u, v) for u, v in G.edges()]
+    existing_keys = node_index.get_indexer([u for u, _ in existing]).astype(np.int64) * len(nodes) + \
+        node_index.get_indexer([v for _, v in existing])
+    keep = (node_ids[orig] != node_ids[dest]) & ~np.isin(orig * len(nodes) + dest, existing_keys)
+    orig, dest, dist = orig[keep], dest[keep], dist[keep]
+
+    travel_time = dist / MetricTravelSpeeds.WALKING.value * 60
+    # 0 means no connection, we prefer a very small number instead.
+    travel_time[travel_time == 0] = 0.0001
+    # Add headway time if available
+    headway = nodes['mean_hw'].to_numpy(dtype=float)[dest]
+    travel_time += np.where(np.isnan(headway), 0, headway)
+
+    G.add_edges_from(
+        (u, v, {'node_id_from': u, 'node_id_to': v, 'length': d, 'weight': t, 'travel_time': t,
+                'net_type': 'walking_estimation'})
+        for u, v, d, t in zip(node_ids[orig], node_ids[dest], dist.tolist(), travel_time.tolist()))
+    logger.info(f"Added {len(orig)} transfer edges in {round((time.time() - start_time) / 60, 2)} minutes")
     return G
@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import igraph as ig
+
+from .id_dictionary import GRAPH_IDS_ATTRIBUTE, NODE_ID_ATTRIBUTES, EDGE_ID_ATTRIBUTES, IdDictionary
+
+GRAPH_STORE_SUFFIX = '.graph'
+META_FILE = 'meta.json'
+# Array valued graph attributes holding one row per edge, reordered with the edges
+EDGE_MATRICES = ('segment_frequencies', 'segment_waits')
+IDS_DIR = 'ids'
+
+
+def _columnar(values: list) -> np.ndarray:
+    """Attribute values as a fixed width array, missing values of text columns become empty strings."""
+    array = np.asarray(values)
+    if array.dtype == object:
+        array = np.asarray(['' if value is None else str(value) for value in values])
+    return array
+
+
+def write_graph_store(G: ig.Graph, store_dir: Path, ids: IdDictionary = None) -> Path:
+    """Store a graph as CSR topology plus one .npy file per vertex and edge attribute.
+    Edges are stored sorted by source vertex, so `indptr`/`indices` form the CSR adjacency and the edge attribute
+    arrays follow the same order. Array valued graph attributes (e.g. the hourly frequencies) are stored as .npy
+    files, those listed in EDGE_MATRICES reordered with the edges, the other graph attributes go to meta.json.
+    With an id dictionary the stop, route, trip and agency id attributes (see id_dictionary) are stored as int32
+    codes, the dictionary is stored with them.
+    Args:
+        G (igraph.Graph): directed graph, its id attributes may already be codes of its 'ids' dictionary (see
+            read_graph_store)
+        store_dir (Path): directory to write to, replaced if it exists
+        ids (IdDictionary, optional): id dictionary of the feed, ids of the graph missing from it are added to a
+            copy. Defaults to None, storing the ids as strings unless the graph holds codes.
+    Returns:
+        Path: store_dir
+    """
+    store_dir = Path(store_dir)
+    # Write next to the final location first, so that readers never see a half written store
+    tmp_dir = store_dir.with_name(f"{store_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    edges = np.array(G.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(edges[:, 0], kind='stable')
+    indptr = np.r_[0, np.cumsum(np.bincount(edges[:, 0], minlength=G.vcount()))].astype(np.int64)
+    np.save(tmp_dir.joinpath('indptr.npy'), indptr)
+    np.save(tmp_dir.joinpath('indices.npy'), edges[order, 1])
+
+    interned = {'node': {}, 'edge': {}}
+    if GRAPH_IDS_ATTRIBUTE in G.attributes():
+        # Read with its codes, they are stored as they are
+        ids = G[GRAPH_IDS_ATTRIBUTE]
+        interned = {'node': {name: kind for name, kind in NODE_ID_ATTRIBUTES.items() if name in G.vs.attributes()},
+                    'edge': {name: kind for name, kind in EDGE_ID_ATTRIBUTES.items() if name in G.es.attributes()}}
+    elif ids is not None:
+        ids = IdDictionary(ids.ids)
+        for prefix, seq, attributes in (('node', G.vs, NODE_ID_ATTRIBUTES), ('edge', G.es, EDGE_ID_ATTRIBUTES)):
+            interned[prefix] = {name: kind for name, kind in attributes.items() if name in seq.attributes()}
+            for name, kind in interned[prefix].items():
+                ids.add(kind, _columnar(seq[name]))
+
+    for prefix, seq, seq_order in (('node', G.vs, slice(None)), ('edge', G.es, order)):
+        for name in seq.attributes():
+            values = _columnar(seq[name])
+            if name in interned[prefix]:
+                values = values.astype(np.int32) if values.dtype.kind in 'iu' \
+                    else ids.encode(interned[prefix][name], values)
+            np.save(tmp_dir.joinpath(f"{prefix}_{name}.npy"), values[seq_order])
+    if ids is not None:
+        ids.write(tmp_dir.joinpath(IDS_DIR))
+
+    graph_attributes, arrays = {}, []
+    for name in G.attributes():
+        value = G[name]
+        if name == GRAPH_IDS_ATTRIBUTE:
+            continue
+        if isinstance(value, np.ndarray):
+            np.save(tmp_dir.joinpath(f"graph_{name}.npy"), value[order] if name in EDGE_MATRICES else value)
+            arrays.append(name)
+        else:
+            graph_attributes[name] = value
+
+    with open(tmp_dir.joinpath(META_FILE), 'w') as fp:
+        json.dump({'n_nodes': G.vcount(), 'n_edges': G.ecount(), 'directed': G.is_directed(),
+                   'node_attributes': G.vs.attributes(), 'edge_attributes': G.es.attributes(),
+                   'graph_arrays': arrays, 'graph_attributes': graph_attributes, 'interned_attributes': interned},
+                  fp, default=str)
+
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+    return store_dir
+
+
+def read_graph_store_arrays(store_dir: Path, mmap: bool = True) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Read a graph store without building a graph.
+    Args:
+        store_dir (Path): directory written by write_graph_store
+        mmap (bool, optional): memory map the arrays, so that several processes share one copy. Defaults to True.
+    Returns:
+        tuple: the meta data and a dict with 'indptr', 'indices', 'node_<name>', 'edge_<name>' and
+        'graph_<name>' arrays, the attributes listed in meta['interned_attributes'] hold id codes (see
+        read_id_dictionary)
+    """
+    store_dir = Path(store_dir)
+    with open(store_dir.joinpath(META_FILE)) as fp:
+        meta = json.load(fp)
+    names = ['indptr', 'indices',
+             *[f"node_{name}" for name in meta['node_attributes']],
+             *[f"edge_{name}" for name in meta['edge_attributes']],
+             *[f"graph_{name}" for name in meta['graph_arrays']]]
+    return meta, {name: np.load(store_dir.joinpath(f"{name}.npy"), mmap_mode='r' if mmap else None)
+                  for name in names}
+
+
+def read_id_dictionary(store_dir: Path) -> IdDictionary:
+    """The id dictionary of a graph store, None if its ids are stored as strings."""
+    ids_dir = Path(store_dir).joinpath(IDS_DIR)
+    return IdDictionary.read(ids_dir) if ids_dir.exists() else None
+
+
+def read_graph_store(store_dir: Path, decode_ids: bool = True) -> ig.Graph:
+    """Read a graph store into igraph, with edges in CSR (source) order.
+    2D graph arrays (e.g. 'stop_frequencies') become graph attributes, still memory mapped.
+    Args:
+        store_dir (Path): directory written by write_graph_store
+        decode_ids (bool, optional): restore the string ids of interned attributes. If False they stay int32 codes
+            and the dictionary becomes the graph attribute 'ids' (see id_dictionary.graph_attribute). Defaults to
+            True.
+    """
+    meta, arrays = read_graph_store_arrays(store_dir)
+    ids = read_id_dictionary(store_dir)
+    interned = meta.get('interned_attributes', {'node': {}, 'edge': {}})
+    if ids is not None and decode_ids:
+        for prefix in ('node', 'edge'):
+            for name, kind in interned[prefix].items():
+                arrays[f"{prefix}_{name}"] = ids.decode(kind, arrays[f"{prefix}_{name}"])
+    indptr = arrays['indptr']
+    sources = np.repeat(np.arange(meta['n_nodes']), np.diff(indptr))
+    G = ig.Graph(n=meta['n_nodes'], edges=np.column_stack([sources, arrays['indices']]), directed=meta['directed'])
+
+    for name in meta['node_attributes']:
+        G.vs[name] = arrays[f"node_{name}"].tolist()
+    for name in meta['edge_attributes']:
+        G.es[name] = arrays[f"edge_{name}"].tolist()
+    for name, value in meta['graph_attributes'].items():
+        G[name] = value
+    for name in meta['graph_arrays']:
+        G[name] = arrays[f"graph_{name}"]
+    if ids is not None and not decode_ids:
+        G[GRAPH_IDS_ATTRIBUTE] = ids
+
+    return G
+
+
+def is_graph_store(path: Path) -> bool:
+    return Path(path).suffix == GRAPH_STORE_SUFFIX and Path(path).joinpath(META_FILE).exists()
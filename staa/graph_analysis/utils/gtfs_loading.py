@@ -0,0 +1,211 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Tuple
+from zipfile import ZipFile
+
+import pandas as pd
+from urbanaccess.gtfs import utils_format, utils_validation
+from urbanaccess.gtfs.gtfsfeeds_dataframe import urbanaccess_gtfs_df
+
+REQUIRED_TABLES = ('stops', 'routes', 'trips', 'stop_times')
+CALENDAR_TABLES = ('calendar', 'calendar_dates')
+OPTIONAL_TABLES = ('agency',)
+# Explicit dtypes of the columns used downstream, ids and times stay text as in UrbanAccess
+GTFS_DTYPES = {
+    'agency': {'agency_id': object, 'agency_name': object},
+    'stops': {'stop_id': object, 'stop_code': object, 'stop_name': object, 'parent_station': object,
+              'stop_lat': float, 'stop_lon': float},
+    'routes': {'route_id': object, 'agency_id': object, 'route_short_name': object, 'route_long_name': object,
+               'route_type': 'int64'},
+    'trips': {'trip_id': object, 'route_id': object, 'service_id': object, 'shape_id': object,
+              'trip_headsign': object},
+    'stop_times': {'trip_id': object, 'stop_id': object, 'arrival_time': object, 'departure_time': object,
+                   'stop_sequence': 'int64'},
+    'calendar': {'service_id': object, 'monday': 'int64', 'tuesday': 'int64', 'wednesday': 'int64',
+                 'thursday': 'int64', 'friday': 'int64', 'saturday': 'int64', 'sunday': 'int64',
+                 'start_date': 'int64', 'end_date': 'int64'},
+    'calendar_dates': {'service_id': object, 'date': 'int64', 'exception_type': 'int64'},
+}
+# Placeholders UrbanAccess uses for a missing calendar table
+EMPTY_CALENDARS = {
+    'calendar': ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                 'start_date', 'end_date'],
+    'calendar_dates': ['service_id', 'dates', 'exception_type'],
+}
+
+
+def zip_content_hash(zip_path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha1 of the bytes of a zip file, identical feeds share it whatever their file name."""
+    digest = hashlib.sha1()
+    with open(zip_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cast(df: pd.DataFrame, table: str) -> pd.DataFrame:
+    """Strip the column names and cast the numeric columns of a table read as text."""
+    # remove any extra whitespace in column names before casting, so that padded headers still match
+    df = df.rename(columns=lambda x: x.strip())
+    numeric = {col: dtype for col, dtype in GTFS_DTYPES[table].items() if dtype is not object and col in df}
+    return df.astype(numeric)
+
+
+def _in_bbox(stops: pd.DataFrame, bbox: Tuple[float, float, float, float]) -> pd.Series:
+    """Stops strictly inside bbox, with the same (lng_max, lat_min, lng_min, lat_max) convention as UrbanAccess."""
+    lng_max, lat_min, lng_min, lat_max = bbox
+    return stops['stop_lon'].gt(lng_max) & stops['stop_lon'].lt(lng_min) & \
+        stops['stop_lat'].gt(lat_min) & stops['stop_lat'].lt(lat_max)
+
+
+def read_gtfs_zip(zip_path: Path, bbox: Tuple[float, float, float, float] = None,
+                  chunk_size: int = 500_000) -> Dict[str, pd.DataFrame]:
+    """Read the GTFS tables straight from a zip, without extracting it.
+    With a bbox, the stops outside of it are dropped first and stop_times is streamed in chunks of chunk_size rows,
+    keeping only the rows of the remaining stops. Trips and routes are then pruned to those still served, so the
+    memory needed scales with the area of the bbox rather than with the whole feed.
+    Args:
+        zip_path (Path): GTFS zip
+        bbox (tuple, optional): (lng_max, lat_min, lng_min, lat_max). Defaults to None, reading the whole feed.
+        chunk_size (int, optional): rows of stop_times per chunk when a bbox is given. Defaults to 500_000.
+    Returns:
+        dict: table name (e.g. 'stop_times') -> DataFrame, for all tables present in the zip
+    """
+    tables = {}
+    with ZipFile(zip_path) as ref:
+        # Feeds are sometimes zipped with their folder, only the file names matter
+        members = {Path(name).name: name for name in ref.namelist() if name.endswith('.txt')}
+        for table in (*REQUIRED_TABLES, *CALENDAR_TABLES, *OPTIONAL_TABLES):
+            if f"{table}.txt" not in members:
+                continue
+            with ref.open(members[f"{table}.txt"]) as fp:
+                if bbox is None or table != 'stop_times':
+                    tables[table] = _cast(pd.read_csv(fp, dtype=object, encoding='utf-8-sig', low_memory=False),
+                                          table)
+                    if bbox is not None and table == 'stops':
+                        tables[table] = tables[table][_in_bbox(tables[table], bbox)].reset_index(drop=True)
+                    continue
+
+                stop_ids = set(tables['stops']['stop_id']) if 'stops' in tables else set()
+                chunks = []
+                for chunk in pd.read_csv(fp, dtype=object, encoding='utf-8-sig', chunksize=chunk_size):
+                    chunk = _cast(chunk, table)
+                    chunks.append(chunk[chunk['stop_id'].isin(stop_ids)])
+                tables[table] = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    if bbox is not None and 'stop_times' in tables:
+        if 'trips' in tables:
+            tables['trips'] = tables['trips'][tables['trips']['trip_id'].isin(
+                set(tables['stop_times']['trip_id']))].reset_index(drop=True)
+            if 'routes' in tables:
+                tables['routes'] = tables['routes'][tables['routes']['route_id'].isin(
+                    set(tables['trips']['route_id']))].reset_index(drop=True)
+    return tables
+
+
+def load_gtfs_tables(zip_path: Path, cache_dir: Path,
+                     bbox: Tuple[float, float, float, float] = None) -> Dict[str, pd.DataFrame]:
+    """Read the GTFS tables of a zip through a parquet cache keyed by the zip's content hash and the bbox.
+    The first load parses the CSVs, every later load (other time window, ...) only reads parquet.
+    """
+    cache_key = zip_content_hash(zip_path)
+    if bbox is not None:
+        cache_key = f"{cache_key}_{'_'.join(f'{v:g}' for v in bbox)}"
+    feed_cache = Path(cache_dir).joinpath(cache_key)
+    if feed_cache.exists():
+        return {path.stem: pd.read_parquet(path) for path in feed_cache.glob('*.parquet')}
+
+    tables = read_gtfs_zip(zip_path, bbox)
+    # Write to a temporary directory first, concurrent workers may cache the same feed
+    tmp_cache = feed_cache.with_name(f"{feed_cache.name}.{os.getpid()}.tmp")
+    tmp_cache.mkdir(parents=True, exist_ok=True)
+    for table, df in tables.items():
+        df.to_parquet(tmp_cache.joinpath(f"{table}.parquet"), index=False)
+    try:
+        os.replace(tmp_cache, feed_cache)
+    except OSError:
+        # Another worker cached it first
+        shutil.rmtree(tmp_cache, ignore_errors=True)
+    return tables
+
+
+def gtfs_tables_to_ua_feed(tables: Dict[str, pd.DataFrame], feed_folder: Path,
+                           bbox: Tuple[float, float, float, float]) -> urbanaccess_gtfs_df:
+    """Turn raw GTFS tables into UrbanAccess feed dataframes, as ua.gtfs.load.gtfsfeed_to_df does for a folder
+    with a single feed, with validation, removal of the stops outside bbox and appended definitions.
+    Args:
+        tables (dict): tables as returned by read_gtfs_zip / load_gtfs_tables
+        feed_folder (Path): scratch folder named after the feed. UrbanAccess derives the unique feed id from its
+            name and only checks whether it contains an agency.txt.
+        bbox (tuple): (lng_max, lat_min, lng_min, lat_max)
+    Returns:
+        urbanaccess_gtfs_df: a new feed dataframe object, independent of UrbanAccess' global one
+    """
+    for table in REQUIRED_TABLES:
+        if table not in tables or tables[table].empty:
+            raise ValueError(f"{table}.txt is a required GTFS text file and was not found in {feed_folder}")
+    if not any(table in tables for table in CALENDAR_TABLES):
+        raise ValueError(f"at least one of `calendar.txt` or `calendar_dates.txt` is required to complete a GTFS "
+                         f"dataset but neither was found in {feed_folder}")
+
+    tables = {table: df.copy() for table, df in tables.items()}
+    for table, columns in EMPTY_CALENDARS.items():
+        tables.setdefault(table, pd.DataFrame(columns=columns))
+    agency_df = tables.get('agency', pd.DataFrame())
+
+    feed_folder = Path(feed_folder)
+    feed_folder.mkdir(parents=True, exist_ok=True)
+    if 'agency' in tables:
+        agency_df.to_csv(feed_folder.joinpath('agency.txt'), index=False)
+
+    stops_df, routes_df, trips_df, stop_times_df, calendar_df, calendar_dates_df = \
+        utils_format._add_unique_agencyid(agency_df=agency_df,
+                                          stops_df=tables['stops'],
+                                          routes_df=tables['routes'],
+                                          trips_df=tables['trips'],
+                                          stop_times_df=tables['stop_times'],
+                                          calendar_df=tables['calendar'],
+                                          calendar_dates_df=tables['calendar_dates'],
+                                          nulls_as_folder=True,
+                                          feed_folder=str(feed_folder))
+    stops_df, routes_df, trips_df, stop_times_df, calendar_df, calendar_dates_df = \
+        utils_format._add_unique_gtfsfeed_id(stops_df=stops_df,
+                                             routes_df=routes_df,
+                                             trips_df=trips_df,
+                                             stop_times_df=stop_times_df,
+                                             calendar_df=calendar_df,
+                                             calendar_dates_df=calendar_dates_df,
+                                             feed_folder=str(feed_folder),
+                                             feed_number=1)
+
+    stops_df = utils_validation._validate_gtfs(stops_df=stops_df, feed_folder=str(feed_folder), verbose=True,
+                                               bbox=bbox, remove_stops_outsidebbox=True)
+    stop_times_df = stop_times_df[stop_times_df['stop_id'].isin(stops_df['stop_id'])]
+
+    stops_df = utils_format._append_route_type(stops_df=stops_df,
+                                               stop_times_df=stop_times_df,
+                                               routes_df=routes_df[['route_id', 'route_type']],
+                                               trips_df=trips_df[['trip_id', 'route_id']],
+                                               info_to_append='route_type_to_stops')
+    stop_times_df = utils_format._append_route_type(stops_df=stops_df,
+                                                    stop_times_df=stop_times_df,
+                                                    routes_df=routes_df[['route_id', 'route_type']],
+                                                    trips_df=trips_df[['trip_id', 'route_id']],
+                                                    info_to_append='route_type_to_stop_times')
+
+    stops_df, routes_df, stop_times_df, trips_df = [
+        df.reset_index(drop=True) for df in (stops_df, routes_df, stop_times_df, trips_df)]
+    stops_df, routes_df, stop_times_df, trips_df = utils_format._add_txt_definitions(
+        stops_df=stops_df, routes_df=routes_df, stop_times_df=stop_times_df, trips_df=trips_df)
+    stop_times_df = utils_format._timetoseconds(df=stop_times_df, time_cols=['departure_time'])
+
+    feed = urbanaccess_gtfs_df()
+    feed.stops = stops_df
+    feed.routes = routes_df
+    feed.trips = trips_df
+    feed.stop_times = stop_times_df
+    feed.calendar = calendar_df.reset_index(drop=True)
+    feed.calendar_dates = calendar_dates_df.reset_index(drop=True)
+    return feed
@@ -0,0 +1,92 @@
+from pathlib import Path
+from typing import Dict
+
+import igraph as ig
+import numpy as np
+import pandas as pd
+
+ID_KINDS = ('stop', 'route', 'trip', 'agency')
+# Graph attributes holding ids of a kind, stored as their integer codes
+NODE_ID_ATTRIBUTES = {'node_id': 'stop'}
+EDGE_ID_ATTRIBUTES = {'node_id_from': 'stop', 'node_id_to': 'stop', 'unique_route_id': 'route',
+                      'unique_trip_id': 'trip', 'unique_agency_id': 'agency'}
+# Graph attribute holding the dictionary of a graph read with its integer codes
+GRAPH_IDS_ATTRIBUTE = 'ids'
+
+
+def _unique_ids(df: pd.DataFrame, column: str) -> np.ndarray:
+    """UrbanAccess' unique id of every row: the GTFS id and the unique agency id joined by '_'."""
+    return df[column].astype(str).str.cat(df['unique_agency_id'].astype(str), sep='_').to_numpy(dtype=str)
+
+
+class IdDictionary:
+    """Dense int32 codes of the stop, route, trip and agency ids of a feed.
+    Codes are positions in the sorted ids of every kind, -1 marks an unknown id.
+    Args:
+        ids (dict): kind (see ID_KINDS) -> ids, missing kinds are empty
+    """
+
+    def __init__(self, ids: Dict[str, np.ndarray]):
+        self.ids = {kind: np.unique(np.asarray(ids.get(kind, []), dtype=str)) for kind in ID_KINDS}
+        self._index = {kind: pd.Index(values) for kind, values in self.ids.items()}
+
+    @classmethod
+    def from_ua_feed(cls, ua_feed) -> 'IdDictionary':
+        """Intern the unique ids UrbanAccess derives from a loaded feed (see gtfs_loading.gtfs_tables_to_ua_feed)."""
+        return cls({
+            'stop': _unique_ids(ua_feed.stops, 'stop_id'),
+            'route': _unique_ids(ua_feed.routes, 'route_id'),
+            'trip': _unique_ids(ua_feed.trips, 'trip_id'),
+            'agency': ua_feed.stops['unique_agency_id'].astype(str).to_numpy(dtype=str),
+        })
+
+    def encode_unique(self, kind: str, df: pd.DataFrame, column: str) -> np.ndarray:
+        """int32 codes of UrbanAccess' unique ids of the rows of `df` (see from_ua_feed), -1 for unknown ids.
+        Rows are factorized by their (id, agency) pair, the unique ids are only built and looked up once per pair."""
+        pairs = pd.MultiIndex.from_arrays([df[column].astype(str), df['unique_agency_id'].astype(str)])
+        row_codes, uniques = pd.factorize(pairs)
+        codes = self.encode(kind, _unique_ids(uniques.to_frame(index=False, name=[column, 'unique_agency_id']),
+                                              column))
+        return codes[row_codes] if len(row_codes) else np.zeros(0, dtype=np.int32)
+
+    def add(self, kind: str, values):
+        """Intern the unknown ids among `values`. The codes of a kind change when ids are added to it, so add all ids
+        before encoding any of them."""
+        values = np.asarray(values, dtype=str)
+        unknown = self._index[kind].get_indexer(values) < 0
+        if unknown.any():
+            self.ids[kind] = np.union1d(self.ids[kind], values[unknown])
+            self._index[kind] = pd.Index(self.ids[kind])
+
+    def encode(self, kind: str, values) -> np.ndarray:
+        """int32 codes of ids of a kind (see ID_KINDS), -1 for unknown ids."""
+        return self._index[kind].get_indexer(np.asarray(values, dtype=str)).astype(np.int32)
+
+    def decode(self, kind: str, codes: np.ndarray) -> np.ndarray:
+        """Ids of codes of a kind, '' for unknown codes."""
+        codes = np.asarray(codes, dtype=np.int64)
+        ids = np.append(self.ids[kind], '')
+        return ids[np.where(codes >= 0, codes, len(ids) - 1)]
+
+    def write(self, ids_dir: Path) -> Path:
+        """Store the ids of every kind as one .npy file."""
+        ids_dir = Path(ids_dir)
+        ids_dir.mkdir(parents=True, exist_ok=True)
+        for kind, values in self.ids.items():
+            np.save(ids_dir.joinpath(f"{kind}.npy"), values)
+        return ids_dir
+
+    @classmethod
+    def read(cls, ids_dir: Path) -> 'IdDictionary':
+        ids_dir = Path(ids_dir)
+        return cls({kind: np.load(ids_dir.joinpath(f"{kind}.npy")) for kind in ID_KINDS
+                    if ids_dir.joinpath(f"{kind}.npy").exists()})
+
+
+def graph_attribute(G: ig.Graph, name: str, edges: bool = False) -> np.ndarray:
+    """String values of a node (or edge) attribute, decoded if the graph was read with integer id codes."""
+    values = G.es[name] if edges else G.vs[name]
+    kind = (EDGE_ID_ATTRIBUTES if edges else NODE_ID_ATTRIBUTES).get(name)
+    if kind is None or GRAPH_IDS_ATTRIBUTE not in G.attributes():
+        return np.asarray(values, dtype=str)
+    return G[GRAPH_IDS_ATTRIBUTE].decode(kind, values)
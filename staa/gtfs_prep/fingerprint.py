@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict
+from zipfile import ZipFile
+
+import pandas as pd
+
+# Fingerprints and date aliases of a pipeline stage, kept next to its artifacts
+FINGERPRINTS_FILE = 'fingerprints.json'
+# Tables that make up the service of a day feed. calendar, calendar_dates and feed_info only carry the dates and
+# version of a snapshot and are left out, so that snapshots of different days with the same service match.
+SERVICE_TABLES = ('agency', 'stops', 'routes', 'trips', 'stop_times', 'frequencies', 'transfers')
+# Columns naming a snapshot rather than describing its service
+IGNORED_COLUMNS = ('service_id',)
+
+
+def file_fingerprint(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha1 of the raw bytes of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def service_fingerprint(zip_path: Path) -> str:
+    """sha1 of the normalised service of a GTFS zip, independent of row and column order and of its dates.
+    Two day feeds with the same fingerprint produce the same graph and therefore the same OD results.
+    """
+    digest = hashlib.sha1()
+    with ZipFile(zip_path) as ref:
+        members = {Path(name).name: name for name in ref.namelist() if name.endswith('.txt')}
+        for table in SERVICE_TABLES:
+            if f"{table}.txt" not in members:
+                continue
+            with ref.open(members[f"{table}.txt"]) as fp:
+                df = pd.read_csv(fp, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+            df = df.rename(columns=lambda x: x.strip())
+            df = df[sorted(col for col in df.columns if col not in IGNORED_COLUMNS)]
+            df = df.sort_values(list(df.columns)).reset_index(drop=True)
+            digest.update(f"{table}:{','.join(df.columns)}".encode())
+            digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def file_date(path: Path) -> str:
+    """The YYYYMMDD date in the name of a pipeline artifact."""
+    return re.findall(r'\d{8}', Path(path).name)[0]
+
+
+def deduplicate(fingerprints: Dict[str, str], consecutive: bool = False) -> Dict[str, str]:
+    """Map every date onto the earliest date with the same fingerprint.
+    Args:
+        fingerprints (dict): YYYYMMDD date -> fingerprint
+        consecutive (bool, optional): only alias runs of consecutive dates with the same fingerprint, for stages
+            that forward fill over the canonical dates alone. Defaults to False.
+    Returns:
+        dict: alias date -> canonical date, only for the dates that are aliases
+    """
+    canonical, aliases = {}, {}
+    previous = None
+    for date in sorted(fingerprints):
+        if consecutive and fingerprints[date] != previous:
+            canonical[fingerprints[date]] = date
+        first = canonical.setdefault(fingerprints[date], date)
+        if first != date:
+            aliases[date] = first
+        previous = fingerprints[date]
+    return aliases
+
+
+def _read_record(artifact_dir: Path) -> dict:
+    path = Path(artifact_dir).joinpath(FINGERPRINTS_FILE)
+    if not path.exists():
+        return {'fingerprints': {}, 'aliases': {}}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _write_record(artifact_dir: Path, record: dict):
+    path = Path(artifact_dir).joinpath(FINGERPRINTS_FILE)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as fp:
+        json.dump({key: dict(sorted(values.items())) for key, values in record.items()}, fp, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_aliases(artifact_dir: Path) -> Dict[str, str]:
+    """Alias date -> canonical date recorded in a directory, empty if none were recorded."""
+    return _read_record(artifact_dir)['aliases']
+
+
+def record_fingerprints(artifact_dir: Path, fingerprints: Dict[str, str], consecutive: bool = False) -> Dict[str, str]:
+    """Add the fingerprints of new artifacts to the record of a directory and deduplicate all recorded dates.
+    Args:
+        artifact_dir (Path): directory holding the artifacts of one pipeline stage
+        fingerprints (dict): YYYYMMDD date -> fingerprint of the new artifacts
+        consecutive (bool, optional): see deduplicate. Defaults to False.
+    Returns:
+        dict: alias date -> canonical date, for all recorded dates
+    """
+    record = _read_record(artifact_dir)
+    record['fingerprints'].update(fingerprints)
+    record['aliases'] = deduplicate(record['fingerprints'], consecutive)
+    _write_record(artifact_dir, record)
+    return record['aliases']
+
+
+def record_aliases(artifact_dir: Path, aliases: Dict[str, str]) -> Dict[str, str]:
+    """Record aliases inherited from an earlier pipeline stage, for stages whose artifacts are not fingerprinted
+    themselves (graphs, OD results): they are derived from canonical inputs only.
+    Returns:
+        dict: all aliases recorded in the directory
+    """
+    record = _read_record(artifact_dir)
+    record['aliases'].update(aliases)
+    _write_record(artifact_dir, record)
+    return record['aliases']
@@ -13,6 +13,7 @@ from zipfile import ZipFile
 
 from transit_feed_providers import TransitFeedProviders
 from exceptions import GTFSDownloadException
+from fingerprint import file_fingerprint, file_date, record_fingerprints
 
 logging.basicConfig()
 logger = logging.getLogger(__file__)
@@ -104,8 +105,21 @@ def download_and_store_gtfs(start_date: datetime.date, end_date: datetime.date,
     downloaded_paths = []
     total_space = 0
 
-    results = ThreadPool(8).imap_unordered(_fetch_gtfs, urls)
-    filter_results = ThreadPool(6).imap_unordered(_filter_gtfs, results)
+    fetched = ThreadPool(8).map(_fetch_gtfs, urls)
+    for path_or_exception in fetched:
+        if isinstance(path_or_exception, GTFSDownloadException):
+            logger.warning(str(path_or_exception))
+
+    # Consecutive snapshots are often byte identical, only the first of every run is filtered. The day extraction
+    # forward fills over the remaining dates, so the aliases are still covered by their canonical snapshot.
+    fetched_paths = [path for path in fetched if not isinstance(path, GTFSDownloadException)]
+    aliases = record_fingerprints(Path(DATA_PATH), {file_date(path): file_fingerprint(path) for path in fetched_paths},
+                                  consecutive=True)
+    canonical_paths = [path for path in fetched_paths if file_date(path) not in aliases]
+    logger.info(f"{len(fetched_paths) - len(canonical_paths)} of {len(fetched_paths)} feeds are identical to an "
+                f"earlier one")
+
+    filter_results = ThreadPool(6).imap_unordered(_filter_gtfs, canonical_paths)
     for path_or_exception in filter_results:
         if not isinstance(path_or_exception, GTFSDownloadException):
             path = path_or_exception
@@ -1,12 +1,13 @@
 import os
-from typing import Tuple, Union
+from typing import Tuple, Union, List
 from pathlib import Path
 import re
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 
 import pandas as pd
 import gtfs_kit as gk
 from exceptions import GTFSDateError
+from fingerprint import file_date, service_fingerprint, read_aliases, record_fingerprints
 
 import datetime
 
@@ -18,45 +19,66 @@ logger.setLevel(logging.INFO)
 
 ORIGIN_DATA_DIR = Path(os.getenv('ORIGIN_DATA_DIR', './data/filtered_gtfs_files'))
 TARGET_DATA_DIR = Path(os.getenv('TARGET_DATA_DIR', './data/day_gtfs_files'))
-NUM_WORKERS = os.getenv('NUM_WORKERS', 4)
+# Directory of the downloaded snapshots (gtfs_aggregation's DATA_PATH), the snapshot aliases are recorded there
+RAW_DATA_DIR = Path(os.getenv('RAW_DATA_DIR', './data/full_gtfs_files'))
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', 4))
 
 ON_LISA = bool(os.environ.get("ON_LISA", False))
 
 
-def _extract_and_store_gtfs_for_dates(entry: Tuple) -> Union[Path, GTFSDateError]:
-    # Check if gtfs file needs to be read in
-    logger.info(f"reading in file: {entry[1][0]}")
-    curr_path = entry[1][0]
+def _extract_and_store_gtfs_for_dates(
+        entry: Tuple[Path, List[datetime.datetime]]) -> List[Union[Tuple[Path, str], GTFSDateError]]:
+    # Read every source archive only once and write the slices of all dates it is used for
+    curr_path, dates = entry
+    logger.info(f"reading in file: {curr_path} for {len(dates)} dates")
     feed = gk.read_feed(curr_path, dist_units='km')
+    feed_dates = set(feed.get_dates())
 
-    # Extract current date
-    d = entry[0].date()
-    curr_date = d.isoformat().replace('-', '')
+    results = []
+    for date in dates:
+        # Extract current date
+        curr_date = date.date().isoformat().replace('-', '')
 
-    # Make sure date is in available dates
-    try:
-        assert curr_date in feed.get_dates()
-    except:
-        logger.warning(f"could not find date {curr_date} in {feed.get_dates()}")
-        return GTFSDateError("failed to find {curr_date} in {feed.get_dates()}")
+        # Make sure date is in available dates
+        if curr_date not in feed_dates:
+            logger.warning(f"could not find date {curr_date} in {curr_path}")
+            results.append(GTFSDateError(f"failed to find {curr_date} in {curr_path}"))
+            continue
 
-    restricted_feed = feed.restrict_to_dates(dates=[curr_date])
-    reduced_file_path = TARGET_DATA_DIR.joinpath(f'filtered-ov-gtfs-{curr_date}.zip')
-    restricted_feed.write(reduced_file_path)
+        restricted_feed = feed.restrict_to_dates(dates=[curr_date])
+        reduced_file_path = TARGET_DATA_DIR.joinpath(f'filtered-ov-gtfs-{curr_date}.zip')
+        restricted_feed.write(reduced_file_path)
+        results.append((reduced_file_path, service_fingerprint(reduced_file_path)))
 
-    return reduced_file_path
+    return results
 
 
 def extract_and_store_gtfs_for_dates(dates: pd.DataFrame) -> None:
-    total_space = 0
     extracted_days_paths = []
 
-    results = ThreadPool(NUM_WORKERS).imap_unordered(_extract_and_store_gtfs_for_dates, dates.iterrows())
-    for path in results:
-        if isinstance(path, GTFSDateError):
-            continue
-        extracted_days_paths.append(path)
-        total_space += path.stat().st_size
+    # Forward filling maps many dates to the same archive, group them so that every archive is read once.
+    # gtfs_kit is pandas bound, so the archives are processed in separate processes rather than threads.
+    sources = [(path, list(group.index)) for path, group in dates.groupby('GTFS_File', sort=False)]
+    fingerprints = {}
+    with Pool(NUM_WORKERS) as pool:
+        for results in pool.imap_unordered(_extract_and_store_gtfs_for_dates, sources):
+            for result in results:
+                if isinstance(result, GTFSDateError):
+                    continue
+                path, fingerprint = result
+                fingerprints[file_date(path)] = fingerprint
+                extracted_days_paths.append(path)
+
+    # Days with the same service give the same graph and OD results, keep only the earliest of them and record the
+    # other dates as its aliases
+    aliases = record_fingerprints(TARGET_DATA_DIR, fingerprints)
+    for path in extracted_days_paths:
+        if file_date(path) in aliases:
+            os.remove(path)
+    extracted_days_paths = [path for path in extracted_days_paths if file_date(path) not in aliases]
+    total_space = sum(path.stat().st_size for path in extracted_days_paths)
+    logger.info(f"{len(fingerprints) - len(extracted_days_paths)} of {len(fingerprints)} days have the same service "
+                f"as an earlier day")
 
     n_paths_processed = len(extracted_days_paths)
     extracted_dates = [datetime.datetime.strptime(re.findall(r'\d{8}', str(path))[0], '%Y%m%d') for path in extracted_days_paths]
@@ -70,6 +92,12 @@ def extract_and_store_gtfs_for_dates(dates: pd.DataFrame) -> None:
 if __name__ == "__main__":
     # Load all GTFS files
     all_gtfs_files = [ORIGIN_DATA_DIR.joinpath(e) for e in os.listdir(ORIGIN_DATA_DIR) if Path(e).suffix == '.zip']
+    # Snapshots identical to the previous one are covered by forward filling the previous one. They are never
+    # filtered, so their record is kept with the downloads.
+    source_aliases = {**read_aliases(RAW_DATA_DIR), **read_aliases(ORIGIN_DATA_DIR)}
+    # The forward fill has to cover a trailing run of aliases up to the last snapshot
+    last_snapshot_date = pd.to_datetime(max({file_date(path) for path in all_gtfs_files} | set(source_aliases)))
+    all_gtfs_files = [path for path in all_gtfs_files if file_date(path) not in source_aliases]
     logger.info(f"Identified {len(all_gtfs_files)} candidate GTFS archives")
     # Get all dates from the GTFS files
     dates = [re.findall(r'\d{8}', str(path))[0] for path in all_gtfs_files]
@@ -80,6 +108,7 @@ if __name__ == "__main__":
     # GTFS files are looking up to 30 weeks ahead so this should never cause failure
     # and makes sure that we're using the latest GTFS feed
     df_dates = df_dates.resample('D').ffill()
+    df_dates = df_dates.reindex(pd.date_range(df_dates.index.min(), last_snapshot_date, freq='D')).ffill()
     df_dates['Day'] = pd.Series(pd.Series(df_dates.index).dt.day_name().values, index=df_dates.index)
     # Extract all mondays and corresponding GTFS files
     mondays = df_dates[df_dates['Day'] == 'Monday']
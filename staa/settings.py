@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 import logging
 
@@ -11,11 +12,24 @@ logger.setLevel(logging.INFO)
 #### GRAPH GENERATION
 #####################
 GG_DELETE_EXISTING = os.environ['GG_DELETE_EXISTING']
-# TODO Figure out why a mutli-worker setup doesn't work here
+# Number of worker processes, every feed is generated in its own process with its own UrbanAccess state
 GG_NUM_WORKERS = int(os.getenv('GG_NUM_WORKERS', 1))
 GG_GTFS_DATA_DIR = Path(os.environ['GG_GTFS_DATA_DIR'])
 GG_TRANSIT_GRAPH_DATA_DIR = Path(os.environ['GG_TRANSIT_GRAPH_DATA_DIR'])
 GG_CITY_NAME = os.environ['GG_CITY_NAME']
+# Additionally export every graph as networkx gpickle + GML, next to its binary graph store
+GG_EXPORT_NX = bool(int(os.getenv('GG_EXPORT_NX', 0)))
+# Additionally export the schedule of every graph as a connection store, for schedule based routing
+GG_EXPORT_CONNECTIONS = bool(int(os.getenv('GG_EXPORT_CONNECTIONS', 0)))
+# Number of retries of a failing feed before it is reported as not processed
+GG_MAX_RETRIES = int(os.getenv('GG_MAX_RETRIES', 2))
+# Root of the per worker scratch directories
+GG_SCRATCH_DIR = Path(os.getenv('GG_SCRATCH_DIR', tempfile.gettempdir()))
+# (day, time window) specs to generate a graph for from every feed, separated by ';'
+GG_TIME_WINDOWS = [(day, [start, end]) for day, start, end in
+                   (spec.split() for spec in os.getenv('GG_TIME_WINDOWS', 'monday 07:00:00 09:00:00').split(';'))]
+# Parsed GTFS tables (parquet), keyed by the content hash of their zip
+GG_GTFS_CACHE_DIR = Path(os.getenv('GG_GTFS_CACHE_DIR', GG_GTFS_DATA_DIR.joinpath('parsed_cache')))
 
 #####################
 #### GRAPH GENERATION
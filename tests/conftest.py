@@ -0,0 +1,18 @@
+import igraph as ig
+import pytest
+
+
+def transit_graph(n: int, edges: list) -> ig.Graph:
+    """Directed transit graph from (source, target, travel_time[, route]) tuples, lengths are 100 m per minute."""
+    G = ig.Graph(n=n, edges=[edge[:2] for edge in edges], directed=True)
+    G.vs['node_id'] = [f"s{v}" for v in range(n)]
+    G.es['travel_time'] = [float(edge[2]) for edge in edges]
+    G.es['length'] = [100. * edge[2] for edge in edges]
+    G.es['unique_route_id'] = [edge[3] if len(edge) > 3 else 'r0' for edge in edges]
+    G.es['route_type'] = [3] * len(edges)
+    return G
+
+
+@pytest.fixture
+def make_transit_graph():
+    return transit_graph
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from staa.accessibility_analysis.connection_scan import (WALKING_SPEED, ConnectionScan, connection_scan_od,
+                                                         mean_travel_time)
+from staa.graph_analysis.utils.connection_store import build_connections, write_connection_store
+from staa.graph_analysis.utils.id_dictionary import IdDictionary
+
+# Stops on a meridian, 0.001 degree of latitude is about 111 m. D is a short walk from C, X has no coordinates.
+STOP_LAT = {'A': 52.30, 'B': 52.31, 'C': 52.32, 'D': 52.3209, 'F': 52.35}
+# trip -> (stop, time) of its stop times
+TRIPS = {
+    't1': [('A', '08:00'), ('B', '08:10'), ('C', '08:20')],
+    't2': [('D', '08:25'), ('F', '08:40')],
+    't3': [('A', '08:30'), ('X', '09:00'), ('F', '09:30')],
+}
+
+
+def _seconds(hhmm: str) -> int:
+    return int(hhmm[:2]) * 3600 + int(hhmm[3:]) * 60
+
+
+@pytest.fixture
+def cs(tmp_path):
+    stops = pd.DataFrame({'stop_id': list(STOP_LAT), 'unique_agency_id': 'ag', 'stop_lat': list(STOP_LAT.values()),
+                          'stop_lon': 4.9})
+    stop_times = pd.DataFrame(
+        [(trip, f"{stop}_ag", _seconds(time), sequence)
+         for trip, stop_times in TRIPS.items() for sequence, (stop, time) in enumerate(stop_times)],
+        columns=['unique_trip_id', 'unique_stop_id', 'departure_time_sec_interpolate', 'stop_sequence'])
+    ids = IdDictionary({'stop': [*stop_times['unique_stop_id'].unique()], 'trip': list(TRIPS)})
+    connections = build_connections(stop_times, stops, ids, _seconds('07:00'))
+    store_dir = write_connection_store(connections, tmp_path.joinpath('connections'),
+                                       {'window': [_seconds('08:00'), _seconds('08:15')]})
+    return ConnectionScan(store_dir, transfer_radius_m=250)
+
+
+def _stop(cs, name):
+    return int(np.flatnonzero(cs.stop_ids == f"{name}_ag")[0])
+
+
+def test_stops_without_coordinates_are_not_snapped(cs):
+    assert _stop(cs, 'X') not in cs.located
+    stops, dist = cs.nearest([4.9], [52.35], k=len(cs.located))
+    assert _stop(cs, 'X') not in stops
+    assert stops[0, 0] == _stop(cs, 'F') and dist[0, 0] == pytest.approx(0, abs=1e-6)
+
+
+def test_earliest_arrival_with_transfer(cs):
+    a, f = _stop(cs, 'A'), _stop(cs, 'F')
+    tt = connection_scan_od(cs, np.array([[a]]), np.zeros((1, 1)), np.array([[f]]), np.zeros((1, 1)),
+                            [_seconds('08:00'), _seconds('08:15')])
+    # t1 to C, walk about 100 m to D, t2 to F. Departing at 08:15 only t3 is left.
+    np.testing.assert_allclose(tt[0, :, 0], [40 * 60, 75 * 60])
+    np.testing.assert_allclose(mean_travel_time(tt), [[57.5 * 60]])
+
+
+def test_unreachable_departures_are_left_out_of_the_mean(cs):
+    b, f = _stop(cs, 'B'), _stop(cs, 'F')
+    # Walking into the network at B only catches t1 when departing at 08:00
+    tt = connection_scan_od(cs, np.array([[b]]), np.zeros((1, 1)), np.array([[f]]), np.zeros((1, 1)),
+                            [_seconds('07:55'), _seconds('08:15')])
+    assert np.isfinite(tt[0, 0, 0]) and np.isinf(tt[0, 1, 0])
+    np.testing.assert_allclose(mean_travel_time(tt), tt[:, 0])
+    assert np.isinf(mean_travel_time(np.full((1, 2, 1), np.inf))).all()
+
+
+def test_access_walk_is_added(cs):
+    a, f = _stop(cs, 'A'), _stop(cs, 'F')
+    # 5 minutes of walking still catches t1 at 08:00 when departing at 07:55
+    tt = connection_scan_od(cs, np.array([[a]]), np.array([[WALKING_SPEED * 300]]), np.array([[f]]),
+                            np.array([[WALKING_SPEED * 60]]), [_seconds('07:55')])
+    np.testing.assert_allclose(tt[0, 0, 0], 46 * 60)
+
+
+def test_footpaths_are_closed(tmp_path):
+    # Three stops 200 m apart: the outer two are only linked through the middle one
+    lat = 52.3 + np.arange(3) * 200 / 111_195
+    stops = pd.DataFrame({'stop_id': ['G', 'H', 'I'], 'unique_agency_id': 'ag', 'stop_lat': lat, 'stop_lon': 4.9})
+    stop_times = pd.DataFrame([('t', 'G_ag', 0, 0), ('t', 'H_ag', 60, 1)],
+                              columns=['unique_trip_id', 'unique_stop_id', 'departure_time_sec_interpolate',
+                                       'stop_sequence'])
+    ids = IdDictionary({'stop': ['G_ag', 'H_ag', 'I_ag'], 'trip': ['t']})
+    store_dir = write_connection_store(build_connections(stop_times, stops, ids), tmp_path, {'window': [0, 60]})
+
+    def footpaths(cs, stop):
+        span = slice(cs.transfer_indptr[stop], cs.transfer_indptr[stop + 1])
+        return dict(zip(cs.transfer_stops[span].tolist(), cs.transfer_time[span] * WALKING_SPEED))
+
+    closed = footpaths(ConnectionScan(store_dir, transfer_radius_m=250, max_walk_m=1000), 0)
+    assert sorted(closed) == [1, 2]
+    assert closed[2] == pytest.approx(400, rel=1e-3)
+    assert sorted(footpaths(ConnectionScan(store_dir, transfer_radius_m=250, max_walk_m=300), 0)) == [1]
@@ -0,0 +1,32 @@
+import numpy as np
+
+from staa.accessibility_analysis.cumulative_accessibility import (point_travel_times, cumulative_opportunities,
+                                                                  gravity_accessibility, nearest_k_travel_times)
+from staa.accessibility_analysis.od_routing import RoutingGraph, walking_minutes
+
+
+def test_walking_minutes():
+    # 5 km/h
+    np.testing.assert_allclose(walking_minutes([0., 500., 5000.]), [0., 6., 60.])
+
+
+def test_point_pair_against_thresholds(make_transit_graph):
+    rg = RoutingGraph(make_transit_graph(3, [(0, 1, 10), (1, 2, 20)]))
+    # 500 m to node 0 and 250 m from node 1: 6 + 10 + 3 minutes, node 2 is 20 minutes further
+    o_walk = walking_minutes(np.array([[500.]]))
+    d_walk = walking_minutes(np.array([[250.], [250.]]))
+    d_idx = np.array([[1], [2]])
+
+    tt = point_travel_times(rg, np.array([[0]]), o_walk, d_idx, d_walk, limit=60)
+    np.testing.assert_allclose(tt, [[19., 39.]])
+    np.testing.assert_array_equal(cumulative_opportunities(tt, [15, 30, 45, 60]), [[0, 1, 2, 2]])
+    np.testing.assert_allclose(gravity_accessibility(tt, 1 / 30), [np.exp(-19 / 30) + np.exp(-39 / 30)])
+    # The first search up to 15 minutes settles neither destination, the limit is widened
+    np.testing.assert_allclose(nearest_k_travel_times(rg, np.array([[0]]), o_walk, d_idx, d_walk, 2, 15),
+                               [[19., 39.]])
+
+
+def test_search_limit_cuts_off(make_transit_graph):
+    rg = RoutingGraph(make_transit_graph(3, [(0, 1, 10), (1, 2, 20)]))
+    tt = point_travel_times(rg, np.array([[0]]), np.zeros((1, 1)), np.array([[1], [2]]), np.zeros((2, 1)), limit=15)
+    np.testing.assert_allclose(tt, [[10., np.inf]])
@@ -0,0 +1,52 @@
+from zipfile import ZipFile
+
+from staa.gtfs_prep.fingerprint import (service_fingerprint, file_date, deduplicate, read_aliases,
+                                        record_fingerprints, record_aliases)
+
+STOPS = "stop_id,stop_name,stop_lat,stop_lon\ns1,A,52.37,4.89\ns2,B,52.36,4.90\n"
+TRIPS = "route_id,service_id,trip_id\nr1,{service},t1\n"
+STOP_TIMES = "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n" \
+             "t1,08:00:00,08:00:00,s1,1\nt1,08:10:00,08:10:00,s2,2\n"
+
+
+def _day_feed(path, service='mon', date='20230102', stops=STOPS, stop_times=STOP_TIMES):
+    with ZipFile(path, 'w') as ref:
+        ref.writestr('stops.txt', stops)
+        ref.writestr('trips.txt', TRIPS.format(service=service))
+        ref.writestr('stop_times.txt', stop_times)
+        ref.writestr('calendar_dates.txt', f"service_id,date,exception_type\n{service},{date},1\n")
+    return path
+
+
+def test_service_fingerprint(tmp_path):
+    reference = service_fingerprint(_day_feed(tmp_path.joinpath('gtfs_20230102.zip')))
+    # Other dates and service ids, rows and columns in another order
+    stops = "stop_lon,stop_lat,stop_name,stop_id\n4.90,52.36,B,s2\n4.89,52.37,A,s1\n"
+    same = _day_feed(tmp_path.joinpath('gtfs_20230109.zip'), service='mon2', date='20230109', stops=stops)
+    assert service_fingerprint(same) == reference
+
+    later = STOP_TIMES.replace('08:10:00', '08:12:00')
+    other = _day_feed(tmp_path.joinpath('gtfs_20230116.zip'), stop_times=later)
+    assert service_fingerprint(other) != reference
+
+
+def test_file_date():
+    assert file_date('/data/gtfs-nl_20230102.zip') == '20230102'
+
+
+def test_deduplicate():
+    fingerprints = {'20230102': 'a', '20230109': 'b', '20230116': 'a', '20230123': 'a'}
+    assert deduplicate(fingerprints) == {'20230116': '20230102', '20230123': '20230102'}
+    # Only runs of the same service alias each other
+    assert deduplicate(fingerprints, consecutive=True) == {'20230123': '20230116'}
+
+
+def test_record_fingerprints(tmp_path):
+    assert read_aliases(tmp_path) == {}
+    assert record_fingerprints(tmp_path, {'20230102': 'a', '20230109': 'b'}) == {}
+    # Later snapshots are deduplicated against the recorded ones
+    assert record_fingerprints(tmp_path, {'20230116': 'a'}) == {'20230116': '20230102'}
+    assert read_aliases(tmp_path) == {'20230116': '20230102'}
+
+    assert record_aliases(tmp_path, {'20230123': '20230109'}) == {'20230116': '20230102', '20230123': '20230109'}
+    assert read_aliases(tmp_path) == {'20230116': '20230102', '20230123': '20230109'}
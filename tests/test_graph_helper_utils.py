@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('osmnx')
+pytest.importorskip('urbanaccess')
+from staa.graph_analysis.utils.graph_helper_utils import ua_transit_network_to_igraph  # noqa: E402
+
+
+def _transit_net():
+    nodes = pd.DataFrame({'node_id': ['s1_a', 's2_a', 's3_a'], 'x': [4.89, 4.90, 4.91], 'y': [52.37, 52.36, 52.35]})
+    edges = pd.DataFrame({
+        'node_id_from': ['s1_a', 's1_a', 's1_a', 's2_a', 's3_a'],
+        'node_id_to': ['s2_a', 's2_a', 's2_a', 's3_a', 's4_a'],
+        'weight': [4., 6., 8., 3., 2.],
+        'unique_agency_id': ['a'] * 5,
+        'unique_route_id': ['r1_a', 'r2_a', 'r1_a', 'r1_a', 'r1_a'],
+        'unique_trip_id': ['t1_a', 't2_a', 't3_a', 't1_a', 't1_a'],
+        'route_type': [3] * 5,
+    })
+    return type('TransitNet', (), {'transit_nodes': nodes.set_index('node_id'), 'transit_edges': edges})
+
+
+def test_trips_are_aggregated_per_node_pair():
+    G = ua_transit_network_to_igraph(_transit_net())
+    node_ids = np.asarray(G.vs['node_id'])
+    edges = {(node_ids[u], node_ids[v]): e for e, (u, v) in enumerate(G.get_edgelist())}
+    assert sorted(edges) == [('s1_a', 's2_a'), ('s2_a', 's3_a'), ('s3_a', 's4_a')]
+    # The median travel time of the trips, the other attributes of the first one
+    assert G.es[edges['s1_a', 's2_a']]['weight'] == 6.
+    assert G.es[edges['s1_a', 's2_a']]['unique_trip_id'] == 't1_a'
+    assert G['name'] == 'a'
+
+
+def test_edge_endpoints_without_node_become_nodes():
+    G = ua_transit_network_to_igraph(_transit_net())
+    assert G.vcount() == 4
+    missing = G.vs.find(node_id='s4_a')
+    assert missing['x'] is None or np.isnan(missing['x'])
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from staa.accessibility_analysis.hourly_routing import (HOURS_PER_DAY, parse_hours, boarding_graph, hour_groups,
+                                                        hour_routing_graph)
+from staa.accessibility_analysis.od_routing import RoutingGraph, od_tree_metrics
+
+
+def _hourly_graph(make_transit_graph, waits_a: float, waits_b: float):
+    """Line A 0 -> 1 -> 2 of 5 minutes per segment and line B 1 -> 2 of 3 minutes, with their waits at 7:00."""
+    G = make_transit_graph(3, [(0, 1, 5, 'A'), (1, 2, 5, 'A'), (1, 2, 3, 'B')])
+    waits = np.full((G.ecount(), HOURS_PER_DAY), np.inf)
+    waits[:, 7] = [waits_a, waits_a, waits_b]
+    # Line B is not served at 8:00
+    waits[:, 8] = [waits_a, waits_a, np.inf]
+    G['segment_waits'] = waits
+    G['time_window'] = ['07:00:00', '09:00:00']
+    return G
+
+
+def _route(G, hours):
+    Gb = boarding_graph(G)
+    rg = RoutingGraph(Gb)
+    return {tuple(group_hours): od_tree_metrics(hour_routing_graph(rg, weights), [0], [2])
+            for weights, group_hours in hour_groups(Gb, hours)}
+
+
+def test_parse_hours():
+    assert parse_hours('') == []
+    assert parse_hours('9, 7,7') == [7, 9]
+    assert parse_hours('all') == list(range(HOURS_PER_DAY))
+
+
+def test_staying_on_a_line_waits_once(make_transit_graph):
+    # Transferring to B takes 2 + 5 + 10 + 3 minutes, staying on A 2 + 5 + 5
+    od = _route(_hourly_graph(make_transit_graph, 2., 10.), [7])[(7,)]
+    assert od['tt'][0, 0] == 12.
+    assert od['hops'][0, 0] == 2
+    assert od['lines'][0, 0] == 1
+
+
+def test_transfer_pays_the_wait(make_transit_graph):
+    # Transferring to B takes 2 + 5 + 1 + 3 minutes
+    ods = _route(_hourly_graph(make_transit_graph, 2., 1.), [7, 8])
+    assert ods[(7,)]['tt'][0, 0] == 11.
+    assert ods[(7,)]['hops'][0, 0] == 2
+    assert ods[(7,)]['lines'][0, 0] == 2
+    # Without line B the trip stays on A
+    assert ods[(8,)]['tt'][0, 0] == 12.
+
+
+def test_hours_with_the_same_service_share_a_group(make_transit_graph):
+    G = _hourly_graph(make_transit_graph, 2., 1.)
+    G['segment_waits'][:, 8] = G['segment_waits'][:, 7]
+    assert list(_route(G, [7, 8])) == [(7, 8)]
+
+
+def test_hours_outside_the_timerange(make_transit_graph):
+    Gb = boarding_graph(_hourly_graph(make_transit_graph, 2., 1.))
+    with pytest.raises(ValueError):
+        hour_groups(Gb, [7, 9])
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from staa.graph_analysis.utils.id_dictionary import IdDictionary
+
+
+def test_encode_decode_round_trip(tmp_path):
+    ids = IdDictionary({'stop': ['s2_a', 's1_a', 's1_b']})
+    codes = ids.encode('stop', ['s1_b', 's2_a', 'unknown'])
+    np.testing.assert_array_equal(codes, [1, 2, -1])
+    np.testing.assert_array_equal(ids.decode('stop', codes), ['s1_b', 's2_a', ''])
+
+    stored = IdDictionary.read(ids.write(tmp_path))
+    np.testing.assert_array_equal(stored.encode('stop', ['s1_b', 's2_a']), [1, 2])
+    assert len(stored.ids['trip']) == 0
+
+
+def test_encode_unique():
+    ids = IdDictionary({'stop': ['s1_a', 's2_a', 's1_b']})
+    stop_times = pd.DataFrame({'stop_id': ['s1', 's2', 's1', 's3', 's1'],
+                               'unique_agency_id': ['a', 'a', 'b', 'a', 'a']})
+    # The codes of the '<stop_id>_<unique_agency_id>' ids of every row
+    np.testing.assert_array_equal(ids.encode_unique('stop', stop_times, 'stop_id'), [0, 2, 1, -1, 0])
+    assert ids.encode_unique('stop', stop_times.iloc[:0], 'stop_id').shape == (0,)
+
+
+def test_add_keeps_ids_sorted():
+    ids = IdDictionary({'route': ['r2']})
+    ids.add('route', ['r3', 'r1', 'r2'])
+    np.testing.assert_array_equal(ids.ids['route'], ['r1', 'r2', 'r3'])
+    np.testing.assert_array_equal(ids.encode('route', ['r2']), [1])
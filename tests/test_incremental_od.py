@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from staa.accessibility_analysis.incremental_od import (write_od_state, read_od_state, edge_changes,
+                                                        affected_origins, merge_od_states)
+from staa.accessibility_analysis.od_routing import RoutingGraph, od_tree_metrics
+
+N_NODES = 30
+
+
+def _random_edges(rng: np.random.Generator, m: int = 70) -> list:
+    pairs = rng.integers(0, N_NODES, (m, 2))
+    return [(u, v, rng.uniform(1, 10), f"r{rng.integers(0, 4)}") for u, v in pairs if u != v]
+
+
+def _next_graph(rng: np.random.Generator, edges: list) -> list:
+    """The next date of a graph: an edge dropped, one slower, one faster and a new one."""
+    dropped, slower, faster = rng.choice(len(edges), 3, replace=False)
+    changed = [(u, v, tt * (1.5 if e == slower else 0.5 if e == faster else 1.), route)
+               for e, (u, v, tt, route) in enumerate(edges) if e != dropped]
+    return changed + _random_edges(rng, 1)
+
+
+def _state(rg: RoutingGraph, origins: np.ndarray, pois: np.ndarray) -> dict:
+    node_ids = np.asarray(rg.graph.vs['node_id'])
+    od = od_tree_metrics(rg, origins, pois, with_path_edges=True)
+    return {'origin_nodes': node_ids[origins], 'poi_nodes': node_ids[pois], 'tt': od['tt'],
+            'path_edges': od['path_edges']}
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_incremental_equals_full_recompute(seed, tmp_path, make_transit_graph):
+    rng = np.random.default_rng(seed)
+    origins, pois = np.arange(N_NODES), np.arange(0, N_NODES, 3)
+    edges = _random_edges(rng)
+    rg = RoutingGraph(make_transit_graph(N_NODES, edges))
+    state = _state(rg, origins, pois)
+
+    for date in range(3):
+        edges = _next_graph(rng, edges)
+        new_rg = RoutingGraph(make_transit_graph(N_NODES, edges))
+        prev_state = read_od_state(write_od_state(tmp_path.joinpath(f"state_{date}"), state))
+
+        worse, better, prev_to_new = edge_changes(rg, new_rg)
+        affected = affected_origins(prev_state, new_rg, worse, better)
+        # Merged states are ordered by node_id
+        node_index = pd.Index(new_rg.graph.vs['node_id'])
+        fresh = _state(new_rg, node_index.get_indexer(prev_state['origin_nodes'][affected]), pois)
+        state = merge_od_states(prev_state, ~affected, prev_to_new, [fresh], new_rg.graph.vs['node_id'],
+                                len(new_rg.edge_keys))
+
+        full = _state(new_rg, origins, pois)
+        order = np.argsort(state['origin_nodes'])
+        np.testing.assert_array_equal(state['origin_nodes'][order], np.sort(full['origin_nodes']))
+        np.testing.assert_allclose(state['tt'][order], full['tt'][np.argsort(full['origin_nodes'])])
+        # Kept rows carry their path edges over onto the edges of the new graph
+        assert (state['path_edges'][order] != full['path_edges'][np.argsort(full['origin_nodes'])]).nnz == 0
+        rg = new_rg
+
+
+def test_unchanged_graph_affects_nothing(make_transit_graph):
+    rg = RoutingGraph(make_transit_graph(N_NODES, _random_edges(np.random.default_rng(0))))
+    state = _state(rg, np.arange(N_NODES), np.arange(0, N_NODES, 3))
+    worse, better, prev_to_new = edge_changes(rg, rg)
+    assert not worse.any() and not len(better)
+    np.testing.assert_array_equal(prev_to_new, np.arange(len(rg.edge_keys)))
+    assert not affected_origins(state, rg, worse, better).any()
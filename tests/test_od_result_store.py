@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+import pytest
+
+from staa.accessibility_analysis.od_result_store import (META_FILE, UNREACHABLE_NAME, OD_DTYPES, write_od_result,
+                                                         read_od_result, from_compact_od_metric, stack_od_results,
+                                                         open_od_stack)
+
+
+def _matrices(seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    tt = rng.uniform(0, 90, (4, 3))
+    tt[1, 2] = np.inf
+    counts = rng.integers(1, 5, (4, 3)).astype(float)
+    counts[1, 2] = np.nan
+    return {'tt': tt, 'td': np.where(np.isinf(tt), np.inf, tt * 300), 'modes': counts, 'lines': counts,
+            'hops': counts * 2}
+
+
+def test_round_trip(tmp_path):
+    matrices = _matrices()
+    write_od_result(tmp_path, matrices, meta={'graph': 'g1'})
+
+    stored = read_od_result(tmp_path)
+    assert set(stored) == {*matrices, UNREACHABLE_NAME}
+    np.testing.assert_array_equal(stored[UNREACHABLE_NAME], ~np.isfinite(matrices['tt']))
+    for metric, values in matrices.items():
+        assert stored[metric].dtype == OD_DTYPES[metric]
+        # Times and distances are stored as float32
+        np.testing.assert_allclose(from_compact_od_metric(metric, stored[metric]), values, rtol=1e-6)
+    with open(tmp_path.joinpath(META_FILE)) as fp:
+        assert json.load(fp)['graph'] == 'g1'
+
+
+def test_stack(tmp_path):
+    dirs = [write_od_result(tmp_path.joinpath(f"r{i}"), _matrices(i)) for i in range(2)]
+    stack_od_results(dirs, ['2023-01-02', '2023-01-09'], tmp_path.joinpath('stack'))
+
+    tt, labels = open_od_stack(tmp_path.joinpath('stack'), 'tt')
+    assert labels == ['2023-01-02', '2023-01-09']
+    for t in range(2):
+        np.testing.assert_allclose(from_compact_od_metric('tt', tt[t]), _matrices(t)['tt'], rtol=1e-6)
+
+
+def test_stack_rejects_other_shapes(tmp_path):
+    first = write_od_result(tmp_path.joinpath('r0'), _matrices())
+    second = write_od_result(tmp_path.joinpath('r1'), {metric: values[:2] for metric, values in _matrices().items()})
+    with pytest.raises(ValueError):
+        stack_od_results([first, second], ['a', 'b'], tmp_path.joinpath('stack'))
@@ -0,0 +1,60 @@
+import igraph as ig
+import numpy as np
+import pytest
+
+from staa.accessibility_analysis.od_routing import RoutingGraph, od_tree_metrics
+
+
+def test_graph_without_edges():
+    G = ig.Graph(n=3, directed=True)
+    G.es['travel_time'] = []
+    G.es['length'] = []
+    od = od_tree_metrics(RoutingGraph(G), [0, 1], [1, 2], with_path_edges=True)
+    np.testing.assert_array_equal(od['tt'], [[np.inf, np.inf], [0., np.inf]])
+    np.testing.assert_array_equal(od['td'], [[np.inf, np.inf], [0., np.inf]])
+    for metric in ('modes', 'lines', 'hops'):
+        assert np.isnan(od[metric]).all()
+    assert od['path_edges'].shape == (2, 0)
+
+
+def _random_multigraph(seed: int, n: int = 12, m: int = 40) -> ig.Graph:
+    """Random directed graph with parallel edges, distinct travel times make every shortest path unique."""
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, n, (m, 2))
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    # Every pair twice, parallel edges with a travel time and line of their own
+    edges = np.vstack([pairs, pairs])
+    G = ig.Graph(n=n, edges=edges.tolist(), directed=True)
+    G.es['travel_time'] = rng.uniform(1, 10, len(edges)).tolist()
+    G.es['length'] = rng.uniform(100, 1000, len(edges)).tolist()
+    G.es['unique_route_id'] = [f"r{r}" for r in rng.integers(0, 5, len(edges))]
+    G.es['route_type'] = rng.integers(0, 3, len(edges)).tolist()
+    return G
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.filterwarnings("ignore:Couldn't reach some vertices")
+def test_metrics_match_igraph_shortest_paths(seed):
+    G = _random_multigraph(seed)
+    rg = RoutingGraph(G)
+    origins, destinations = np.arange(G.vcount()), np.arange(0, G.vcount(), 2)
+    od = od_tree_metrics(rg, origins, destinations, batch_size=5, with_path_edges=True)
+
+    np.testing.assert_allclose(od['tt'], G.distances(origins, destinations, weights='travel_time'))
+    for i, o in enumerate(origins):
+        paths = G.get_shortest_paths(o, destinations, weights='travel_time', output='epath')
+        for j, path in enumerate(paths):
+            if not path:
+                # Unreached or the origin itself
+                assert np.isnan(od['hops'][i, j])
+                assert od['td'][i, j] == (0. if o == destinations[j] else np.inf)
+                continue
+            assert od['td'][i, j] == pytest.approx(sum(G.es[path]['length']))
+            assert od['hops'][i, j] == len(path)
+            assert od['lines'][i, j] == len(set(G.es[path]['unique_route_id']))
+            assert od['modes'][i, j] == len(set(G.es[path]['route_type']))
+
+        # The path edges of an origin are the union of its paths, indexed like rg.edge_keys
+        on_path = {e for path in paths for e in path}
+        keys = {G.es[e].source * rg.n + G.es[e].target for e in on_path}
+        assert set(rg.edge_keys[od['path_edges'][i].indices]) == keys
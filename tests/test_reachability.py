@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+
+from staa.accessibility_analysis.od_routing import RoutingGraph
+from staa.accessibility_analysis.reachability import ReachabilityIndex
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_shortest_paths(seed, make_transit_graph):
+    rng = np.random.default_rng(seed)
+    n = 80
+    # Sparse, so that the graph falls apart into many strongly connected components
+    edges = [(u, v, 1.) for u, v in rng.integers(0, n, (90, 2)) if u != v]
+    rg = RoutingGraph(make_transit_graph(n, edges))
+    # More targets than fit in a single bitset word
+    targets = rng.choice(n, 70, replace=False)
+    origins = np.arange(n)
+
+    index = ReachabilityIndex(rg.csr, targets)
+    expected = np.isfinite(dijkstra(rg.csr, directed=True, indices=origins)[:, targets])
+    np.testing.assert_array_equal(index.reachable(origins, targets), expected)